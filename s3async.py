@@ -0,0 +1,776 @@
+# -*- coding: utf-8 -*-
+
+# s3async
+#
+# by Walter Graf
+#
+# S3 connections sending their requests from one event loop
+#
+# A boto connection sends one request at a time and waits for its response,
+# so the tools need a thread and a connection per request they want in
+# flight, and a listing has no request outstanding while a page is being
+# processed. A Client instead keeps HTTP/1.1 keep-alive connections to the
+# endpoint and drives all of them from a single thread polling non-blocking
+# sockets: submit() signs a request (Signer: AWS signature version 2 or 4),
+# queues it and returns a Request at once, whose wait() returns the response
+# once it has arrived. Any number of threads may submit, and a single thread
+# can keep thousands of requests queued and as many in flight as the
+# scheduler allows.
+#
+# Python 2 has no asyncio, the loop is built on select.poll. It takes the
+# slots of its requests from the process wide scheduler (s3scheduler) without
+# blocking, so the backend honours the same AIMD concurrency limit, rate limit
+# and retries as the boto connections: requests failing with a 500, 502, 503
+# or 504 response or a connection error are sent again after the jittered
+# backoff. A keep-alive connection the endpoint has closed meanwhile is
+# replaced without counting an attempt. Every attempt is recorded in s3stats.
+#
+# connection() wraps a Client into a boto S3Connection, so that every tool
+# works unchanged on this backend; such a connection may be shared by
+# threads. The hot paths use the Client directly to keep requests in flight
+# while they work: the version listing requests the next page before the
+# current one is processed (s3lister), deletes, copies and metadata lookups
+# have a window of outstanding requests (AsyncDeleter, AsyncCopier,
+# MetadataFilter). client_of() returns the Client of a bucket, None on the
+# boto backend.
+#
+# A forked process (s3fanout) starts a Client of its own on its first
+# request, the connections of the parent are left alone.
+
+import os
+import time
+import errno
+import fcntl
+import heapq
+import random
+import socket
+import select
+import ssl
+import hmac
+import hashlib
+import base64
+import urllib
+import urlparse
+import threading
+import traceback
+import collections
+import email.utils
+import xml.etree.cElementTree as ElementTree
+import s3stats
+import s3scheduler
+
+# seconds a request may take before it fails like a connection error
+S3_ASYNC_TIMEOUT = 70.0
+
+# seconds an unused keep-alive connection is kept open
+S3_ASYNC_IDLE_TIMEOUT = 50.0
+
+# new connections waiting for their first response, more are only opened once these have
+# answered, so that a burst of requests does not overflow the accept queue of the endpoint
+S3_ASYNC_MAX_OPENING = 8
+
+# seconds between two looks for a free slot while requests wait for the scheduler
+S3_ASYNC_POLL_INTERVAL = 0.05
+
+# requests the deleters, copiers and metadata lookups keep in flight or queued
+S3_ASYNC_WINDOW = 2 * s3scheduler.S3_SCHEDULER_MAX_CONCURRENCY
+
+S3_ASYNC_SIGNATURES = [ "v2", "v4" ]
+
+# query parameters that are part of the signed resource in signature version 2
+S3_ASYNC_SUBRESOURCES = [ "acl", "cors", "delete", "lifecycle", "location", "logging", "partNumber", "policy",
+  "requestPayment", "response-cache-control", "response-content-disposition", "response-content-encoding",
+  "response-content-language", "response-content-type", "response-expires", "restore", "tagging", "torrent",
+  "uploadId", "uploads", "versionId", "versioning", "versions", "website" ]
+
+S3_ASYNC_READ_SIZE = 64 * 1024
+
+# signs requests with the credentials of the S3 configuration file
+# signature is v2 (HMAC-SHA1 of the request) or v4 (HMAC-SHA256 with a scope of date and region)
+
+class Signer(object):
+
+  def __init__(self, access, secret, signature="v2", region="us-east-1"):
+    if signature not in S3_ASYNC_SIGNATURES:
+      raise ValueError("unknown signature version %r" % signature)
+    self.access = access
+    self.secret = secret
+    self.signature = signature
+    self.region = region
+
+  # add the date and authorization headers to the headers of a request
+  # path is the quoted path including the query, host the Host header
+
+  def sign(self, method, path, host, headers, body):
+    if self.signature == "v2":
+      self._sign_v2(method, path, headers)
+    else:
+      self._sign_v4(method, path, host, headers, body)
+
+  def _sign_v2(self, method, path, headers):
+    headers["Date"] = email.utils.formatdate(usegmt=True)
+    signed = { "content-md5": "", "content-type": "" }
+    for name, value in headers.items():
+      name = name.lower()
+      if name in [ "content-md5", "content-type", "date" ] or name.startswith("x-amz-"):
+        signed[name] = str(value).strip()
+    if "x-amz-date" in signed:
+      signed["date"] = ""
+    s = method + "\n"
+    for name in sorted(signed):
+      if name.startswith("x-amz-"):
+        s += "%s:%s\n" % (name, signed[name])
+      else:
+        s += signed[name] + "\n"
+    resource, _, query = path.partition("?")
+    s += resource
+    subresources = []
+    for param in query.split("&"):
+      name, equals, value = param.partition("=")
+      if name in S3_ASYNC_SUBRESOURCES:
+        subresources.append(name + equals + urllib.unquote(value))
+    if subresources:
+      s += "?" + "&".join(sorted(subresources, key=lambda p: p.partition("=")[0]))
+    digest = hmac.new(self.secret, s, hashlib.sha1).digest()
+    headers["Authorization"] = "AWS %s:%s" % (self.access, base64.b64encode(digest))
+
+  def _sign_v4(self, method, path, host, headers, body):
+    now = time.gmtime()
+    amz_date = time.strftime("%Y%m%dT%H%M%SZ", now)
+    date = amz_date[:8]
+    headers["X-Amz-Date"] = amz_date
+    headers["x-amz-content-sha256"] = hashlib.sha256(body).hexdigest()
+    resource, _, query = path.partition("?")
+    params = dict(urlparse.parse_qsl(query, keep_blank_values=True))
+    canonical_query = "&".join([ "%s=%s" % (urllib.quote(name, safe="-_.~"), urllib.quote(params[name], safe="-_.~")) for name in sorted(params) ])
+    signed = { "host": host }
+    for name, value in headers.items():
+      if name.lower() != "authorization":
+        signed[name.lower().strip()] = " ".join(str(value).strip().split())
+    names = sorted(signed)
+    canonical_request = "\n".join([
+      method,
+      urllib.quote(urllib.unquote(resource), safe="/~"),
+      canonical_query,
+      "\n".join([ "%s:%s" % (name, signed[name]) for name in names ]) + "\n",
+      ";".join(names),
+      headers["x-amz-content-sha256"]
+      ])
+    scope = "%s/%s/s3/aws4_request" % (date, self.region)
+    string_to_sign = "\n".join([ "AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request).hexdigest() ])
+    key = "AWS4" + self.secret
+    for part in [ date, self.region, "s3", "aws4_request" ]:
+      key = hmac.new(key, part, hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign, hashlib.sha256).hexdigest()
+    headers["Authorization"] = "AWS4-HMAC-SHA256 Credential=%s/%s,SignedHeaders=%s,Signature=%s" % (self.access, scope, ";".join(names), signature)
+
+# the response to a request, answering the part of httplib.HTTPResponse boto uses
+
+class Response(object):
+
+  def __init__(self, status, reason, headers, body):
+    self.status = status
+    self.reason = reason
+    self.headers = headers
+    self.msg = {}
+    for name, value in headers:
+      self.msg[name] = self.msg[name] + ", " + value if name in self.msg else value
+    self.body = body
+    self.position = 0
+
+  # like boto's responses, read() returns the whole body on every call
+
+  def read(self, amt=None):
+    if amt == None:
+      self.position = len(self.body)
+      return self.body
+    data = self.body[self.position:self.position + amt]
+    self.position += len(data)
+    return data
+
+  def getheader(self, name, default=None):
+    return self.msg.get(name.lower(), default)
+
+  def getheaders(self):
+    return self.msg.items()
+
+  def close(self):
+    pass
+
+# the part of an httplib connection a boto sender (e.g. Key.send_file) streams a request body
+# into, getresponse() submits the collected request to client in one piece
+# the body is held in memory, a chunked body is sent with its length instead
+
+class _BodyCollector(object):
+
+  def __init__(self, client, bucket, key, query_args):
+    self.client = client
+    self.bucket = bucket
+    self.key = key
+    self.query_args = query_args
+    self.method = None
+    self.headers = {}
+    self.body = []
+    self.debuglevel = 0
+
+  def putrequest(self, method, path, skip_host=0, skip_accept_encoding=0):
+    self.method = method
+
+  def putheader(self, name, value):
+    self.headers[name] = value
+
+  def endheaders(self):
+    pass
+
+  def set_debuglevel(self, level):
+    self.debuglevel = level
+
+  def send(self, data):
+    self.body.append(data)
+
+  def getresponse(self):
+    headers = {}
+    chunked = False
+    for name, value in self.headers.items():
+      if name.lower() == "transfer-encoding":
+        chunked = value.lower() == "chunked"
+      elif name.lower() != "expect":
+        headers[name] = value
+    body = "".join(self.body)
+    if chunked:
+      body = _unchunk(body)
+    return self.client.submit(self.method, self.bucket, self.key, headers, body, self.query_args).wait()
+
+# the data of a body in chunked transfer encoding
+
+def _unchunk(body):
+  data = []
+  position = 0
+  while True:
+    end = body.index("\r\n", position)
+    size = int(body[position:end].split(";")[0], 16)
+    if size == 0:
+      return "".join(data)
+    data.append(body[end + 2:end + 2 + size])
+    position = end + 2 + size + 2
+
+# a request submitted to a Client
+
+class Request(object):
+
+  def __init__(self, method, path, headers, body, op, callback):
+    self.method = method
+    self.path = path
+    self.headers = headers
+    self.body = body
+    self.op = op
+    self.callback = callback
+    self.attempt = 0
+    self.started = None
+    self.response = None
+    self.error = None
+    self.done = threading.Event()
+
+  # the response, once it has arrived
+  # raises the error of the last attempt if no response has been received
+
+  def wait(self):
+    while not self.done.wait(1.0):
+      pass
+    if self.error != None:
+      raise self.error
+    return self.response
+
+# one HTTP connection of a Client
+
+class _Connection(object):
+
+  def __init__(self, client):
+    self.sock = socket.socket(client.family, socket.SOCK_STREAM)
+    self.sock.setblocking(0)
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.fd = self.sock.fileno()
+    self.state = "connecting"
+    self.request = None
+    self.reused = False
+    self.opening = True
+    self.out = ""
+    self.buffer = ""
+    self.head = None
+    self.body = []
+    self.remaining = None
+    self.deadline = None
+    self.idle_since = None
+    error = self.sock.connect_ex(client.address)
+    if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+      raise socket.error(error, os.strerror(error))
+
+_start_lock = threading.Lock()
+
+class Client(object):
+
+  # host, port, is_secure    the endpoint, see s3connect
+  # access, secret           the credentials
+  # signature, region        see Signer
+
+  def __init__(self, host, port, is_secure, access, secret, signature="v2", region="us-east-1"):
+    self.host = host
+    self.port = port
+    self.is_secure = is_secure
+    self.signer = Signer(access, secret, signature, region)
+    if (port == 443 and is_secure) or (port == 80 and not is_secure):
+      self.host_header = host
+    else:
+      self.host_header = "%s:%d" % (host, port)
+    self.pid = None
+
+  # start the loop of this process on the first request
+
+  def _start(self):
+    family, type, proto, name, self.address = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)[0]
+    self.family = family
+    self.pid = os.getpid()
+    self.lock = threading.Lock()
+    self.submitted = collections.deque()
+    self.waiting = collections.deque()
+    self.timers = []
+    self.sequence = 0
+    self.connections = {}
+    self.idle = []
+    self.opening = 0
+    self.poller = select.poll()
+    self.wake_r, self.wake_w = os.pipe()
+    for fd in [ self.wake_r, self.wake_w ]:
+      fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    self.poller.register(self.wake_r, select.POLLIN)
+    self.ssl_context = None
+    if self.is_secure:
+      self.ssl_context = ssl.create_default_context()
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  # send a request, returns its Request right away
+  # callback is called as callback(request) from the loop once the request is done, it must
+  # not block
+
+  def submit(self, method, bucket="", key="", headers=None, body="", query_args=None, callback=None):
+    if isinstance(key, unicode):
+      key = key.encode("utf-8")
+    if isinstance(body, unicode):
+      body = body.encode("utf-8")
+    path = "/"
+    if bucket:
+      path += bucket + "/"
+    path += urllib.quote(key)
+    if query_args:
+      path += "?" + query_args
+    request = Request(method, path, dict(headers or {}), body or "", s3stats.operation(method, key, query_args), callback)
+
+    # queued under the lock, so that a loop that has died either fails the request or a new
+    # loop is started for it
+
+    with _start_lock:
+      if self.pid != os.getpid():
+        self._start()
+      self.submitted.append(request)
+      self._wake()
+    return request
+
+  def _wake(self):
+    try:
+      os.write(self.wake_w, "x")
+    except OSError as e:
+      if e.errno != errno.EAGAIN:
+        raise
+
+  # the event loop
+  # if the loop dies, all its requests fail with the error and its connections are closed,
+  # the next request starts a new loop
+
+  def _run(self):
+    try:
+      while True:
+        while self.submitted:
+          self.waiting.append(self.submitted.popleft())
+        self._dispatch()
+        self._poll()
+        self._run_timers()
+        self._expire()
+    except Exception as e:
+      traceback.print_exc()
+      with _start_lock:
+        self.pid = None
+        failed = []
+        for c in self.connections.values():
+          if c.request != None:
+            s3scheduler.scheduler.release(False)
+            failed.append(c.request)
+          self._close(c)
+        for when, n, function, request in self.timers:
+          if function == self._send:
+            s3scheduler.scheduler.release(False)
+          failed.append(request)
+        failed += list(self.waiting) + list(self.submitted)
+        for fd in [ self.wake_r, self.wake_w ]:
+          os.close(fd)
+      for request in failed:
+        self._finish(request, None, e)
+
+  # start the waiting requests the scheduler has a slot for
+
+  def _dispatch(self):
+    while self.waiting:
+      if not self.idle and self.opening >= S3_ASYNC_MAX_OPENING:
+        return
+      start = s3scheduler.scheduler.acquire_nowait()
+      if start == None:
+        return
+      request = self.waiting.popleft()
+      if start > time.time():
+        self._timer(start, self._send, request)
+      else:
+        self._send(request)
+
+  def _poll(self):
+    timeout = 1.0
+    if self.waiting:
+      timeout = S3_ASYNC_POLL_INTERVAL
+    if self.timers:
+      timeout = min(timeout, self.timers[0][0] - time.time())
+    for fd, event in self.poller.poll(max(0, int(timeout * 1000))):
+      if fd == self.wake_r:
+        try:
+          while os.read(self.wake_r, 4096):
+            pass
+        except OSError:
+          pass
+        continue
+      c = self.connections.get(fd)
+      if c == None:
+        continue
+      if c.request == None:
+        # the endpoint closed an idle connection or sent something unasked for
+        self._close(c)
+        continue
+      try:
+        self._step(c, event)
+      except (socket.error, ssl.SSLError, _BrokenResponse) as e:
+        self._connection_failed(c, e)
+
+  def _timer(self, when, function, request):
+    self.sequence += 1
+    heapq.heappush(self.timers, (when, self.sequence, function, request))
+
+  def _run_timers(self):
+    now = time.time()
+    while self.timers and self.timers[0][0] <= now:
+      when, n, function, request = heapq.heappop(self.timers)
+      function(request)
+
+  # fail the requests taking too long, close the connections idle for too long
+
+  def _expire(self):
+    now = time.time()
+    for c in self.connections.values():
+      if c.request != None and c.deadline < now:
+        self._connection_failed(c, socket.timeout("timed out"))
+    while self.idle and now - self.idle[0].idle_since > S3_ASYNC_IDLE_TIMEOUT:
+      self._close(self.idle[0])
+
+  # send an attempt of request on an idle connection or a new one
+
+  def _send(self, request, fresh=False):
+    c = None
+    if self.idle and not fresh:
+      c = self.idle.pop()
+      c.reused = True
+      c.state = "sending"
+    else:
+      try:
+        c = _Connection(self)
+      except socket.error as e:
+        request.started = time.time()
+        self._attempt_failed(request, e)
+        return
+      self.connections[c.fd] = c
+      self.poller.register(c.fd, select.POLLOUT)
+      self.opening += 1
+    request.started = time.time()
+    headers = dict(request.headers)
+    if request.body or request.method in [ "PUT", "POST" ]:
+      headers["Content-Length"] = str(len(request.body))
+    self.signer.sign(request.method, request.path, self.host_header, headers, request.body)
+    c.out = "%s %s HTTP/1.1\r\nHost: %s\r\n" % (request.method, request.path, self.host_header)
+    c.out += "".join([ "%s: %s\r\n" % (name, value) for name, value in headers.items() ]) + "\r\n" + request.body
+    c.request = request
+    c.deadline = request.started + S3_ASYNC_TIMEOUT
+    c.buffer = ""
+    c.head = None
+    c.body = []
+    c.remaining = None
+    if c.state == "sending":
+      self.poller.modify(c.fd, select.POLLOUT)
+
+  # advance the connection c on a poll event
+
+  def _step(self, c, event):
+    if c.state == "connecting":
+      error = c.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+      if error:
+        raise socket.error(error, os.strerror(error))
+      if self.ssl_context == None:
+        c.state = "sending"
+      else:
+        c.sock = self.ssl_context.wrap_socket(c.sock, server_hostname=self.host, do_handshake_on_connect=False)
+        c.state = "handshake"
+    if c.state == "handshake":
+      try:
+        c.sock.do_handshake()
+      except ssl.SSLWantReadError:
+        self.poller.modify(c.fd, select.POLLIN)
+        return
+      except ssl.SSLWantWriteError:
+        self.poller.modify(c.fd, select.POLLOUT)
+        return
+      c.state = "sending"
+    if c.state == "sending":
+      while c.out:
+        try:
+          n = c.sock.send(c.out)
+        except ssl.SSLWantWriteError:
+          return
+        except socket.error as e:
+          if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return
+          raise
+        c.out = c.out[n:]
+      c.state = "receiving"
+      self.poller.modify(c.fd, select.POLLIN)
+      return
+    if c.state == "receiving":
+      eof = False
+      while True:
+        try:
+          data = c.sock.recv(S3_ASYNC_READ_SIZE)
+        except ssl.SSLWantReadError:
+          break
+        except socket.error as e:
+          if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            break
+          raise
+        if not data:
+          eof = True
+          break
+        c.buffer += data
+      response = self._parse(c, eof)
+      if response != None:
+        self._received(c, response)
+      elif eof:
+        raise _BrokenResponse("connection closed by the endpoint")
+
+  # the response of c once it is complete, None while more is to come
+
+  def _parse(self, c, eof):
+    if c.head == None:
+      end = c.buffer.find("\r\n\r\n")
+      if end < 0:
+        return None
+      lines = c.buffer[:end].split("\r\n")
+      c.buffer = c.buffer[end + 4:]
+      status_line = lines[0].split(" ", 2)
+      if len(status_line) < 2 or not status_line[0].startswith("HTTP/"):
+        raise _BrokenResponse("bad status line %r" % lines[0])
+      headers = []
+      for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers.append((name.strip().lower(), value.strip()))
+      c.head = (status_line[0], int(status_line[1]), status_line[2] if len(status_line) > 2 else "", headers)
+      fields = dict(headers)
+      if c.request.method == "HEAD" or c.head[1] in (204, 304) or c.head[1] < 200:
+        c.remaining = 0
+      elif fields.get("transfer-encoding", "").lower() == "chunked":
+        c.remaining = "chunked"
+      elif "content-length" in fields:
+        c.remaining = int(fields["content-length"])
+      else:
+        c.remaining = "close"
+    if c.remaining == "close":
+      c.body.append(c.buffer)
+      c.buffer = ""
+      if not eof:
+        return None
+    elif c.remaining == "chunked":
+      while True:
+        end = c.buffer.find("\r\n")
+        if end < 0:
+          return None
+        size = int(c.buffer[:end].split(";")[0], 16)
+        if size == 0:
+          trailer = c.buffer.find("\r\n\r\n", end)
+          if trailer < 0:
+            return None
+          c.buffer = c.buffer[trailer + 4:]
+          break
+        if len(c.buffer) < end + 2 + size + 2:
+          return None
+        c.body.append(c.buffer[end + 2:end + 2 + size])
+        c.buffer = c.buffer[end + 2 + size + 2:]
+    else:
+      take = c.buffer[:c.remaining]
+      c.body.append(take)
+      c.buffer = c.buffer[len(take):]
+      c.remaining -= len(take)
+      if c.remaining > 0:
+        return None
+    version, status, reason, headers = c.head
+    keep_alive = version == "HTTP/1.1" and c.remaining != "close" and dict(headers).get("connection", "").lower() != "close"
+    c.state = "idle" if keep_alive else "closing"
+    return Response(status, reason, headers, "".join(c.body))
+
+  # the response of the current attempt on c has arrived
+
+  def _received(self, c, response):
+    request = c.request
+    c.request = None
+    self._opened(c)
+    if c.state == "idle":
+      c.idle_since = time.time()
+      self.idle.append(c)
+    else:
+      self._close(c)
+    latency = time.time() - request.started
+    if s3stats.stats.enabled:
+      s3stats.stats.request(request.op, latency, len(request.body), response.status)
+      s3stats.stats.received(request.op, len(response.body))
+    if response.status in s3scheduler.S3_SCHEDULER_RETRY_STATUS:
+      s3scheduler.scheduler.release(False)
+      s3stats.stats.event("throttled" if response.status == 503 else "server_error")
+      if request.attempt < s3scheduler.scheduler.retries:
+        self._retry(request)
+        return
+    else:
+      s3scheduler.scheduler.release(s3scheduler.scheduler.usual(request.op, latency))
+    self._finish(request, response, None)
+
+  # the connection c broke, a keep-alive connection closed by the endpoint before it answered
+  # is replaced right away
+
+  def _connection_failed(self, c, error):
+    request = c.request
+    stale = c.reused and c.head == None and not c.buffer and not isinstance(error, socket.timeout)
+    self._close(c)
+    if request == None:
+      return
+    if stale:
+      self._send(request, True)
+      return
+    self._attempt_failed(request, error)
+
+  def _attempt_failed(self, request, error):
+    if s3stats.stats.enabled:
+      s3stats.stats.request(request.op, time.time() - request.started, len(request.body), None)
+    s3scheduler.scheduler.release(False)
+    s3stats.stats.event("connection_error")
+    if request.attempt < s3scheduler.scheduler.retries:
+      self._retry(request)
+      return
+    self._finish(request, None, error)
+
+  def _retry(self, request):
+    request.attempt += 1
+    s3stats.stats.event("retry")
+    backoff = random.uniform(0, min(s3scheduler.S3_SCHEDULER_MAX_DELAY, s3scheduler.S3_SCHEDULER_BASE_DELAY * 2 ** request.attempt))
+    self._timer(time.time() + backoff, self.waiting.append, request)
+
+  def _finish(self, request, response, error):
+    request.response = response
+    request.error = error
+    if request.callback != None:
+      try:
+        request.callback(request)
+      except Exception:
+        traceback.print_exc()
+    request.done.set()
+
+  # c has answered or is closed, it no longer counts as opening
+
+  def _opened(self, c):
+    if c.opening:
+      c.opening = False
+      self.opening -= 1
+
+  def _close(self, c):
+    c.request = None
+    self._opened(c)
+    self.connections.pop(c.fd, None)
+    if c in self.idle:
+      self.idle.remove(c)
+    try:
+      self.poller.unregister(c.fd)
+    except (KeyError, ValueError, select.error):
+      pass
+    try:
+      c.sock.close()
+    except socket.error:
+      pass
+
+class _BrokenResponse(Exception):
+  pass
+
+# (code, message) of an S3 error response, like boto's S3ResponseError reports them
+
+def error(response):
+  code = message = None
+  try:
+    for e in ElementTree.fromstring(response.body):
+      if e.tag == "Code":
+        code = e.text
+      elif e.tag == "Message":
+        message = e.text
+  except SyntaxError:
+    pass
+  return code or str(response.status), message or response.reason
+
+# the Client of the connection of bucket, None if it is a boto connection
+
+def client_of(bucket):
+  return getattr(bucket.connection, "client", None)
+
+# a boto S3Connection sending its requests through client
+# the class is defined on the first call, so that boto is only imported then
+
+_connection_class = None
+
+def connection(client):
+  global _connection_class
+  if _connection_class == None:
+    import boto.s3.connection
+    import boto.s3.key
+
+    class AsyncS3Connection(boto.s3.connection.S3Connection):
+
+      def __init__(self, client):
+        boto.s3.connection.S3Connection.__init__(self,
+          aws_access_key_id = client.signer.access,
+          aws_secret_access_key = client.signer.secret,
+          host = client.host,
+          port = client.port,
+          is_secure = client.is_secure,
+          calling_format = boto.s3.connection.OrdinaryCallingFormat()
+          )
+        self.client = client
+
+      # a body streamed by sender is collected and sent once it is complete
+
+      def make_request(self, method, bucket="", key="", headers=None, data="", query_args=None, sender=None, override_num_retries=None, retry_handler=None):
+        if isinstance(bucket, self.bucket_class):
+          bucket = bucket.name
+        if isinstance(key, boto.s3.key.Key):
+          key = key.name
+        if sender != None:
+          return sender(_BodyCollector(self.client, bucket, key, query_args), method, None, data, headers or {})
+        return self.client.submit(method, bucket, key, headers, data, query_args).wait()
+
+    _connection_class = AsyncS3Connection
+  return _connection_class(client)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# s3bench
+#
+# by Walter Graf
+#
+# usage: s3bench.py [-h] [--keys keys] [--versions versions] [--depth depth]
+#                   [--fanout fanout] [--deleted fraction] [--seed seed]
+#                   [--latency ms] [--throttle fraction]
+#                   [--max-in-flight requests] [--repeat repeat]
+#                   [--shards shards] [--workers workers]
+#                   [--output csv-file-output] [--serve port] [--etags]
+#                   [tool [tool ...]]
+#
+# benchmark the tools against a local fake S3 endpoint
+#
+# positional arguments:
+#   tool                  benchmark these tools (default: s3lisov s3lisdv
+#                         s3listv s3delov s3delvb)
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   --keys keys           number of objects in the bucket (default: 10000)
+#   --versions versions   number of versions per object (default: 3)
+#   --depth depth         number of prefix levels above the objects (default:
+#                         1)
+#   --fanout fanout       number of prefixes per level (default: 10)
+#   --deleted fraction    fraction of objects whose latest version is a delete
+#                         marker (default: 0.1)
+#   --seed seed           seed of the bucket generator (default: 1)
+#   --latency ms          delay every request by this many milliseconds
+#                         (default: 0)
+#   --throttle fraction   answer this fraction of all requests with 503 SlowDown
+#                         (default: 0.0)
+#   --max-in-flight requests
+#                         answer requests beyond this many requests in flight
+#                         with 503 SlowDown
+#   --repeat repeat       run every benchmark this many times and report the
+#                         fastest run (default: 3)
+#   --shards shards       number of shards the listing tools split the listing
+#                         into (default: 1)
+#   --workers workers     number of workers of the listing and delete tools
+#                         (default: 1)
+#   --output csv-file-output
+#                         append the results to this csv file
+#   --serve port          only populate the bucket and serve it on this port
+#                         until interrupted
+#   --etags               give the versions the md5 of their content as etag, as
+#                         s3verify expects
+
+import sys
+import os
+import argparse
+import time
+import tempfile
+import shutil
+import subprocess
+import csv
+import s3fake
+
+S3_BENCH_TOOLS = [ "s3lisov", "s3lisdv", "s3listv", "s3delov", "s3delvb" ]
+S3_BENCH_BUCKET = "bench"
+S3_BENCH_CSV_KEYS = [ "time", "tool", "keys", "versions", "latency_ms", "shards", "workers", "seconds", "versions_per_sec", "requests", "peak_rss_kb" ]
+
+# parse command line arguments
+
+parser = argparse.ArgumentParser(description = "benchmark the tools against a local fake S3 endpoint")
+parser.add_argument("tools", metavar="tool", nargs="*", default=S3_BENCH_TOOLS, help="benchmark these tools (default: %s)" % " ".join(S3_BENCH_TOOLS))
+parser.add_argument("--keys", metavar="keys", type=int, default=10000, help="number of objects in the bucket (default: %(default)s)")
+parser.add_argument("--versions", metavar="versions", type=int, default=3, help="number of versions per object (default: %(default)s)")
+parser.add_argument("--depth", metavar="depth", type=int, default=1, help="number of prefix levels above the objects (default: %(default)s)")
+parser.add_argument("--fanout", metavar="fanout", type=int, default=10, help="number of prefixes per level (default: %(default)s)")
+parser.add_argument("--deleted", metavar="fraction", type=float, default=0.1, help="fraction of objects whose latest version is a delete marker (default: %(default)s)")
+parser.add_argument("--seed", metavar="seed", type=int, default=1, help="seed of the bucket generator (default: %(default)s)")
+parser.add_argument("--latency", metavar="ms", type=float, default=0, help="delay every request by this many milliseconds (default: %(default)s)")
+parser.add_argument("--throttle", metavar="fraction", type=float, default=0.0, help="answer this fraction of all requests with 503 SlowDown (default: %(default)s)")
+parser.add_argument("--max-in-flight", metavar="requests", type=int, help="answer requests beyond this many requests in flight with 503 SlowDown")
+parser.add_argument("--repeat", metavar="repeat", type=int, default=3, help="run every benchmark this many times and report the fastest run (default: %(default)s)")
+parser.add_argument("--shards", metavar="shards", type=int, default=1, help="number of shards the listing tools split the listing into (default: %(default)s)")
+parser.add_argument("--workers", metavar="workers", type=int, default=1, help="number of workers of the listing and delete tools (default: %(default)s)")
+parser.add_argument("--output", metavar="csv-file-output", help="append the results to this csv file")
+parser.add_argument("--serve", metavar="port", type=int, help="only populate the bucket and serve it on this port until interrupted")
+parser.add_argument("--etags", action="store_true", help="give the versions the md5 of their content as etag, as s3verify expects")
+args = parser.parse_args()
+
+tools = args.tools
+repeat = args.repeat
+shards = args.shards
+workers = args.workers
+
+for tool in tools:
+  if tool not in S3_BENCH_TOOLS:
+    parser.error("unknown tool %s, choose from %s" % (tool, " ".join(S3_BENCH_TOOLS)))
+if args.keys < 1 or args.versions < 1 or args.depth < 0 or args.fanout < 1:
+  parser.error("keys, versions and fanout must be at least 1, depth at least 0")
+if repeat < 1 or shards < 1 or workers < 1:
+  parser.error("repeat, shards and workers must be at least 1")
+
+# start the fake endpoint and fill the bucket
+
+s3 = s3fake.FakeS3(args.latency / 1000.0, args.throttle, args.max_in_flight)
+host, port = s3.start(port = args.serve or 0)
+
+def populate():
+  return s3fake.populate(s3, S3_BENCH_BUCKET, args.keys, args.versions, args.depth, args.fanout, args.deleted, args.seed, args.etags)
+
+versions = populate()
+print >> sys.stderr, "bucket", S3_BENCH_BUCKET, "with", args.keys, "objects and", versions, "versions served on", "%s:%d" % (host, port)
+
+workdir = tempfile.mkdtemp(prefix="s3bench")
+s3_conf = os.path.join(workdir, "s3versioning.cnf")
+with open(s3_conf, "wb") as f:
+  f.write("[connect]\naccess = bench\nsecret = bench\nhost = %s\nport = %d\nis_secure = false\n" % (host, port))
+
+if args.serve != None:
+  print >> sys.stderr, "S3 configuration file", s3_conf
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    pass
+  s3.stop()
+  shutil.rmtree(workdir)
+  sys.exit(0)
+
+# run a tool in a child process, returns (seconds, peak RSS in KB) or exits if the tool fails
+# the fake endpoint keeps serving from this process while the child runs
+
+tool_dir = os.path.dirname(os.path.abspath(__file__))
+log_file = os.path.join(workdir, "stderr")
+
+def run(tool, tool_args):
+  command = [ sys.executable, os.path.join(tool_dir, tool + ".py"), "-c", s3_conf, S3_BENCH_BUCKET ] + tool_args
+  with open(log_file, "wb") as log:
+    started = time.time()
+    child = subprocess.Popen(command, stdout=log, stderr=log)
+    pid, status, usage = os.wait4(child.pid, 0)
+    seconds = time.time() - started
+  if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+    print >> sys.stderr, tool, "failed:"
+    with open(log_file, "rb") as log:
+      sys.stderr.writelines(log.readlines()[-10:])
+    s3.stop()
+    shutil.rmtree(workdir)
+    sys.exit(1)
+  return seconds, usage.ru_maxrss
+
+# command line arguments of every tool
+# s3delov deletes all versions of the bucket according to a complete listing made beforehand
+
+list_file = os.path.join(workdir, "versions.csv")
+output_file = os.path.join(workdir, "output")
+
+def tool_args(tool):
+  if tool == "s3delov":
+    return [ "--input", list_file, "--workers", str(workers) ]
+  if tool == "s3delvb":
+    return [ "--yes-i-really-really-mean-it", "--workers", str(workers) ]
+  listing = [ "--output", output_file, "--shards", str(shards), "--workers", str(workers) ]
+  if tool == "s3listv":
+    listing += [ "--version-limit", "1" ]
+  return listing
+
+if "s3delov" in tools:
+  run("s3lisov", [ "--output", list_file ])
+
+# run the benchmarks
+# every run gets a freshly populated bucket, so that a tool running after a delete tool
+# finds all versions and the rates are comparable
+
+results = []
+for tool in tools:
+  best = None
+  peak_rss = 0
+  for i in range(repeat):
+    populate()
+    s3.reset_requests()
+    seconds, rss = run(tool, tool_args(tool))
+    if tool in [ "s3delov", "s3delvb" ] and S3_BENCH_BUCKET in s3.buckets and s3.buckets[S3_BENCH_BUCKET].versions:
+      print >> sys.stderr, tool, "left", s3.buckets[S3_BENCH_BUCKET].versions, "versions behind"
+    requests = sum(s3.requests.values())
+    peak_rss = max(peak_rss, rss)
+    if best == None or seconds < best[0]:
+      best = (seconds, requests, dict(s3.requests))
+  seconds, requests, operations = best
+  print >> sys.stderr, tool, "requests:", ", ".join([ "%s %d" % (op, n) for op, n in sorted(operations.items()) ])
+  results.append({
+    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "tool": tool,
+    "keys": args.keys,
+    "versions": versions,
+    "latency_ms": args.latency,
+    "shards": shards,
+    "workers": workers,
+    "seconds": "%.3f" % seconds,
+    "versions_per_sec": "%.0f" % (versions / seconds),
+    "requests": requests,
+    "peak_rss_kb": peak_rss
+    })
+
+s3.stop()
+shutil.rmtree(workdir)
+
+# report
+
+print "%-10s %10s %10s %14s %10s %14s" % ("tool", "versions", "seconds", "versions/sec", "requests", "peak RSS (MB)")
+for r in results:
+  print "%-10s %10d %10s %14s %10d %14.1f" % (r["tool"], r["versions"], r["seconds"], r["versions_per_sec"], r["requests"], r["peak_rss_kb"] / 1024.0)
+
+if args.output != None:
+  write_header = not os.path.exists(args.output)
+  with open(args.output, "ab") as f:
+    writer = csv.DictWriter(f, S3_BENCH_CSV_KEYS, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    if write_header:
+      writer.writeheader()
+    writer.writerows(results)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+# s3catalog
+#
+# by Walter Graf
+#
+# local SQLite catalog of object versions
+#
+# The catalog mirrors the version listing of buckets (the csv fields plus
+# etag and storage class) so that the listing tools can answer their queries
+# without listing the bucket again. It is filled by s3sync.
+#
+# Every version is stored with its position within its object (seq 0 is the
+# newest version) and the number of versions that are not delete markers up
+# to and including this position (vcount). Listing the catalog ordered by
+# object and seq reproduces the order of the S3 version listing.
+#
+# A sync of a prefix is incremental: the listing is merged with the catalog
+# object by object, only objects whose versions changed are rewritten and
+# objects which disappeared from the bucket are removed. The time a prefix
+# has last been synced is kept as its watermark.
+
+import time
+import sqlite3
+import itertools
+import s3record
+
+# number of objects merged between two commits during sync
+S3_CATALOG_COMMIT_INTERVAL = 10000
+
+S3_CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+  bucket TEXT NOT NULL,
+  object TEXT NOT NULL,
+  seq INTEGER NOT NULL,
+  version_id TEXT NOT NULL,
+  mod_time TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  del_marker INTEGER NOT NULL,
+  is_latest INTEGER NOT NULL,
+  etag TEXT,
+  storage_class TEXT,
+  vcount INTEGER NOT NULL,
+  PRIMARY KEY (bucket, object, seq)
+);
+CREATE INDEX IF NOT EXISTS versions_mod_time ON versions (bucket, mod_time);
+CREATE INDEX IF NOT EXISTS versions_latest ON versions (bucket, del_marker, mod_time) WHERE seq = 0;
+CREATE INDEX IF NOT EXISTS versions_vcount ON versions (bucket, vcount);
+CREATE TABLE IF NOT EXISTS prefixes (
+  bucket TEXT NOT NULL,
+  prefix TEXT NOT NULL,
+  synced TEXT NOT NULL,
+  objects INTEGER NOT NULL,
+  versions INTEGER NOT NULL,
+  PRIMARY KEY (bucket, prefix)
+);
+"""
+
+S3_CATALOG_COLUMNS = "object, version_id, mod_time, size, del_marker, is_latest, etag, storage_class"
+
+# mod_time values (S3 timestamps in UTC) compare like their first 19 characters
+# (yyyy-mm-ddThh:mm:ss) do once this suffix is appended to a 19 character timestamp
+
+S3_CATALOG_TIME_SUFFIX = "~"
+
+class Catalog(object):
+
+  def __init__(self, path):
+    self.db = sqlite3.connect(path)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.executescript(S3_CATALOG_SCHEMA)
+
+  def close(self):
+    self.db.close()
+
+  # watermark of the synced prefix covering prefix, None if prefix has never been synced
+
+  def watermark(self, bucket, prefix=None):
+    prefix = prefix or ""
+    synced = None
+    for p, s in self.db.execute("SELECT prefix, synced FROM prefixes WHERE bucket = ?", (bucket,)):
+      if prefix.startswith(p) and (synced is None or s > synced):
+        synced = s
+    return synced
+
+  # yield the catalogued versions below prefix in S3 listing order as s3record.Version records
+  # the optional criteria narrow down the versions the same way the listing tools do
+  # after           only versions modified after this time (yyyy-mm-ddThh:mm:ss, UTC)
+  # deleted_before  only objects whose latest version is a delete marker created before this time (UTC)
+  # only_deleted    only latest versions which are delete markers
+  # no_deleted      no latest versions which are delete markers
+  # version_limit   only objects with more than version_limit versions
+
+  def versions(self, bucket, prefix=None, after=None, deleted_before=None, only_deleted=False, no_deleted=False, version_limit=None):
+    where = [ "v.bucket = ?" ]
+    params = [ bucket ]
+    if prefix:
+      where.append("v.object >= ? AND substr(v.object, 1, ?) = ?")
+      params += [ prefix, len(prefix), prefix ]
+    if after is not None:
+      where.append("v.mod_time > ?")
+      params.append(after + S3_CATALOG_TIME_SUFFIX)
+    if only_deleted:
+      where.append("v.del_marker = 1 AND v.is_latest = 1")
+    if no_deleted:
+      where.append("NOT (v.del_marker = 1 AND v.is_latest = 1)")
+    if deleted_before is not None:
+      where.append("v.object IN (SELECT object FROM versions WHERE bucket = ? AND seq = 0 AND del_marker = 1 AND mod_time < ?)")
+      params += [ bucket, deleted_before ]
+    if version_limit is not None:
+      where.append("v.object IN (SELECT object FROM versions WHERE bucket = ? AND vcount > ?)")
+      params += [ bucket, version_limit ]
+    query = "SELECT " + ", ".join([ "v." + c.strip() for c in S3_CATALOG_COLUMNS.split(",") ]) + " FROM versions v WHERE " + " AND ".join(where) + " ORDER BY v.object, v.seq"
+    for row in self.db.execute(query, params):
+      yield _version(row)
+
+  # merge the listing of versions below prefix into the catalog
+  # versions must be in S3 listing order, returns (objects, changed, removed, versions)
+
+  def sync(self, bucket, prefix, versions):
+    prefix = prefix or ""
+    synced = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime())
+    objects = changed = removed = count = 0
+    last_name = None
+    for name, group in itertools.groupby(versions, lambda v: v.name):
+      rows = _rows(group)
+      removed += self._remove_between(bucket, prefix, last_name, name)
+      stored = self.db.execute("SELECT " + S3_CATALOG_COLUMNS + " FROM versions WHERE bucket = ? AND object = ? ORDER BY seq", (bucket, name)).fetchall()
+      if stored != rows:
+        self.db.execute("DELETE FROM versions WHERE bucket = ? AND object = ?", (bucket, name))
+        vcount = 0
+        for seq, r in enumerate(rows):
+          if not r[4]:
+            vcount += 1
+          self.db.execute("INSERT INTO versions (bucket, seq, vcount, " + S3_CATALOG_COLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (bucket, seq, vcount) + r)
+        changed += 1
+      objects += 1
+      count += len(rows)
+      last_name = name
+      if objects % S3_CATALOG_COMMIT_INTERVAL == 0:
+        self.db.commit()
+    removed += self._remove_between(bucket, prefix, last_name, None)
+    self.db.execute("INSERT OR REPLACE INTO prefixes (bucket, prefix, synced, objects, versions) VALUES (?, ?, ?, ?, ?)", (bucket, prefix, synced, objects, count))
+    self.db.commit()
+    return objects, changed, removed, count
+
+  # remove the objects below prefix between low and high (both exclusive, None means unbounded)
+
+  def _remove_between(self, bucket, prefix, low, high):
+    where = "bucket = ? AND object >= ? AND substr(object, 1, ?) = ?"
+    params = [ bucket, prefix, len(prefix), prefix ]
+    if low is not None:
+      where += " AND object > ?"
+      params.append(low)
+    if high is not None:
+      where += " AND object < ?"
+      params.append(high)
+    cursor = self.db.execute("SELECT COUNT(DISTINCT object) FROM versions WHERE " + where, params)
+    n = cursor.fetchone()[0]
+    if n:
+      self.db.execute("DELETE FROM versions WHERE " + where, params)
+    return n
+
+# catalog rows of the versions of one object
+
+def _rows(versions):
+  rows = []
+  for v in versions:
+    if v.del_marker:
+      rows.append((v.name, v.version_id, v.last_modified, 0, 1, int(v.is_latest), None, None))
+    else:
+      rows.append((v.name, v.version_id, v.last_modified, int(v.size), 0, int(v.is_latest), v.etag, v.storage_class))
+  return rows
+
+# version record of a catalog row
+
+def _version(row):
+  name, version_id, mod_time, size, del_marker, is_latest, etag, storage_class = row
+  return s3record.Version(name, version_id, mod_time, size, bool(is_latest), bool(del_marker), etag, storage_class)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+# s3checkpoint
+#
+# by Walter Graf
+#
+# checkpoints for resumable listings
+#
+# A checkpoint records the pagination markers of the last completed listing
+# page together with the state a tool needs to carry on from there, e.g. the
+# offset of its partial csv output or its per object counters.
+# Saving a checkpoint costs an fsync of the output and of the checkpoint
+# file, so the tools update their checkpoint after every page but it is only
+# written to disk once the save interval has elapsed.
+# The checkpoint file is replaced atomically, a crash leaves either the old or
+# the new checkpoint behind.
+
+import os
+import time
+import json
+
+# minimum number of seconds between two checkpoint writes
+S3_CHECKPOINT_INTERVAL = 10.0
+
+class Checkpoint(object):
+
+  def __init__(self, path, interval=S3_CHECKPOINT_INTERVAL):
+    self.path = path
+    self.interval = interval
+    self.saved = time.time()
+
+  # the recorded state or None if there is no checkpoint
+
+  def load(self):
+    if not os.path.exists(self.path):
+      return None
+    with open(self.path, "rb") as f:
+      return json.load(f)
+
+  # True if the save interval has elapsed since the last write
+
+  def due(self):
+    return time.time() - self.saved >= self.interval
+
+  # durably record state, the files are flushed and synced first so the state
+  # never refers to data that did not make it to disk
+
+  def save(self, state, files=()):
+    for f in files:
+      f.flush()
+      os.fsync(f.fileno())
+    tmp = self.path + ".tmp"
+    with open(tmp, "wb") as f:
+      json.dump(state, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(tmp, self.path)
+    self.saved = time.time()
+
+  # forget the checkpoint once the listing has completed
+
+  def remove(self):
+    if os.path.exists(self.path):
+      os.remove(self.path)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+# s3connect
+#
+# by Walter Graf
+#
+# connections to the S3 endpoint of the S3 configuration file
+#
+# The [connect] section of the S3 configuration file names the endpoint and
+# the credentials:
+#
+#   [connect]
+#   access = <access key>
+#   secret = <secret key>
+#   host = <host name>
+#   port = 443
+#   is_secure = true
+#   signature = v2
+#   region = us-east-1
+#
+# signature (v2 or v4, default v2) is the AWS signature version of the
+# requests, region the region signature version 4 signs for.
+#
+# connector() returns a function opening a new connection on every call; the
+# tools call it once for every worker thread, as boto connections must not be
+# shared between threads. The connections record their requests (s3stats)
+# and send them through the scheduler (s3scheduler).
+#
+# The tools take the backend of their connections with --backend: boto sends
+# every request with boto's own HTTP connections, async through one event
+# loop per process (s3async), where the listings, deletes, copies and
+# metadata lookups keep many requests in flight without a thread each.
+#
+# boto takes a while to import, it is only imported once the first
+# connection is opened, so that e.g. --help does not pay for it.
+#
+# A long running process (s3daemon) keeps the connections of finished tool
+# runs in a ConnectionPool and hands them to the next runs, boto keeps their
+# HTTP connections alive, so that the next runs skip the TCP and TLS set up.
+
+import time
+import threading
+import ConfigParser
+import s3stats
+import s3scheduler
+
+# number of idle connections kept by a ConnectionPool
+S3_POOL_MAX_IDLE = 64
+
+S3_BACKENDS = [ "boto", "async" ]
+
+# the S3 configuration file at path
+
+def read_config(path):
+  cnf = ConfigParser.RawConfigParser()
+  cnf.read(path)
+  return cnf
+
+# function opening a new connection to the endpoint of the configuration cnf
+# backend is one of S3_BACKENDS
+
+def connector(cnf, backend="boto"):
+  access = cnf.get("connect", "access")
+  secret = cnf.get("connect", "secret")
+  host = cnf.get("connect", "host")
+  port = cnf.getint("connect", "port")
+  is_secure = cnf.getboolean("connect", "is_secure")
+  signature = "v2"
+  if cnf.has_option("connect", "signature"):
+    signature = cnf.get("connect", "signature")
+  region = "us-east-1"
+  if cnf.has_option("connect", "region"):
+    region = cnf.get("connect", "region")
+  if signature not in [ "v2", "v4" ]:
+    raise ValueError("unknown signature version %r in the S3 configuration" % signature)
+  if backend not in S3_BACKENDS:
+    raise ValueError("unknown backend %r" % backend)
+
+  def connect():
+    import boto
+    import boto.s3.connection
+    connection = boto.connect_s3(
+      aws_access_key_id = access,
+      aws_secret_access_key = secret,
+      host = host,
+      port = port,
+      is_secure = is_secure,
+      calling_format = boto.s3.connection.OrdinaryCallingFormat()
+      )
+    if signature == "v4":
+      import boto.auth
+      connection._auth_handler = boto.auth.S3HmacAuthV4Handler(host, boto.config, connection.provider, region_name=region)
+    return s3scheduler.schedule(s3stats.instrument(connection))
+
+  # the connections of the async backend share the event loop of one client
+
+  client = []
+  lock = threading.Lock()
+
+  def connect_async():
+    import s3async
+    with lock:
+      if not client:
+        client.append(s3async.Client(host, port, is_secure, access, secret, signature, region))
+    return s3async.connection(client[0])
+
+  if backend == "async":
+    return connect_async
+  return connect
+
+# connections kept open between the tool runs of a long running process
+
+class ConnectionPool(object):
+
+  # connect     function opening a new connection, see connector()
+  # max_idle    number of idle connections kept, the ones idle longest are dropped
+
+  def __init__(self, connect, max_idle=S3_POOL_MAX_IDLE):
+    self.connect = connect
+    self.max_idle = max_idle
+    self.idle = []
+    self.lock = threading.Lock()
+    self.opened = 0
+    self.reused = 0
+
+  # function opening connections for one tool run like connector(), taking idle connections
+  # first, its release() hands the connections back once the run is over
+
+  def lease(self):
+    return _Lease(self)
+
+  # open n connections up front
+
+  def warm_up(self, n):
+    self._give([ self._take() for i in range(n) ])
+    self.keep_alive(0)
+
+  # send a request on every connection idle for more than idle_sec seconds, so that its HTTP
+  # connection stays open
+
+  def keep_alive(self, idle_sec):
+    with self.lock:
+      now = time.time()
+      stale = [ c for c, released in self.idle if now - released > idle_sec ]
+      self.idle = [ (c, released) for c, released in self.idle if now - released <= idle_sec ]
+    alive = []
+    for c in stale:
+      try:
+        c.get_all_buckets()
+        alive.append(c)
+      except Exception:
+        pass
+    self._give(alive)
+
+  def _take(self):
+    with self.lock:
+      if self.idle:
+        self.reused += 1
+        return self.idle.pop()[0]
+      self.opened += 1
+    return self.connect()
+
+  def _give(self, connections):
+    now = time.time()
+    with self.lock:
+      self.idle.extend([ (c, now) for c in connections ])
+      self.idle.sort(key=lambda i: i[1])
+      del self.idle[0:max(0, len(self.idle) - self.max_idle)]
+
+class _Lease(object):
+
+  def __init__(self, pool):
+    self.pool = pool
+    self.taken = []
+    self.lock = threading.Lock()
+
+  def __call__(self):
+    c = self.pool._take()
+    with self.lock:
+      self.taken.append(c)
+    return c
+
+  def release(self):
+    with self.lock:
+      taken, self.taken = self.taken, []
+    self.pool._give(taken)
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+# s3copier
+#
+# by Walter Graf
+#
+# server-side copies of object versions onto their own object
+#
+# Copying an older version of an object onto the object makes it the current
+# version again without deleting anything: the versions in between stay in
+# the history. The data never leaves the S3 platform, the copy is done with
+# PUT Object - Copy (x-amz-copy-source), keeping metadata and storage class.
+# Versions larger than 5 GB, the limit of a single copy request, are copied
+# as a multipart upload with parts copied from the source version.
+#
+# ParallelCopier spreads the copies over a pool of worker threads, each
+# owning its own S3 connection, fed through a bounded queue like
+# s3deleter.ParallelDeleter. On the async backend (s3async) AsyncCopier keeps
+# a window of copy requests in flight from the event loop instead, copier()
+# picks the copier fitting the backend.
+
+import urllib
+import threading
+import Queue
+import collections
+import s3async
+
+# largest object a single copy request can copy and part size of larger copies
+S3_MAX_COPY_SIZE = 5 * 1024 ** 3
+S3_COPY_PART_SIZE = 512 * 1024 ** 2
+
+class VersionCopier(object):
+
+  # bucket       bucket the versions are copied in
+  # on_failure   called as on_failure(name, version_id, code, message, row) for each failed copy
+
+  def __init__(self, bucket, on_failure=None):
+    self.bucket = bucket
+    self.on_failure = on_failure
+    self.copied = 0
+    self.bytes = 0
+    self.failed = 0
+    self.requests = 0
+    self.errors = {}
+
+  # make version version_id of size bytes the current version of object name
+  # row is handed back to on_failure untouched
+
+  def copy(self, name, version_id, size, storage_class=None, row=None):
+    import boto.exception
+    try:
+      if size > S3_MAX_COPY_SIZE:
+        self._copy_multipart(name, version_id, size, storage_class)
+      else:
+        self.requests += 1
+        self.bucket.copy_key(name, self.bucket.name, name, src_version_id=version_id, storage_class=storage_class or "STANDARD")
+    except boto.exception.S3ResponseError as e:
+      self._fail(name, version_id, e.error_code or str(e.status), e.message or e.reason, row)
+      return
+    except Exception as e:
+      self._fail(name, version_id, e.__class__.__name__, str(e), row)
+      return
+    self.copied += 1
+    self.bytes += size
+
+  # a multipart upload does not copy the metadata, it is taken from the source version
+
+  def _copy_multipart(self, name, version_id, size, storage_class):
+    self.requests += 1
+    source = self.bucket.get_key(name, version_id=version_id)
+    headers = {}
+    if source.content_type:
+      headers["Content-Type"] = source.content_type
+    if storage_class:
+      headers["x-amz-storage-class"] = storage_class
+    self.requests += 1
+    upload = self.bucket.initiate_multipart_upload(name, headers=headers, metadata=source.metadata)
+    try:
+      part = 0
+      for start in range(0, size, S3_COPY_PART_SIZE):
+        part += 1
+        self.requests += 1
+        upload.copy_part_from_key(self.bucket.name, name, part, start, min(start + S3_COPY_PART_SIZE, size) - 1, src_version_id=version_id)
+      self.requests += 1
+      upload.complete_upload()
+    except Exception:
+      upload.cancel_upload()
+      raise
+
+  def close(self):
+    pass
+
+  def _fail(self, name, version_id, code, message, row):
+    self.failed += 1
+    self.errors[code] = self.errors.get(code, 0) + 1
+    if self.on_failure is not None:
+      self.on_failure(name, version_id, code, message, row)
+
+class AsyncCopier(VersionCopier):
+
+  # bucket       bucket on the async backend the versions are copied in
+  # on_failure   see VersionCopier
+  # window       number of copies kept in flight, copy() blocks while as many are outstanding
+
+  def __init__(self, bucket, on_failure=None, window=s3async.S3_ASYNC_WINDOW):
+    VersionCopier.__init__(self, bucket, on_failure)
+    self.client = s3async.client_of(bucket)
+    self.window = window
+    self.in_flight = collections.deque()
+
+  # like VersionCopier.copy(), but the copy is only sent, close() waits for all copies
+  # versions larger than a single copy request are copied right away as a multipart upload
+
+  def copy(self, name, version_id, size, storage_class=None, row=None):
+    if size > S3_MAX_COPY_SIZE:
+      VersionCopier.copy(self, name, version_id, size, storage_class, row)
+      return
+    key = name.encode("utf-8") if isinstance(name, unicode) else name
+    headers = {
+      "x-amz-copy-source": "%s/%s?versionId=%s" % (self.bucket.name, urllib.quote(key), version_id),
+      "x-amz-metadata-directive": "COPY",
+      "x-amz-storage-class": storage_class or "STANDARD"
+      }
+    self.requests += 1
+    self.in_flight.append((name, version_id, size, row, self.client.submit("PUT", self.bucket.name, name, headers=headers)))
+    while len(self.in_flight) > self.window:
+      self._complete()
+
+  def close(self):
+    while self.in_flight:
+      self._complete()
+
+  # a copy can fail after its 200 response has started, the body is an error then
+
+  def _complete(self):
+    name, version_id, size, row, request = self.in_flight.popleft()
+    try:
+      response = request.wait()
+    except Exception as e:
+      self._fail(name, version_id, e.__class__.__name__, str(e), row)
+      return
+    if response.status != 200 or "<Error>" in response.body:
+      code, message = s3async.error(response)
+      self._fail(name, version_id, code, message, row)
+      return
+    self.copied += 1
+    self.bytes += size
+
+class ParallelCopier(object):
+
+  # open_bucket  called once per worker, must return a bucket on a connection of its own
+  # workers      number of worker threads
+  # on_failure   see VersionCopier, calls are serialized
+  # queue_size   maximum number of copies waiting for a worker (default: 2 per worker)
+
+  def __init__(self, open_bucket, workers, on_failure=None, queue_size=None):
+    if workers < 1:
+      raise ValueError("number of workers must be at least 1")
+    self.on_failure = on_failure
+    self.lock = threading.Lock()
+    self.queue = Queue.Queue(queue_size or 2 * workers)
+    self.copied = 0
+    self.bytes = 0
+    self.failed = 0
+    self.requests = 0
+    self.errors = {}
+
+    # connections are opened up front so that connection problems surface in the caller
+
+    self.copiers = [ VersionCopier(open_bucket(), self._report) for i in range(workers) ]
+    self.threads = []
+    for c in self.copiers:
+      t = threading.Thread(target=self._work, args=(c,))
+      t.daemon = True
+      t.start()
+      self.threads.append(t)
+
+  # queue a copy, blocks while all workers are busy and the queue is full
+
+  def copy(self, name, version_id, size, storage_class=None, row=None):
+    self.queue.put((name, version_id, size, storage_class, row))
+
+  # wait for all queued copies to be done and collect the worker statistics
+
+  def close(self):
+    for t in self.threads:
+      self.queue.put(None)
+    for t in self.threads:
+      t.join()
+    self.copied = sum([ c.copied for c in self.copiers ])
+    self.bytes = sum([ c.bytes for c in self.copiers ])
+    self.failed = sum([ c.failed for c in self.copiers ])
+    self.requests = sum([ c.requests for c in self.copiers ])
+    self.errors = {}
+    for c in self.copiers:
+      for code, count in c.errors.items():
+        self.errors[code] = self.errors.get(code, 0) + count
+
+  def _work(self, copier):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        break
+      copier.copy(*item)
+
+  def _report(self, name, version_id, code, message, row):
+    if self.on_failure is not None:
+      with self.lock:
+        self.on_failure(name, version_id, code, message, row)
+
+# the copier for the bucket returned by open_bucket
+# an AsyncCopier on the async backend, else a ParallelCopier with workers threads
+
+def copier(open_bucket, workers, on_failure=None):
+  bucket = open_bucket()
+  if s3async.client_of(bucket) != None:
+    return AsyncCopier(bucket, on_failure)
+  return ParallelCopier(open_bucket, workers, on_failure)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+# s3csv
+#
+# by Walter Graf
+#
+# csv output of object versions
+#
+# VersionWriter writes object versions as csv rows with the columns
+# s3version.S3_CSV_KEYS, the format s3delov reads.
+
+import csv
+import s3version
+
+class VersionWriter(object):
+
+  # output        file the csv rows are written to
+  # bucket_name   value of the bucket column
+  # header        write the header row (not wanted when appending to a resumed listing)
+
+  def __init__(self, output, bucket_name, header=True):
+    self.output = output
+    self.csv_dict = {}
+    self.csv_writer = csv.DictWriter(output, s3version.S3_CSV_KEYS, delimiter=",", quotechar='"')
+
+    #csv_writer.writeheader()
+    for k in s3version.S3_CSV_KEYS:
+      self.csv_dict[k] = k
+    if header:
+      self.csv_writer.writerow(self.csv_dict)
+    self.csv_dict["bucket"] = bucket_name
+
+  # populate csv_dict and write to csv file
+
+  def write(self, v):
+    csv_dict = self.csv_dict
+    csv_dict["object"] = v.name
+    csv_dict["version_id"] = v.version_id
+    csv_dict["mod_time"] = v.last_modified
+    if v.del_marker:
+      csv_dict["size"] = "0"
+      csv_dict["del_marker"] = "yes"
+    else:
+      csv_dict["size"] = str(v.size)
+      csv_dict["del_marker"] = "no"
+    csv_dict["is_latest"] = str(v.is_latest)
+    self.csv_writer.writerow(csv_dict)
+
+  def flush(self):
+    self.output.flush()
+
+  def close(self):
+    self.output.close()
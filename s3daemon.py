@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# s3daemon
+#
+# by Walter Graf
+#
+# usage: s3daemon.py [-h] [-c s3-config-file] [--socket socket-file]
+#                    [--jobs jobs] [--connections connections]
+#                    [--keep-alive seconds] [--backend {boto,async}]
+#                    [--retries retries] [--max-rate requests-per-sec] [--stats]
+#                    [--stats-file stats-file]
+#                    [--stats-format {prometheus,json}]
+#
+# run listing, delete and restore jobs of local clients with warm S3 connections
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   -c s3-config-file     use this S3 configuration file (default:
+#                         $HOME/s3versioning.cnf)
+#   --socket socket-file  accept jobs on this Unix domain socket (default:
+#                         $HOME/s3daemon.sock)
+#   --jobs jobs           run this many jobs at a time (default: 4)
+#   --connections connections
+#                         open this many S3 connections at start (default: 4)
+#   --keep-alive seconds  send a request on connections idle for this many
+#                         seconds to keep them open (default: 30.0)
+#   --backend {boto,async}
+#                         send the S3 requests through boto's connections or the
+#                         event loop of s3async (default: boto)
+#   --retries retries     retry throttled or failed S3 requests this many times
+#                         (default: 8)
+#   --max-rate requests-per-sec
+#                         never send more than this many S3 requests per second,
+#                         summed over all jobs
+#   --stats               print request and pipeline statistics to stderr at
+#                         exit
+#   --stats-file stats-file
+#                         write request and pipeline statistics to this file at
+#                         exit
+#   --stats-format {prometheus,json}
+#                         format of the statistics file (default: prometheus)
+#
+# s3daemon runs listing, delete and restore jobs for its clients (see s3job)
+# in one long running process. The connections of finished jobs are kept in
+# a pool and handed to the next jobs, idle ones are kept alive, so that a job
+# starts without interpreter start-up, imports and TCP and TLS set up. All
+# jobs send their requests through the scheduler of the daemon and share its
+# retries and --max-rate request budget.
+#
+# Clients connect to the Unix domain socket of the daemon, which only its
+# user can access, and send one request as a line of JSON:
+#
+#   {"command": "lisov", "args": ["--after", "2020-01-01T00:00:00", "bucket"], "priority": 0, "stdin": false}
+#
+# command is one of the subcommands in S3_DAEMON_COMMANDS, args are its
+# command line arguments as for s3v. Jobs with a higher priority run first,
+# jobs of the same priority in the order of their arrival, at most --jobs at
+# a time. If stdin is true the client sends its standard input after the
+# request line, the job reads it as stdin (e.g. s3delov without --input).
+# The daemon answers with lines of JSON while the job runs:
+#
+#   {"job": 7, "queued": 2}         job 7 queued behind 2 other jobs
+#   {"job": 7, "started": true}
+#   {"stdout": "..."}               output of the job
+#   {"stderr": "..."}               messages of the job
+#   {"job": 7, "status": 0}         exit status of the job, the last line
+#   {"error": "..."}                the request has been refused
+#
+# The output and messages are byte strings decoded as latin-1, to be
+# encoded as latin-1 again by the client. {"command": "status"} is answered
+# with {"jobs": [...]}, the running and queued jobs.
+#
+# Files named in the job arguments are opened by the daemon, relative paths
+# are relative to its working directory. The options of the configuration
+# file, the backend, the scheduler and the statistics belong to the daemon
+# and are refused in jobs. Messages of worker threads started by a job reach its
+# client as long as it is the only running job, otherwise they go to the
+# stderr of the daemon.
+
+import sys
+import os
+import argparse
+import socket
+import threading
+import Queue
+import json
+import re
+import signal
+import time
+import traceback
+import s3version
+import s3stats
+import s3connect
+import s3scheduler
+import s3fanout
+
+# subcommands of s3v run as jobs
+S3_DAEMON_COMMANDS = [ "lisov", "lisdv", "listv", "scan", "delov", "retain", "restore" ]
+
+# options belonging to the daemon
+S3_DAEMON_REFUSED_OPTIONS = [ "-c", "--backend", "--retries", "--max-rate", "--stats", "--stats-file", "--stats-format" ]
+
+# bytes of output collected before they are sent to the client
+S3_DAEMON_CHUNK_SIZE = 64 * 1024
+
+# maximum length of a request line
+S3_DAEMON_MAX_REQUEST = 1024 ** 2
+
+# command line arguments
+
+def make_parser(prog=None):
+  parser = argparse.ArgumentParser(prog = prog, description = "run listing, delete and restore jobs of local clients with warm S3 connections")
+  parser.add_argument("-c", dest="s3_conf", metavar="s3-config-file", default=s3version.S3_CONF, help="use this S3 configuration file (default: %(default)s)")
+  parser.add_argument("--socket", metavar="socket-file", default=s3version.S3_SOCKET, help="accept jobs on this Unix domain socket (default: %(default)s)")
+  parser.add_argument("--jobs", metavar="jobs", type=int, default=4, help="run this many jobs at a time (default: %(default)s)")
+  parser.add_argument("--connections", metavar="connections", type=int, default=4, help="open this many S3 connections at start (default: %(default)s)")
+  parser.add_argument("--keep-alive", metavar="seconds", type=float, default=30.0, help="send a request on connections idle for this many seconds to keep them open (default: %(default)s)")
+  parser.add_argument("--backend", choices=s3connect.S3_BACKENDS, default="boto", help="send the S3 requests through boto's connections or the event loop of s3async (default: %(default)s)")
+  parser.add_argument("--retries", metavar="retries", type=int, default=s3scheduler.S3_SCHEDULER_RETRIES, help="retry throttled or failed S3 requests this many times (default: %(default)s)")
+  parser.add_argument("--max-rate", metavar="requests-per-sec", type=float, help="never send more than this many S3 requests per second, summed over all jobs")
+  parser.add_argument("--stats", action="store_true", help="print request and pipeline statistics to stderr at exit")
+  parser.add_argument("--stats-file", metavar="stats-file", help="write request and pipeline statistics to this file at exit")
+  parser.add_argument("--stats-format", choices=s3stats.S3_STATS_FORMATS, default="prometheus", help="format of the statistics file (default: %(default)s)")
+  return parser
+
+# the standard streams of a job, output is sent to the client in chunks, messages line by line
+
+class _JobOutput(object):
+
+  def __init__(self, job, kind, line_buffered):
+    self.job = job
+    self.kind = kind
+    self.line_buffered = line_buffered
+    self.lock = threading.Lock()
+    self.buffered = []
+    self.size = 0
+    self.softspace = 0
+
+  def write(self, data):
+    if isinstance(data, unicode):
+      data = data.encode("utf-8")
+    with self.lock:
+      self.buffered.append(data)
+      self.size += len(data)
+    if self.size >= S3_DAEMON_CHUNK_SIZE or (self.line_buffered and "\n" in data):
+      self.flush()
+
+  def writelines(self, lines):
+    for line in lines:
+      self.write(line)
+
+  def flush(self):
+    with self.lock:
+      data = "".join(self.buffered)
+      self.buffered = []
+      self.size = 0
+    if data:
+      self.job.send({ self.kind: data.decode("latin-1") })
+
+  def isatty(self):
+    return False
+
+class _Job(object):
+
+  def __init__(self, id, command, args, priority, connection, input):
+    self.id = id
+    self.command = command
+    self.args = args
+    self.priority = priority
+    self.connection = connection
+    self.lock = threading.Lock()
+    self.gone = False
+    self.stdin = input
+    self.stdout = _JobOutput(self, "stdout", False)
+    self.stderr = _JobOutput(self, "stderr", True)
+
+  # send message to the client, a client gone does not stop the job
+
+  def send(self, message):
+    with self.lock:
+      if self.gone:
+        return
+      try:
+        self.connection.sendall(json.dumps(message) + "\n")
+      except socket.error:
+        self.gone = True
+
+  def describe(self):
+    return { "job": self.id, "command": self.command, "args": self.args, "priority": self.priority }
+
+# jobs by the threads running them
+
+_running = {}
+_running_lock = threading.Lock()
+
+# job of the calling thread, the only running job for threads started by a job
+
+def _current_job():
+  job = _running.get(threading.current_thread().ident)
+  if job != None:
+    return job
+  with _running_lock:
+    jobs = set(_running.values())
+  if len(jobs) == 1:
+    return jobs.pop()
+  return None
+
+# stand-in for sys.stdin, sys.stdout or sys.stderr passing the calls on to the stream of the
+# job of the calling thread
+
+class _Stream(object):
+
+  def __init__(self, kind, default):
+    self.__dict__["kind"] = kind
+    self.__dict__["default"] = default
+
+  def _target(self):
+    job = _current_job()
+    if job == None:
+      return self.default
+    return getattr(job, self.kind)
+
+  def __getattr__(self, attr):
+    return getattr(self._target(), attr)
+
+  def __setattr__(self, attr, value):
+    setattr(self._target(), attr, value)
+
+  def __iter__(self):
+    return iter(self._target())
+
+# the option of S3_DAEMON_REFUSED_OPTIONS argument a stands for, None if none
+# long options may be abbreviated, short ones follow other flags like -v
+
+def _refused_option(a):
+  name = a.split("=")[0]
+  for option in S3_DAEMON_REFUSED_OPTIONS:
+    if option.startswith("--"):
+      if len(name) > 2 and option.startswith(name):
+        return option
+    elif re.match(r"^-v*%s" % option[1:], a):
+      return option
+  return None
+
+class Daemon(object):
+
+  # pool    s3connect.ConnectionPool the jobs take their connections from
+  # jobs    number of jobs run at a time
+  # log     file the daemon reports to
+
+  def __init__(self, pool, jobs, log):
+    self.pool = pool
+    self.log = log
+    self.queue = Queue.PriorityQueue()
+    self.queued = {}
+    self.lock = threading.Lock()
+    self.next_id = 1
+    self.workers = []
+    for i in range(jobs):
+      t = threading.Thread(target=self._work)
+      t.daemon = True
+      t.start()
+      self.workers.append(t)
+
+  # accept clients on server until interrupted
+
+  def serve(self, server):
+    while True:
+      connection, address = server.accept()
+      t = threading.Thread(target=self._handle, args=(connection,))
+      t.daemon = True
+      t.start()
+
+  # send a request on idle connections every interval seconds
+
+  def keep_alive(self, interval):
+    while True:
+      time.sleep(interval / 2)
+      self.pool.keep_alive(interval)
+
+  # read the request of a client and queue its job
+
+  def _handle(self, connection):
+    input = connection.makefile("rb")
+    try:
+      request = json.loads(input.readline(S3_DAEMON_MAX_REQUEST))
+      if not isinstance(request, dict):
+        raise ValueError("request is no JSON object")
+      command = request.get("command")
+      if command == "status":
+        with _running_lock:
+          running = [ j.describe() for j in _running.values() ]
+        with self.lock:
+          queued = [ j.describe() for j in sorted(self.queued.values(), key=lambda j: (-j.priority, j.id)) ]
+        connection.sendall(json.dumps({ "jobs": [ dict(j, state="running") for j in running ] + [ dict(j, state="queued") for j in queued ] }) + "\n")
+        connection.close()
+        return
+      args, priority = self._check(request)
+    except socket.error:
+      connection.close()
+      return
+    except ValueError as e:
+      try:
+        connection.sendall(json.dumps({ "error": str(e) }) + "\n")
+      except socket.error:
+        pass
+      connection.close()
+      return
+    if not request.get("stdin"):
+      input = open(os.devnull, "rb")
+    with self.lock:
+      job = _Job(self.next_id, command, args, priority, connection, input)
+      self.next_id += 1
+      ahead = len(self.queued)
+      self.queued[job.id] = job
+    print >> self.log, "job", job.id, "queued:", command, " ".join(args)
+    job.send({ "job": job.id, "queued": ahead })
+    self.queue.put((-priority, job.id, job))
+
+  # arguments and priority of request, raises ValueError if the job is refused
+
+  def _check(self, request):
+    command = request.get("command")
+    if command not in S3_DAEMON_COMMANDS:
+      raise ValueError("unknown command %r, jobs are one of %s" % (command, ", ".join(S3_DAEMON_COMMANDS)))
+    args = request.get("args", [])
+    if not isinstance(args, list) or not all([ isinstance(a, basestring) for a in args ]):
+      raise ValueError("args must be a list of strings")
+    args = [ a.encode("utf-8") if isinstance(a, unicode) else a for a in args ]
+    for a in args:
+      option = _refused_option(a)
+      if option != None:
+        raise ValueError("option %s belongs to the daemon" % option)
+    priority = request.get("priority", 0)
+    if not isinstance(priority, int):
+      raise ValueError("priority must be an integer")
+    return args, priority
+
+  def _work(self):
+    import s3v
+    while True:
+      priority, id, job = self.queue.get()
+      with self.lock:
+        del self.queued[job.id]
+      self._run(s3v, job)
+
+  def _run(self, s3v, job):
+    started = time.time()
+    lease = self.pool.lease()
+    with _running_lock:
+      _running[threading.current_thread().ident] = job
+    job.send({ "job": job.id, "started": True })
+    try:
+      status = s3v.run(job.command, job.args, lease)
+    except SystemExit as e:
+      status = e.code
+    except Exception:
+      traceback.print_exc()
+      status = 1
+    if status != None and not isinstance(status, int):
+      print >> sys.stderr, status
+      status = 1
+    status = status or 0
+    job.stdout.flush()
+    job.stderr.flush()
+    with _running_lock:
+      del _running[threading.current_thread().ident]
+    lease.release()
+    job.send({ "job": job.id, "status": status })
+    try:
+      job.connection.close()
+    except socket.error:
+      pass
+    print >> self.log, "job", job.id, "finished with exit status", status, "after %.3f s" % (time.time() - started)
+
+# run the daemon as asked for by the command line arguments argv (default: sys.argv)
+# connect opens the S3 connections instead of the S3 configuration file
+# returns the exit status once the daemon has been stopped
+
+def main(argv=None, connect=None, prog=None):
+  parser = make_parser(prog)
+  args = parser.parse_args(argv)
+
+  # record request and pipeline statistics of all jobs if asked for, they are reported at exit
+
+  s3stats.setup("s3daemon", args.stats, args.stats_file, args.stats_format)
+
+  # all jobs share the retries and the request budget of the daemon
+
+  if args.retries < 0:
+    parser.error("number of retries must not be negative")
+  if args.max_rate != None and args.max_rate <= 0:
+    parser.error("maximum request rate must be positive")
+  s3scheduler.fix(args.retries, args.max_rate)
+
+  s3_conf = args.s3_conf
+  socket_file = args.socket
+  jobs = args.jobs
+  connections = args.connections
+  keep_alive = args.keep_alive
+
+  if jobs < 1:
+    parser.error("number of jobs must be at least 1")
+  if connections < 0:
+    parser.error("number of connections must not be negative")
+  if keep_alive <= 0:
+    parser.error("keep alive interval must be positive")
+
+  # make sure no other daemon serves the socket, a socket file left behind is removed
+
+  if os.path.exists(socket_file):
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      probe.connect(socket_file)
+      parser.error("another daemon is serving %s" % socket_file)
+    except socket.error:
+      os.remove(socket_file)
+    finally:
+      probe.close()
+
+  # parse config file and establish the pool of S3 connections, unless the caller hands over
+  # its own connect function
+
+  if connect == None:
+    connect = s3connect.connector(s3connect.read_config(s3_conf), args.backend)
+  pool = s3connect.ConnectionPool(connect)
+  pool.warm_up(connections)
+
+  # the jobs run in threads, they must not fork and their standard streams are routed to
+  # their clients
+
+  s3fanout.in_process = True
+  log = sys.stderr
+  sys.stdin = _Stream("stdin", sys.stdin)
+  sys.stdout = _Stream("stdout", sys.stdout)
+  sys.stderr = _Stream("stderr", sys.stderr)
+
+  # accept jobs until terminated
+
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  umask = os.umask(0177)
+  try:
+    server.bind(socket_file)
+  finally:
+    os.umask(umask)
+  server.listen(64)
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+  daemon = Daemon(pool, jobs, log)
+  t = threading.Thread(target=daemon.keep_alive, args=(keep_alive,))
+  t.daemon = True
+  t.start()
+  print >> log, "serving", socket_file, "with", jobs, "jobs at a time and", connections, "connections"
+  try:
+    daemon.serve(server)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.close()
+    os.remove(socket_file)
+    print >> log, "stopped,", len(_running), "running and", len(daemon.queued), "queued jobs abandoned,", pool.opened, "connections opened,", pool.reused, "reused"
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
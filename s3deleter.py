@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+
+# s3deleter
+#
+# by Walter Graf
+#
+# batched deletion of object versions
+#
+# object versions are collected and sent as multi-object delete requests
+# (S3 DeleteObjects API) of up to 1000 versions each. The per version result
+# is parsed and failed versions are reported through a callback.
+# If the S3 gateway does not support the bulk call the deleter falls back to
+# single deletes for the rest of the run, other errors fail the batch only.
+#
+# ParallelDeleter spreads the batches over a pool of worker threads, each
+# owning its own S3 connection. A bounded queue between the caller and the
+# workers keeps memory flat for arbitrarily long inputs.
+#
+# On the async backend (s3async) AsyncDeleter sends the requests from the
+# event loop instead and keeps a window of them in flight, without threads.
+# Its results are handled in the caller's thread like VersionDeleter's.
+# deleter() picks the deleter fitting the backend and number of workers.
+
+import sys
+import base64
+import hashlib
+import urllib
+import threading
+import Queue
+import collections
+import xml.etree.cElementTree as ElementTree
+from xml.sax.saxutils import escape
+import s3async
+
+# maximum number of versions the S3 API accepts in a single multi-object delete
+S3_MAX_DELETE_BATCH = 1000
+
+def _utf8(s):
+  if isinstance(s, unicode):
+    return s.encode("utf-8")
+  return s
+
+# statuses of a multi-object delete telling that the endpoint does not support the call,
+# a 400 only with the error code NotImplemented; any other error fails the batch only
+
+S3_BULK_UNSUPPORTED_STATUS = (405, 501)
+
+def _bulk_unsupported(status, code):
+  return status in S3_BULK_UNSUPPORTED_STATUS or (status == 400 and code == "NotImplemented")
+
+class VersionDeleter(object):
+
+  # bucket       bucket the versions are deleted from
+  # batch_size   number of versions per multi-object delete (1 means single deletes)
+  # on_failure   called as on_failure(name, version_id, code, message, row) for each failed version
+  # on_deleted   called as on_deleted(versions) with the (name, version_id, row) tuples deleted by a request
+
+  def __init__(self, bucket, batch_size=S3_MAX_DELETE_BATCH, on_failure=None, on_deleted=None):
+    if batch_size < 1 or batch_size > S3_MAX_DELETE_BATCH:
+      raise ValueError("batch size must be between 1 and %d" % S3_MAX_DELETE_BATCH)
+    self.bucket = bucket
+    self.batch_size = batch_size
+    self.on_failure = on_failure
+    self.on_deleted = on_deleted
+    self.bulk = batch_size > 1
+    self.pending = []
+    self.deleted = 0
+    self.failed = 0
+    self.requests = 0
+    self.errors = {}
+
+  # queue a version for deletion, row is handed back to on_failure untouched
+
+  def add(self, name, version_id, row=None):
+    self.pending.append((name, version_id, row))
+    if len(self.pending) >= self.batch_size:
+      self.flush()
+
+  # delete all queued versions
+
+  def flush(self):
+    import boto.exception
+    batch = self.pending
+    self.pending = []
+    if not batch:
+      return
+    if self.bulk:
+      try:
+        self._delete_bulk(batch)
+        return
+      except boto.exception.S3ResponseError as e:
+        if not _bulk_unsupported(e.status, e.error_code):
+          for name, version_id, row in batch:
+            self._fail(name, version_id, e.error_code or str(e.status), e.message or e.reason, row)
+          return
+        print >> sys.stderr, "multi-object delete rejected (", e.status, e.error_code, ") - falling back to single deletes"
+        self.bulk = False
+      except Exception as e:
+        # connection level problem, the outcome of the whole batch is unknown
+        for name, version_id, row in batch:
+          self._fail(name, version_id, e.__class__.__name__, str(e), row)
+        return
+    for name, version_id, row in batch:
+      self._delete_single(name, version_id, row)
+
+  def close(self):
+    self.flush()
+
+  def _delete_bulk(self, batch):
+    self.requests += 1
+    result = self.bucket.delete_keys([(name, version_id) for name, version_id, row in batch], quiet=True)
+    self._bulk_deleted(batch, [ (e.key, e.version_id, e.code, e.message) for e in result.errors ])
+
+  # account for a multi-object delete of batch, errors are the (name, version_id, code, message)
+  # of the versions not deleted
+
+  # the names are matched as utf-8, the parsed response has them as unicode
+
+  def _bulk_deleted(self, batch, errors):
+    rows = {}
+    for name, version_id, row in batch:
+      rows[(_utf8(name), _utf8(version_id))] = (name, row)
+    self.deleted += len(batch) - len(errors)
+    for name, version_id, code, message in errors:
+      name, row = rows.pop((_utf8(name), _utf8(version_id)), (name, None))
+      self._fail(name, version_id, code, message, row)
+    if self.on_deleted is not None:
+      if errors:
+        batch = [ (name, version_id, row) for name, version_id, row in batch if (_utf8(name), _utf8(version_id)) in rows ]
+      self.on_deleted(batch)
+
+  def _delete_single(self, name, version_id, row):
+    import boto.exception
+    self.requests += 1
+    try:
+      self.bucket.delete_key(name, version_id = version_id)
+    except boto.exception.S3ResponseError as e:
+      self._fail(name, version_id, e.error_code or str(e.status), e.message or e.reason, row)
+      return
+    except Exception as e:
+      self._fail(name, version_id, e.__class__.__name__, str(e), row)
+      return
+    self._single_deleted(name, version_id, row)
+
+  def _single_deleted(self, name, version_id, row):
+    self.deleted += 1
+    if self.on_deleted is not None:
+      self.on_deleted([ (name, version_id, row) ])
+
+  def _fail(self, name, version_id, code, message, row):
+    self.failed += 1
+    self.errors[code] = self.errors.get(code, 0) + 1
+    if self.on_failure is not None:
+      self.on_failure(name, version_id, code, message, row)
+
+class AsyncDeleter(VersionDeleter):
+
+  # bucket       bucket on the async backend the versions are deleted from
+  # batch_size   number of versions per multi-object delete (1 means single deletes)
+  # on_failure   see VersionDeleter
+  # on_deleted   see VersionDeleter
+  # window       number of requests kept in flight, add() blocks while as many are outstanding
+
+  def __init__(self, bucket, batch_size=S3_MAX_DELETE_BATCH, on_failure=None, on_deleted=None, window=s3async.S3_ASYNC_WINDOW):
+    VersionDeleter.__init__(self, bucket, batch_size, on_failure, on_deleted)
+    self.client = s3async.client_of(bucket)
+    self.window = window
+    self.in_flight = collections.deque()
+
+  # queue a version for deletion, the batch is sent once it is full
+
+  def add(self, name, version_id, row=None):
+    self.pending.append((name, version_id, row))
+    if len(self.pending) >= self.batch_size:
+      self._send()
+
+  # delete all queued versions and wait for the outstanding requests
+
+  def flush(self):
+    self._send()
+    while self.in_flight:
+      self._complete()
+
+  def _send(self):
+    batch = self.pending
+    self.pending = []
+    if not batch:
+      return
+    if self.bulk:
+      self._send_bulk(batch)
+    else:
+      for name, version_id, row in batch:
+        self._send_single(name, version_id, row)
+    while len(self.in_flight) > self.window:
+      self._complete()
+
+  def _send_bulk(self, batch):
+    document = '<?xml version="1.0" encoding="UTF-8"?><Delete><Quiet>true</Quiet>'
+    for name, version_id, row in batch:
+      document += "<Object><Key>%s</Key>" % escape(_utf8(name))
+      if version_id != None:
+        document += "<VersionId>%s</VersionId>" % escape(_utf8(version_id))
+      document += "</Object>"
+    document += "</Delete>"
+    headers = { "Content-MD5": base64.b64encode(hashlib.md5(document).digest()), "Content-Type": "text/xml" }
+    self.requests += 1
+    self.in_flight.append((batch, self.client.submit("POST", self.bucket.name, headers=headers, body=document, query_args="delete")))
+
+  # a version id of None deletes the object itself, which places a delete marker on a versioned bucket
+
+  def _send_single(self, name, version_id, row):
+    query_args = None
+    if version_id != None:
+      query_args = "versionId=" + urllib.quote(_utf8(version_id), safe="")
+    self.requests += 1
+    self.in_flight.append(([ (name, version_id, row) ], self.client.submit("DELETE", self.bucket.name, name, query_args=query_args)))
+
+  # handle the response of the oldest outstanding request
+
+  def _complete(self):
+    batch, request = self.in_flight.popleft()
+    try:
+      response = request.wait()
+    except Exception as e:
+      # connection level problem, the outcome of the whole batch is unknown
+      for name, version_id, row in batch:
+        self._fail(name, version_id, e.__class__.__name__, str(e), row)
+      return
+    if request.method == "DELETE":
+      name, version_id, row = batch[0]
+      if response.status in (200, 204):
+        self._single_deleted(name, version_id, row)
+      else:
+        code, message = s3async.error(response)
+        self._fail(name, version_id, code, message, row)
+      return
+    if response.status != 200:
+      code, message = s3async.error(response)
+      if not _bulk_unsupported(response.status, code):
+        for name, version_id, row in batch:
+          self._fail(name, version_id, code, message, row)
+        return
+      if self.bulk:
+        print >> sys.stderr, "multi-object delete rejected (", response.status, code, ") - falling back to single deletes"
+        self.bulk = False
+      for name, version_id, row in batch:
+        self._send_single(name, version_id, row)
+      return
+    errors = []
+    for e in ElementTree.fromstring(response.body):
+      if e.tag.endswith("Error"):
+        fields = dict([ (f.tag[f.tag.find("}") + 1:], f.text) for f in e ])
+        errors.append((fields.get("Key"), fields.get("VersionId"), fields.get("Code"), fields.get("Message")))
+    self._bulk_deleted(batch, errors)
+
+class ParallelDeleter(object):
+
+  # open_bucket  called once per worker, must return a bucket on a connection of its own
+  # workers      number of worker threads
+  # batch_size   number of versions per multi-object delete (1 means single deletes)
+  # on_failure   see VersionDeleter, calls are serialized
+  # on_deleted   see VersionDeleter, calls are serialized
+  # queue_size   maximum number of batches waiting for a worker (default: 2 per worker)
+
+  def __init__(self, open_bucket, workers, batch_size=S3_MAX_DELETE_BATCH, on_failure=None, on_deleted=None, queue_size=None):
+    if workers < 1:
+      raise ValueError("number of workers must be at least 1")
+    self.batch_size = batch_size
+    self.on_failure = on_failure
+    self.on_deleted = on_deleted
+    self.lock = threading.Lock()
+    self.queue = Queue.Queue(queue_size or 2 * workers)
+    self.pending = []
+    self.deleted = 0
+    self.failed = 0
+    self.requests = 0
+    self.errors = {}
+    self.error = None
+
+    # connections are opened up front so that connection problems surface in the caller
+
+    self.deleters = [ VersionDeleter(open_bucket(), batch_size, self._report, self._done) for i in range(workers) ]
+    self.threads = []
+    for d in self.deleters:
+      t = threading.Thread(target=self._work, args=(d,))
+      t.daemon = True
+      t.start()
+      self.threads.append(t)
+
+  # queue a version for deletion, blocks while all workers are busy and the queue is full
+
+  def add(self, name, version_id, row=None):
+    self.pending.append((name, version_id, row))
+    if len(self.pending) >= self.batch_size:
+      self.queue.put(self.pending)
+      self.pending = []
+
+  # wait until all versions queued so far have been deleted and collect the worker statistics
+
+  def flush(self):
+    if self.pending:
+      self.queue.put(self.pending)
+      self.pending = []
+    self.queue.join()
+    self._collect()
+    self._check()
+
+  # wait for all queued versions to be deleted and collect the worker statistics
+
+  def close(self):
+    if self.pending:
+      self.queue.put(self.pending)
+      self.pending = []
+    for t in self.threads:
+      self.queue.put(None)
+    for t in self.threads:
+      t.join()
+    self._collect()
+    self._check()
+
+  def _collect(self):
+    self.deleted = sum([ d.deleted for d in self.deleters ])
+    self.failed = sum([ d.failed for d in self.deleters ])
+    self.requests = sum([ d.requests for d in self.deleters ])
+    self.errors = {}
+    for d in self.deleters:
+      for code, count in d.errors.items():
+        self.errors[code] = self.errors.get(code, 0) + count
+
+  # an error of a worker is raised in the caller
+
+  def _check(self):
+    if self.error != None:
+      raise self.error[0], self.error[1], self.error[2]
+
+  # after an error the queue is still drained so that add() never blocks forever
+
+  def _work(self, deleter):
+    while True:
+      batch = self.queue.get()
+      try:
+        if batch is not None and self.error == None:
+          for name, version_id, row in batch:
+            deleter.add(name, version_id, row)
+          deleter.flush()
+      except Exception:
+        self.error = sys.exc_info()
+      finally:
+        self.queue.task_done()
+      if batch is None:
+        break
+
+  def _report(self, name, version_id, code, message, row):
+    if self.on_failure is not None:
+      with self.lock:
+        self.on_failure(name, version_id, code, message, row)
+
+  def _done(self, versions):
+    if self.on_deleted is not None:
+      with self.lock:
+        self.on_deleted(versions)
+
+# the deleter for the versions of the bucket returned by open_bucket
+# an AsyncDeleter on the async backend, else a ParallelDeleter with workers threads or a
+# VersionDeleter if workers is 1
+
+def deleter(open_bucket, workers, batch_size=S3_MAX_DELETE_BATCH, on_failure=None, on_deleted=None):
+  bucket = open_bucket()
+  if s3async.client_of(bucket) != None:
+    return AsyncDeleter(bucket, batch_size, on_failure, on_deleted)
+  if workers > 1:
+
+    # the bucket opened to detect the backend becomes the connection of the first worker
+
+    opened = [ bucket ]
+    def reuse_bucket():
+      if opened:
+        return opened.pop()
+      return open_bucket()
+    return ParallelDeleter(reuse_bucket, workers, batch_size, on_failure, on_deleted)
+  return VersionDeleter(bucket, batch_size, on_failure, on_deleted)
@@ -6,80 +6,201 @@
 # by Walter Graf
 #
 # usage: s3delov.py [-h] [-c s3-config-file] [--input csv-file-input]
+#                   [--batch-size batch-size] [--failed csv-file-output]
+#                   [--workers workers] [--journal journal-file] [--verbose]
+#                   [--backend {boto,async}] [--retries retries]
+#                   [--max-rate requests-per-sec] [--stats]
+#                   [--stats-file stats-file] [--stats-format {prometheus,json}]
 #                   bucket-name
-# 
-# delete object versions according to a csv file
-# 
+#
+# delete object versions according to a csv file or binary version list
+#
 # positional arguments:
 #   bucket-name           bucket hosting the to be deleted versioned objects
-# 
+#
 # optional arguments:
 #   -h, --help            show this help message and exit
 #   -c s3-config-file     use this S3 configuration file (default:
 #                         $HOME/s3versioning.cnf)
 #   --input csv-file-input, -i csv-file-input
-#                         read csv input from this file (default: stdin)
-
+#                         read csv or binary input from this file (default:
+#                         stdin)
+#   --batch-size batch-size
+#                         number of versions per multi-object delete request, 1
+#                         disables multi-object deletes (default: 1000)
+#   --failed csv-file-output
+#                         write csv rows of versions that failed to delete to
+#                         this file
+#   --workers workers     delete versions with this many parallel workers, each
+#                         using its own S3 connection (default: 1)
+#   --journal journal-file
+#                         record completed deletes in this journal and skip
+#                         versions already recorded in it
+#   --verbose, -v         log every version to stderr before deleting it
+#   --backend {boto,async}
+#                         send the S3 requests through boto's connections or the
+#                         event loop of s3async (default: boto)
+#   --retries retries     retry throttled or failed S3 requests this many times
+#                         (default: 8)
+#   --max-rate requests-per-sec
+#                         never send more than this many S3 requests per second
+#   --stats               print request and pipeline statistics to stderr at
+#                         exit
+#   --stats-file stats-file
+#                         write request and pipeline statistics to this file at
+#                         exit
+#   --stats-format {prometheus,json}
+#                         format of the statistics file (default: prometheus)
 
 import sys
 import os
 import argparse
-import ConfigParser
 import time
-import boto
-import boto.s3.connection
 import csv
 import s3version
-
-# parse command line arguments
-
-parser = argparse.ArgumentParser(description = "delete object versions according to a csv file")
-parser.add_argument("bucket", metavar="bucket-name", help="bucket hosting the to be deleted versioned objects")
-parser.add_argument("-c", dest="s3_conf", metavar="s3-config-file", default=s3version.S3_CONF, help="use this S3 configuration file (default: %(default)s)")
-parser.add_argument("--input", "-i", metavar="csv-file-input", type=argparse.FileType("rb"), default=sys.stdin, help="read csv input from this file (default: stdin)")
-args = parser.parse_args()
-
-s3_conf = args.s3_conf
-bucket_name = args.bucket
-input = args.input
-
-# parse config file
-
-cnf = ConfigParser.RawConfigParser()
-cnf.read(s3_conf)
-
-access = cnf.get("connect", "access")
-secret = cnf.get("connect", "secret")
-host = cnf.get("connect", "host")
-port = cnf.getint("connect", "port")
-is_secure = cnf.getboolean("connect", "is_secure")
-
-# establish S3 connection
-
-s3 = boto.connect_s3(
-  aws_access_key_id = access,
-  aws_secret_access_key = secret,
-  host = host,
-  port = port,
-  is_secure = is_secure,
-  calling_format = boto.s3.connection.OrdinaryCallingFormat()
-  )
-
-# prepare csv input
-
-csv_reader = csv.DictReader(input, delimiter=",", quotechar='"')
-
-# delete object versions in bucket according to csv file
-
-bucket = s3.get_bucket(bucket_name)
-
-# loop over all csv file rows
-# check bucket name and skip in case bucket name doesn't match
-# delete versioned objects
-
-for c in csv_reader:
-  if c["bucket"] != bucket_name:
-    print >> sys.stderr, "bucket name mismatch:", c["bucket"], "!=", bucket_name, "- skipping delete"
-    continue
-  print >> sys.stderr, "deleting", c["object"], c["version_id"]
-  bucket.delete_key(c["object"], version_id = c["version_id"])
+import s3stats
+import s3connect
+import s3scheduler
+import s3log
+import s3format
+import s3deleter
+import s3journal
+
+# command line arguments
+
+def make_parser(prog=None):
+  parser = argparse.ArgumentParser(prog = prog, description = "delete object versions according to a csv file or binary version list")
+  parser.add_argument("bucket", metavar="bucket-name", help="bucket hosting the to be deleted versioned objects")
+  parser.add_argument("-c", dest="s3_conf", metavar="s3-config-file", default=s3version.S3_CONF, help="use this S3 configuration file (default: %(default)s)")
+  parser.add_argument("--input", "-i", metavar="csv-file-input", type=argparse.FileType("rb"), default=sys.stdin, help="read csv or binary input from this file (default: stdin)")
+  parser.add_argument("--batch-size", metavar="batch-size", type=int, default=s3deleter.S3_MAX_DELETE_BATCH, help="number of versions per multi-object delete request, 1 disables multi-object deletes (default: %(default)s)")
+  parser.add_argument("--failed", metavar="csv-file-output", type=argparse.FileType("wb"), help="write csv rows of versions that failed to delete to this file")
+  parser.add_argument("--workers", metavar="workers", type=int, default=1, help="delete versions with this many parallel workers, each using its own S3 connection (default: %(default)s)")
+  parser.add_argument("--journal", metavar="journal-file", help="record completed deletes in this journal and skip versions already recorded in it")
+  parser.add_argument("--verbose", "-v", action="store_true", help="log every version to stderr before deleting it")
+  parser.add_argument("--backend", choices=s3connect.S3_BACKENDS, default="boto", help="send the S3 requests through boto's connections or the event loop of s3async (default: %(default)s)")
+  parser.add_argument("--retries", metavar="retries", type=int, default=s3scheduler.S3_SCHEDULER_RETRIES, help="retry throttled or failed S3 requests this many times (default: %(default)s)")
+  parser.add_argument("--max-rate", metavar="requests-per-sec", type=float, help="never send more than this many S3 requests per second")
+  parser.add_argument("--stats", action="store_true", help="print request and pipeline statistics to stderr at exit")
+  parser.add_argument("--stats-file", metavar="stats-file", help="write request and pipeline statistics to this file at exit")
+  parser.add_argument("--stats-format", choices=s3stats.S3_STATS_FORMATS, default="prometheus", help="format of the statistics file (default: %(default)s)")
+  return parser
+
+# delete the object versions of a csv file or binary version list as asked for by the command
+# line arguments argv (default: sys.argv), connect opens the S3 connections instead of the
+# S3 configuration file, returns the exit status, 1 if any version failed to delete
+
+def main(argv=None, connect=None, prog=None):
+  parser = make_parser(prog)
+  args = parser.parse_args(argv)
+
+  # record request and pipeline statistics if asked for, they are reported at exit
+
+  s3stats.setup("s3delov", args.stats, args.stats_file, args.stats_format)
+
+  # retry failed requests and adapt the number of requests in flight to the endpoint
+
+  if args.retries < 0:
+    parser.error("number of retries must not be negative")
+  if args.max_rate != None and args.max_rate <= 0:
+    parser.error("maximum request rate must be positive")
+  s3scheduler.setup(args.retries, args.max_rate)
+
+  s3_conf = args.s3_conf
+  bucket_name = args.bucket
+  input = args.input
+  batch_size = args.batch_size
+  failed = args.failed
+  workers = args.workers
+  journal_file = args.journal
+
+  if batch_size < 1 or batch_size > s3deleter.S3_MAX_DELETE_BATCH:
+    parser.error("batch size must be between 1 and %d" % s3deleter.S3_MAX_DELETE_BATCH)
+  if workers < 1:
+    parser.error("number of workers must be at least 1")
+
+  # parse config file and establish S3 connections, unless the caller hands over its own
+  # parallel delete workers each establish a connection of their own
+
+  if connect == None:
+    connect = s3connect.connector(s3connect.read_config(s3_conf), args.backend)
+
+  s3 = connect()
+
+  # prepare input, csv or binary
+
+  csv_reader = s3format.read_rows(input)
+
+  # prepare csv output of failed versions
+
+  if failed != None:
+    failed_writer = csv.DictWriter(failed, s3version.S3_CSV_KEYS, delimiter=",", quotechar='"', extrasaction="ignore")
+    failed_dict = {}
+    for k in s3version.S3_CSV_KEYS:
+      failed_dict[k] = k
+    failed_writer.writerow(failed_dict)
+
+  def report_failure(name, version_id, code, message, row):
+    print >> sys.stderr, "failed to delete", name, version_id, ":", code, message
+    if failed != None:
+      if row == None:
+        row = { "bucket": bucket_name, "object": name, "version_id": version_id }
+      failed_writer.writerow(row)
+
+  # open the journal of completed deletes
+
+  journal = None
+  if journal_file != None:
+    journal = s3journal.DeleteJournal(journal_file)
+    print >> sys.stderr, "journal", journal_file, "holds", journal.loaded, "completed deletes"
+
+  def record_deleted(versions):
+    journal.record(bucket_name, versions)
+
+  # delete object versions in bucket according to csv file
+
+  bucket = s3.get_bucket(bucket_name)
+
+  # loop over all csv file rows
+  # check bucket name and skip in case bucket name doesn't match
+  # skip versions the journal knows to be deleted already
+  # delete versioned objects in batches of batch_size versions, spread over workers
+
+  on_deleted = record_deleted if journal != None else None
+  deleter = s3deleter.deleter(lambda: connect().get_bucket(bucket_name, validate=False), workers, batch_size, report_failure, on_deleted)
+
+  log = None
+  if args.verbose:
+    log = s3log.VersionLog()
+  delete = s3stats.timed_call(deleter.add, "delete")
+
+  skipped = 0
+  for c in s3stats.timed(csv_reader, "read", "read"):
+    if c["bucket"] != bucket_name:
+      print >> sys.stderr, "bucket name mismatch:", c["bucket"], "!=", bucket_name, "- skipping delete"
+      continue
+    if journal != None and journal.done(bucket_name, c["object"], c["version_id"]):
+      skipped += 1
+      continue
+    if log != None:
+      log.write("deleting", c["object"], c["version_id"])
+    delete(c["object"], c["version_id"], c)
+
+  s3stats.timed_call(deleter.close, "delete")()
+  if log != None:
+    log.close()
+  s3stats.stats.count("deleted", deleter.deleted)
+  s3stats.stats.count("failed", deleter.failed)
+  if journal != None:
+    journal.close()
+    print >> sys.stderr, "skipped", skipped, "versions deleted by a previous run"
+
+  print >> sys.stderr, "deleted", deleter.deleted, "versions,", deleter.failed, "failed,", deleter.requests, "delete requests"
+  for code, count in sorted(deleter.errors.items()):
+    print >> sys.stderr, "  ", count, "x", code
+  if deleter.failed > 0:
+    return 1
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
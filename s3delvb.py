@@ -6,7 +6,12 @@
 # by Walter Graf
 #
 # usage: s3delvb.py [-h] [-c s3-config-file] [--yes-i-really-really-mean-it]
-#                  bucket-name
+#                   [--batch-size batch-size] [--workers workers]
+#                   [--checkpoint checkpoint-file] [--resume] [--verbose]
+#                   [--backend {boto,async}] [--retries retries]
+#                   [--max-rate requests-per-sec] [--stats]
+#                   [--stats-file stats-file] [--stats-format {prometheus,json}]
+#                   bucket-name
 #
 # delete versioned bucket including its versioned objects
 #
@@ -19,77 +24,187 @@
 #                         $HOME/s3versioning.cnf)
 #   --yes-i-really-really-mean-it
 #                         specify this option to enforce delete
+#   --batch-size batch-size
+#                         number of versions per multi-object delete request, 1
+#                         disables multi-object deletes (default: 1000)
+#   --workers workers     delete versions with this many parallel workers, each
+#                         using its own S3 connection (default: 1)
+#   --checkpoint checkpoint-file
+#                         regularly record the removal progress in this file
+#   --resume              resume the removal recorded in the checkpoint file
+#   --verbose, -v         log every version to stderr before removing it
+#   --backend {boto,async}
+#                         send the S3 requests through boto's connections or the
+#                         event loop of s3async (default: boto)
+#   --retries retries     retry throttled or failed S3 requests this many times
+#                         (default: 8)
+#   --max-rate requests-per-sec
+#                         never send more than this many S3 requests per second
+#   --stats               print request and pipeline statistics to stderr at
+#                         exit
+#   --stats-file stats-file
+#                         write request and pipeline statistics to this file at
+#                         exit
+#   --stats-format {prometheus,json}
+#                         format of the statistics file (default: prometheus)
 
 import sys
 import os
 import argparse
-import ConfigParser
-import boto
-import boto.s3.connection
 import s3version
+import s3stats
+import s3connect
+import s3scheduler
+import s3log
+import s3deleter
+import s3lister
+import s3checkpoint
+
+# command line arguments
+
+def make_parser(prog=None):
+  parser = argparse.ArgumentParser(prog = prog, description = "delete versioned bucket including its versioned objects")
+  parser.add_argument("bucket", metavar="bucket-name", help="name of bucket to be deleted")
+  parser.add_argument("-c", dest="s3_conf", metavar="s3-config-file", default=s3version.S3_CONF, help="use this S3 configuration file (default: %(default)s)")
+  parser.add_argument("--yes-i-really-really-mean-it", dest="enforce", action="store_true", help="specify this option to enforce delete")
+  parser.add_argument("--batch-size", metavar="batch-size", type=int, default=s3deleter.S3_MAX_DELETE_BATCH, help="number of versions per multi-object delete request, 1 disables multi-object deletes (default: %(default)s)")
+  parser.add_argument("--workers", metavar="workers", type=int, default=1, help="delete versions with this many parallel workers, each using its own S3 connection (default: %(default)s)")
+  parser.add_argument("--checkpoint", metavar="checkpoint-file", help="regularly record the removal progress in this file")
+  parser.add_argument("--resume", action="store_true", help="resume the removal recorded in the checkpoint file")
+  parser.add_argument("--verbose", "-v", action="store_true", help="log every version to stderr before removing it")
+  parser.add_argument("--backend", choices=s3connect.S3_BACKENDS, default="boto", help="send the S3 requests through boto's connections or the event loop of s3async (default: %(default)s)")
+  parser.add_argument("--retries", metavar="retries", type=int, default=s3scheduler.S3_SCHEDULER_RETRIES, help="retry throttled or failed S3 requests this many times (default: %(default)s)")
+  parser.add_argument("--max-rate", metavar="requests-per-sec", type=float, help="never send more than this many S3 requests per second")
+  parser.add_argument("--stats", action="store_true", help="print request and pipeline statistics to stderr at exit")
+  parser.add_argument("--stats-file", metavar="stats-file", help="write request and pipeline statistics to this file at exit")
+  parser.add_argument("--stats-format", choices=s3stats.S3_STATS_FORMATS, default="prometheus", help="format of the statistics file (default: %(default)s)")
+  return parser
+
+# remove a versioned bucket including all its versions as asked for by the command line
+# arguments argv (default: sys.argv), connect opens the S3 connections instead of the S3
+# configuration file, returns the exit status
+
+def main(argv=None, connect=None, prog=None):
+  parser = make_parser(prog)
+  args = parser.parse_args(argv)
+
+  # record request and pipeline statistics if asked for, they are reported at exit
+
+  s3stats.setup("s3delvb", args.stats, args.stats_file, args.stats_format)
+
+  # retry failed requests and adapt the number of requests in flight to the endpoint
+
+  if args.retries < 0:
+    parser.error("number of retries must not be negative")
+  if args.max_rate != None and args.max_rate <= 0:
+    parser.error("maximum request rate must be positive")
+  s3scheduler.setup(args.retries, args.max_rate)
+
+  s3_conf = args.s3_conf
+  bucket_name = args.bucket
+  enforce = args.enforce
+  batch_size = args.batch_size
+  workers = args.workers
+  checkpoint_file = args.checkpoint
+  resume = args.resume
+
+  if batch_size < 1 or batch_size > s3deleter.S3_MAX_DELETE_BATCH:
+    parser.error("batch size must be between 1 and %d" % s3deleter.S3_MAX_DELETE_BATCH)
+  if workers < 1:
+    parser.error("number of workers must be at least 1")
+  if resume and checkpoint_file == None:
+    parser.error("--resume requires --checkpoint")
+
+  # check if delete operation is really enforced
+
+  if not enforce:
+    print >> sys.stderr, 'please specify option "--yes-i-really-really-mean-it" to delete the bucket including all its versioned objects'
+    return 0
+
+  # load the checkpoint to resume from
+
+  checkpoint = None
+  resumed = None
+  if checkpoint_file != None:
+    checkpoint = s3checkpoint.Checkpoint(checkpoint_file)
+    if resume:
+      resumed = checkpoint.load()
+      if resumed == None:
+        parser.error("no checkpoint found in %s" % checkpoint_file)
+      if resumed["bucket"] != bucket_name:
+        parser.error("checkpoint %s belongs to a different bucket" % checkpoint_file)
+      print >> sys.stderr, "resuming after", resumed["key_marker"], resumed["version_id_marker"]
+
+  # parse config file and establish S3 connections, unless the caller hands over its own
+  # parallel delete workers each establish a connection of their own
+
+  if connect == None:
+    connect = s3connect.connector(s3connect.read_config(s3_conf), args.backend)
+
+  s3 = connect()
+
+  # delete versioned bucket
+
+  bucket = s3.get_bucket(bucket_name)
+
+  # first remove all versioned objects
+  # s3lister takes care of pagination because get_all_versions() can only handle 1000 versions at a time
+  # versions are deleted in batches of batch_size versions, spread over workers
+
+  print >> sys.stderr, "removing all versioned objects in bucket", bucket_name, ":"
+
+  def report_failure(name, version_id, code, message, row):
+    print >> sys.stderr, "failed to remove", name, version_id, ":", code, message
+
+  deleter = s3deleter.deleter(lambda: connect().get_bucket(bucket_name, validate=False), workers, batch_size, report_failure)
+
+  # record the removal progress after each completed page, once the checkpoint is due
+  # all versions handed to the deleter are removed before the checkpoint is written
+
+  failed_before = 0
+  if resumed != None:
+    failed_before = resumed["failed"]
+
+  def save_checkpoint(marker):
+    if checkpoint.due():
+      deleter.flush()
+      checkpoint.save({ "bucket": bucket_name, "key_marker": marker[0], "version_id_marker": marker[1], "failed": failed_before + deleter.failed })
+
+  if resumed != None:
+    start = (resumed["key_marker"], resumed["version_id_marker"])
+  else:
+    start = None
 
-# parse command line arguments
+  log = None
+  if args.verbose:
+    log = s3log.VersionLog()
+  delete = s3stats.timed_call(deleter.add, "delete")
 
-parser = argparse.ArgumentParser(description = "delete versioned bucket including its versioned objects")
-parser.add_argument("bucket", metavar="bucket-name", help="name of bucket to be deleted")
-parser.add_argument("-c", dest="s3_conf", metavar="s3-config-file", default=s3version.S3_CONF, help="use this S3 configuration file (default: %(default)s)")
-parser.add_argument("--yes-i-really-really-mean-it", dest="enforce", action="store_true", help="specify this option to enforce delete")
-args = parser.parse_args()
+  for v in s3stats.timed(s3lister.list_versions(bucket, start=start, on_page=save_checkpoint if checkpoint != None else None), "list", "listed"):
+    if log != None:
+      log.write("removing", v.name, v.version_id)
+    delete(v.name, v.version_id)
 
-s3_conf = args.s3_conf
-bucket_name = args.bucket
-enforce = args.enforce
+  s3stats.timed_call(deleter.close, "delete")()
+  if log != None:
+    log.close()
+  s3stats.stats.count("deleted", deleter.deleted)
+  s3stats.stats.count("failed", deleter.failed)
 
-# check if delete operation is really enforced
+  print >> sys.stderr, "removed", deleter.deleted, "versions,", deleter.failed, "failed,", deleter.requests, "delete requests"
+  for code, count in sorted(deleter.errors.items()):
+    print >> sys.stderr, "  ", count, "x", code
+
+  if deleter.failed + failed_before > 0:
+    print >> sys.stderr, "not removing bucket", bucket.name, "- not all versioned objects could be removed"
+    return 1
 
-if not enforce:
-  print >> sys.stderr, 'please specify option "--yes-i-really-really-mean-it" to delete the bucket including all its versioned objects'
-  quit()
+  if checkpoint != None:
+    checkpoint.remove()
 
-# parse config file
+  print >> sys.stderr, "removing the now empty bucket", bucket.name
+  s3.delete_bucket(bucket.name)
+  return 0
 
-cnf = ConfigParser.RawConfigParser()
-cnf.read(s3_conf)
-
-access = cnf.get("connect", "access")
-secret = cnf.get("connect", "secret")
-host = cnf.get("connect", "host")
-port = cnf.getint("connect", "port")
-is_secure = cnf.getboolean("connect", "is_secure")
-
-# establish S3 connection
-
-s3 = boto.connect_s3(
-  aws_access_key_id = access,
-  aws_secret_access_key = secret,
-  host = host,
-  port = port,
-  is_secure = is_secure,
-  calling_format = boto.s3.connection.OrdinaryCallingFormat()
-  )
-
-# delete versioned bucket
-
-bucket = s3.get_bucket(bucket_name)
-
-# first remove all versioned objects
-# please note the extra logic because get_all_versions() can only handle 1000 versions at a time
-
-print >> sys.stderr, "removing all versioned objects in bucket", bucket_name, ":"
-
-last_name = None
-last_version_id = None
-while True:
-  versions = bucket.get_all_versions(key_marker=last_name, version_id_marker=last_version_id)
-
-  for v in versions:
-    print >> sys.stderr, "removing", v.name, v.version_id
-    bucket.delete_key(v.name, version_id = v.version_id)
-    last_name = v.name
-    last_version_id = v.version_id
-
-  if not versions.is_truncated:
-    break
-
-print >> sys.stderr, "removing the now empty bucket", bucket.name
-s3.delete_bucket(bucket.name)
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# s3diff
+#
+# by Walter Graf
+#
+# usage: s3diff.py [-h] [-c s3-config-file] [--new-versions output-file]
+#                  [--new-markers output-file] [--vanished output-file]
+#                  [--flipped output-file] [--prefix object-prefix]
+#                  [--shards shards] [--split-at object-name]
+#                  [--delimiter delimiter] [--workers workers]
+#                  [--format {csv,binary}] [--compress] [--backend {boto,async}]
+#                  [--retries retries] [--max-rate requests-per-sec] [--stats]
+#                  [--stats-file stats-file] [--stats-format {prometheus,json}]
+#                  old-listing new-listing
+#
+# list the changes between two version listings of a bucket
+#
+# positional arguments:
+#   old-listing           earlier listing, a csv file or binary version list, or
+#                         s3://bucket-name to list the bucket
+#   new-listing           later listing, a csv file or binary version list, or
+#                         s3://bucket-name to list the bucket
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   -c s3-config-file     use this S3 configuration file (default:
+#                         $HOME/s3versioning.cnf)
+#   --new-versions output-file
+#                         write the versions only in the new listing to this
+#                         file
+#   --new-markers output-file
+#                         write the delete markers only in the new listing to
+#                         this file
+#   --vanished output-file
+#                         write the versions only in the old listing to this
+#                         file
+#   --flipped output-file
+#                         write the new latest version of objects whose latest
+#                         version changed to this file
+#   --prefix object-prefix
+#                         only compare objects starting with this prefix
+#   --shards shards       split a live listing into this many key ranges at
+#                         common prefixes and list them in parallel (default: 1)
+#   --split-at object-name
+#                         split a live listing after this object name instead of
+#                         at common prefixes (may be repeated)
+#   --delimiter delimiter
+#                         delimiter used to discover common prefixes (default:
+#                         /)
+#   --workers workers     list this many key ranges in parallel, each using its
+#                         own S3 connection (default: 4)
+#   --format {csv,binary}
+#                         write the versions in this format (default: csv)
+#   --compress            compress binary output
+#   --backend {boto,async}
+#                         send the S3 requests through boto's connections or the
+#                         event loop of s3async (default: boto)
+#   --retries retries     retry throttled or failed S3 requests this many times
+#                         (default: 8)
+#   --max-rate requests-per-sec
+#                         never send more than this many S3 requests per second
+#   --stats               print request and pipeline statistics to stderr at
+#                         exit
+#   --stats-file stats-file
+#                         write request and pipeline statistics to this file at
+#                         exit
+#   --stats-format {prometheus,json}
+#                         format of the statistics file (default: prometheus)
+#
+# The changes between two listings of the same bucket(s) are found by a merge
+# join: both listings are in S3 listing order, i.e. by bucket, by object name
+# and within one object newest version first, as written by the listing
+# tools (s3lisov without selection options lists all versions) or listed live
+# from the bucket. The listings are read side by side one object at a time,
+# so memory only holds the versions of the current object of each listing,
+# however long the listings are. A listing out of order is reported as an
+# error instead of producing a wrong diff.
+#
+# The change sets are written as version lists with the columns of the
+# listing tools, ready for s3delov:
+# - versions only in the new listing (--new-versions), deleting them rolls
+#   the objects back to the old listing
+# - delete markers only in the new listing (--new-markers), deleting them
+#   undeletes the objects
+# - versions only in the old listing (--vanished)
+# - the new latest version of objects listed in both whose latest version
+#   differs (--flipped)
+
+import sys
+import os
+import argparse
+import itertools
+import s3version
+import s3stats
+import s3connect
+import s3scheduler
+import s3format
+import s3lister
+import s3record
+
+# listings given as s3://bucket-name are listed live from the bucket
+S3_DIFF_LIVE = "s3://"
+
+# command line arguments
+
+def make_parser(prog=None):
+  parser = argparse.ArgumentParser(prog = prog, description = "list the changes between two version listings of a bucket")
+  parser.add_argument("old", metavar="old-listing", help="earlier listing, a csv file or binary version list, or s3://bucket-name to list the bucket")
+  parser.add_argument("new", metavar="new-listing", help="later listing, a csv file or binary version list, or s3://bucket-name to list the bucket")
+  parser.add_argument("-c", dest="s3_conf", metavar="s3-config-file", default=s3version.S3_CONF, help="use this S3 configuration file (default: %(default)s)")
+  parser.add_argument("--new-versions", metavar="output-file", help="write the versions only in the new listing to this file")
+  parser.add_argument("--new-markers", metavar="output-file", help="write the delete markers only in the new listing to this file")
+  parser.add_argument("--vanished", metavar="output-file", help="write the versions only in the old listing to this file")
+  parser.add_argument("--flipped", metavar="output-file", help="write the new latest version of objects whose latest version changed to this file")
+  parser.add_argument("--prefix", metavar="object-prefix", help="only compare objects starting with this prefix")
+  parser.add_argument("--shards", metavar="shards", type=int, default=1, help="split a live listing into this many key ranges at common prefixes and list them in parallel (default: %(default)s)")
+  parser.add_argument("--split-at", metavar="object-name", action="append", help="split a live listing after this object name instead of at common prefixes (may be repeated)")
+  parser.add_argument("--delimiter", metavar="delimiter", default="/", help="delimiter used to discover common prefixes (default: %(default)s)")
+  parser.add_argument("--workers", metavar="workers", type=int, default=4, help="list this many key ranges in parallel, each using its own S3 connection (default: %(default)s)")
+  parser.add_argument("--format", choices=s3format.S3_FORMATS, default="csv", help="write the versions in this format (default: %(default)s)")
+  parser.add_argument("--compress", action="store_true", help="compress binary output")
+  parser.add_argument("--backend", choices=s3connect.S3_BACKENDS, default="boto", help="send the S3 requests through boto's connections or the event loop of s3async (default: %(default)s)")
+  parser.add_argument("--retries", metavar="retries", type=int, default=s3scheduler.S3_SCHEDULER_RETRIES, help="retry throttled or failed S3 requests this many times (default: %(default)s)")
+  parser.add_argument("--max-rate", metavar="requests-per-sec", type=float, help="never send more than this many S3 requests per second")
+  parser.add_argument("--stats", action="store_true", help="print request and pipeline statistics to stderr at exit")
+  parser.add_argument("--stats-file", metavar="stats-file", help="write request and pipeline statistics to this file at exit")
+  parser.add_argument("--stats-format", choices=s3stats.S3_STATS_FORMATS, default="prometheus", help="format of the statistics file (default: %(default)s)")
+  return parser
+
+# a listing is out of order
+
+class OrderError(Exception):
+  pass
+
+def _utf8(s):
+  if isinstance(s, unicode):
+    return s.encode("utf-8")
+  return s
+
+# (bucket name, version) pairs of a version list file
+
+def _file_versions(input, prefix):
+  for row in s3format.read_rows(input):
+    if prefix != None and not row["object"].startswith(prefix):
+      continue
+    v = s3record.Version(row["object"], row["version_id"], row["mod_time"], int(row["size"]), row["is_latest"] == "True", row["del_marker"] == "yes")
+    yield row["bucket"], v
+
+# the versions of a listing grouped by object, as ((bucket name, object name), versions) pairs
+# the object names are compared as utf-8, the order S3 lists them in
+
+def _objects(versions, listing):
+  last = None
+  for key, group in itertools.groupby(versions, lambda bv: (_utf8(bv[0]), _utf8(bv[1].name))):
+    if last != None and key <= last:
+      raise OrderError("%s is not in listing order at %s %s" % (listing, key[0], key[1]))
+    last = key
+    yield key, [ v for b, v in group ]
+
+# the latest version of an object
+
+def _latest(versions):
+  for v in versions:
+    if v.is_latest:
+      return v
+  return None
+
+# merge join the objects of the old and the new listing
+# on_change is called with the change ("new_version", "new_marker", "vanished", "flipped"), the bucket name and the version
+
+def diff(old, new, on_change):
+  old = iter(old)
+  new = iter(new)
+  o = next(old, None)
+  n = next(new, None)
+  while o != None or n != None:
+    if n == None or (o != None and o[0] < n[0]):
+      for v in o[1]:
+        on_change("vanished", o[0][0], v)
+      o = next(old, None)
+    elif o == None or n[0] < o[0]:
+      for v in n[1]:
+        on_change("new_marker" if v.del_marker else "new_version", n[0][0], v)
+      n = next(new, None)
+    else:
+      bucket_name = n[0][0]
+      old_ids = set([ v.version_id for v in o[1] ])
+      new_ids = set([ v.version_id for v in n[1] ])
+      for v in n[1]:
+        if v.version_id not in old_ids:
+          on_change("new_marker" if v.del_marker else "new_version", bucket_name, v)
+      for v in o[1]:
+        if v.version_id not in new_ids:
+          on_change("vanished", bucket_name, v)
+      old_latest = _latest(o[1])
+      new_latest = _latest(n[1])
+      if new_latest != None and (old_latest == None or old_latest.version_id != new_latest.version_id):
+        on_change("flipped", bucket_name, new_latest)
+      o = next(old, None)
+      n = next(new, None)
+
+# writes the versions of one change set, a bucket name column changing in between
+# continues the output without another header
+
+class ChangeWriter(object):
+
+  def __init__(self, output, format, compress):
+    self.output = output
+    self.format = format
+    self.compress = compress
+    self.bucket_name = None
+    self.writer = None
+    self.header = True
+
+  def write(self, bucket_name, v):
+    if bucket_name != self.bucket_name:
+      if self.writer != None:
+        self.writer.flush()
+      self.writer = s3format.version_writer(self.output, bucket_name, self.format, self.compress, self.header)
+      self.bucket_name = bucket_name
+      self.header = False
+    self.writer.write(v)
+
+  def close(self):
+    if self.writer == None:
+      s3format.version_writer(self.output, "", self.format, self.compress, self.header).close()
+    else:
+      self.writer.close()
+
+# compare two listings as asked for by the command line arguments argv (default: sys.argv)
+# connect opens the S3 connections instead of the S3 configuration file
+# returns the exit status
+
+def main(argv=None, connect=None, prog=None):
+  parser = make_parser(prog)
+  args = parser.parse_args(argv)
+
+  # record request and pipeline statistics if asked for, they are reported at exit
+
+  s3stats.setup("s3diff", args.stats, args.stats_file, args.stats_format)
+
+  # retry failed requests and adapt the number of requests in flight to the endpoint
+
+  if args.retries < 0:
+    parser.error("number of retries must not be negative")
+  if args.max_rate != None and args.max_rate <= 0:
+    parser.error("maximum request rate must be positive")
+  s3scheduler.setup(args.retries, args.max_rate)
+
+  s3_conf = args.s3_conf
+  prefix = args.prefix
+  shards = args.shards
+  split_at = args.split_at
+  delimiter = args.delimiter
+  workers = args.workers
+  format = args.format
+  compress = args.compress
+
+  if shards < 1:
+    parser.error("number of shards must be at least 1")
+  if workers < 1:
+    parser.error("number of workers must be at least 1")
+  for listing in [ args.old, args.new ]:
+    if listing == S3_DIFF_LIVE:
+      parser.error("bucket name missing in %s" % listing)
+    if not listing.startswith(S3_DIFF_LIVE) and not os.path.isfile(listing):
+      parser.error("listing %s not found" % listing)
+
+  # the versions of a listing, a file or a live listing of a bucket
+  # the configuration file is only read and connections are only established for live listings
+
+  def versions(listing):
+    if not listing.startswith(S3_DIFF_LIVE):
+      return _file_versions(open(listing, "rb"), prefix)
+    bucket_name = listing[len(S3_DIFF_LIVE):]
+    bucket = connect().get_bucket(bucket_name)
+    if split_at:
+      split_points = split_at
+    else:
+      split_points = s3lister.discover_split_points(bucket, prefix, shards, delimiter)
+    open_bucket = lambda: connect().get_bucket(bucket_name, validate=False)
+    return ((bucket_name, v) for v in s3lister.list_versions(bucket, prefix, split_points, workers, open_bucket))
+
+  if connect == None and (args.old.startswith(S3_DIFF_LIVE) or args.new.startswith(S3_DIFF_LIVE)):
+    connect = s3connect.connector(s3connect.read_config(s3_conf), args.backend)
+
+  # prepare one output per change set asked for
+
+  writers = {}
+  for change, output_file in [ ("new_version", args.new_versions), ("new_marker", args.new_markers), ("vanished", args.vanished), ("flipped", args.flipped) ]:
+    if output_file != None:
+      writers[change] = ChangeWriter(open(output_file, "wb"), format, compress)
+
+  # count every change, write it to its change set if asked for
+
+  counts = dict([ (change, 0) for change in [ "new_version", "new_marker", "vanished", "flipped" ] ])
+  sizes = dict(counts)
+
+  def on_change(change, bucket_name, v):
+    counts[change] += 1
+    sizes[change] += v.size
+    writer = writers.get(change)
+    if writer != None:
+      writer.write(bucket_name, v)
+
+  # compare the listings, the time spent reading them is the list stage
+
+  old = _objects(s3stats.timed(versions(args.old), "list", "listed"), args.old)
+  new = _objects(s3stats.timed(versions(args.new), "list", "listed"), args.new)
+  status = 0
+  try:
+    diff(old, new, on_change)
+  except OrderError as e:
+    print >> sys.stderr, "error:", e
+    status = 1
+
+  for writer in writers.values():
+    writer.close()
+  for change, counter in [ ("new_version", "new"), ("new_marker", "marked"), ("vanished", "vanished"), ("flipped", "flipped") ]:
+    s3stats.stats.count(counter, counts[change])
+  print >> sys.stderr, counts["new_version"], "new versions (%d bytes)," % sizes["new_version"], counts["new_marker"], "new delete markers,", counts["vanished"], "vanished versions (%d bytes)," % sizes["vanished"], counts["flipped"], "objects with a new latest version"
+  return status
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,528 @@
+# -*- coding: utf-8 -*-
+
+# s3fake
+#
+# by Walter Graf
+#
+# local stand-in for a versioned S3 endpoint
+#
+# FakeS3 keeps versioned buckets in memory and serves the subset of the S3 API
+# the toolset uses over HTTP from a thread of the calling process: create,
+# head and delete buckets, get and set versioning, put, head and get objects
+# (also ranges of specific versions, with user defined metadata), copy versions (server-side, within a bucket),
+# list object versions (paginated, with prefix and delimiter), delete single
+# versions or create delete markers and multi-object deletes. Signatures are
+# not checked.
+#
+# Every request can be delayed by an injectable latency and is counted per
+# operation, so that benchmarks can report the requests a tool issued.
+# Throttling can be injected as well: a fraction of all requests and the
+# requests exceeding a number of requests in flight are answered with
+# 503 SlowDown, like a busy RGW gateway does.
+#
+# populate() fills a bucket with a generated, reproducible shape: a number of
+# objects spread over a tree of prefixes, a number of versions per object and
+# a fraction of objects whose latest version is a delete marker. Generated
+# versions are not stored, their content is derived from their name and
+# version id when they are read; only if asked for their ETags are the MD5 of
+# this content, which takes a while for large buckets.
+
+import time
+import random
+import hashlib
+import bisect
+import threading
+import urllib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import xml.etree.cElementTree as ElementTree
+from xml.sax.saxutils import escape
+
+S3_FAKE_MAX_KEYS = 1000
+S3_FAKE_XMLNS = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+# all generated versions are modified at whole seconds before this time
+S3_FAKE_EPOCH = 1577836800 # 2020-01-01T00:00:00Z
+
+def _timestamp(sec):
+  return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(sec))
+
+def _http_date(timestamp):
+  return time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.000Z"))
+
+def _etag(data):
+  return '"%s"' % hashlib.md5(data).hexdigest()
+
+# bytes start to end (exclusive) of the content of a version, content is either
+# the data put or a tuple (seed,) of a generated version, which is a 4 KB block
+# derived from the seed repeated
+
+_block_size = 4096
+
+def _content(content, size, start=0, end=None):
+  if end is None or end > size:
+    end = size
+  if isinstance(content, str):
+    return content[start:end]
+  seed = content[0]
+  block = "".join([ hashlib.md5("%s\0%d" % (seed, i)).digest() for i in range(_block_size // 16) ])
+  first = start // _block_size
+  last = (end + _block_size - 1) // _block_size
+  return (block * (last - first))[start - first * _block_size:end - first * _block_size]
+
+class S3Error(Exception):
+
+  def __init__(self, status, code, message):
+    Exception.__init__(self, message)
+    self.status = status
+    self.code = code
+    self.message = message
+
+class FakeBucket(object):
+
+  # objects maps an object name to its versions, newest first, each version a
+  # tuple (version_id, last_modified, size, del_marker, etag, content), see _content()
+  # names is the sorted list of object names, objects whose last version has
+  # been deleted stay in it until the next compaction
+  # version ids are hex numbers growing with every version of the bucket, so a
+  # listing can continue after a version marker that has been deleted meanwhile
+  # metadata maps (name, version_id) to the user defined metadata of versions having any
+
+  def __init__(self, name):
+    self.name = name
+    self.versioning = None
+    self.objects = {}
+    self.names = []
+    self.versions = 0
+    self.empty = 0
+    self.sequence = 0
+    self.metadata = {}
+
+  def version_id(self):
+    self.sequence += 1
+    return "%016x" % self.sequence
+
+  def put(self, name, version, metadata=None):
+    if metadata:
+      self.metadata[(name, version[0])] = metadata
+    versions = self.objects.get(name)
+    if versions is None:
+      versions = self.objects[name] = []
+      bisect.insort(self.names, name)
+    elif not versions:
+      self.empty -= 1
+    versions.insert(0, version)
+    self.versions += 1
+
+  def delete(self, name, version_id):
+    versions = self.objects.get(name)
+    if not versions:
+      return False
+    for i, v in enumerate(versions):
+      if v[0] == version_id:
+        del versions[i]
+        self.versions -= 1
+        self.metadata.pop((name, version_id), None)
+        if not versions:
+          self.empty += 1
+          if self.empty > len(self.names) // 2:
+            self._compact()
+        return True
+    return False
+
+  def _compact(self):
+    self.names = [ n for n in self.names if self.objects[n] ]
+    for n in [ n for n, versions in self.objects.items() if not versions ]:
+      del self.objects[n]
+    self.empty = 0
+
+  # one page of the version listing, returns (entries, prefixes, truncated, next markers)
+  # entries are (name, version, is_latest) tuples
+
+  def list(self, prefix="", delimiter=None, key_marker=None, version_id_marker=None, max_keys=S3_FAKE_MAX_KEYS):
+    entries = []
+    prefixes = []
+    last = None
+    names = self.names
+    i = bisect.bisect_left(names, max(prefix, key_marker or ""))
+    while i < len(names):
+      name = names[i]
+      if not name.startswith(prefix):
+        break
+      versions = self.objects[name]
+      if key_marker is not None and name <= key_marker:
+        if name < key_marker or not version_id_marker:
+          i += 1
+          continue
+      if delimiter:
+        pos = name.find(delimiter, len(prefix))
+        if pos >= 0:
+          common = name[:pos + len(delimiter)]
+          if key_marker is None or common > key_marker:
+            if len(entries) + len(prefixes) >= max_keys:
+              return entries, prefixes, True, last
+            prefixes.append(common)
+            last = (common, None)
+          i = bisect.bisect_left(names, common[:-1] + chr(ord(common[-1]) + 1))
+          continue
+      start = 0
+      if name == key_marker:
+        start = _continue_at(versions, version_id_marker)
+      for n in range(start, len(versions)):
+        v = versions[n]
+        if len(entries) + len(prefixes) >= max_keys:
+          return entries, prefixes, True, last
+        entries.append((name, v, n == 0))
+        last = (name, v[0])
+      i += 1
+    return entries, prefixes, False, None
+
+# position in versions (newest first) to continue a listing after the version marker
+
+def _sequence(version_id):
+  try:
+    return int(version_id, 16)
+  except ValueError:
+    return 0
+
+def _continue_at(versions, marker):
+  for n, v in enumerate(versions):
+    if v[0] == marker:
+      return n + 1
+
+  # the marker has been deleted, continue with the versions created before it
+
+  for n, v in enumerate(versions):
+    if _sequence(v[0]) < _sequence(marker):
+      return n
+  return len(versions)
+
+class FakeS3(object):
+
+  def __init__(self, latency=0.0, throttle=0.0, max_in_flight=None):
+    self.latency = latency
+    self.throttle = throttle
+    self.max_in_flight = max_in_flight
+    self.in_flight = 0
+    self.buckets = {}
+    self.lock = threading.Lock()
+    self.requests = {}
+    self.server = None
+
+  # count of requests per operation since the last reset
+
+  def reset_requests(self):
+    with self.lock:
+      self.requests = {}
+
+  def count(self, op):
+    with self.lock:
+      self.requests[op] = self.requests.get(op, 0) + 1
+
+  def bucket(self, name):
+    b = self.buckets.get(name)
+    if b is None:
+      raise S3Error(404, "NoSuchBucket", "The specified bucket does not exist")
+    return b
+
+  # serve the endpoint on host:port (port 0 picks a free port) from a daemon thread
+
+  def start(self, host="127.0.0.1", port=0):
+    self.server = _Server((host, port), _Handler)
+    self.server.s3 = self
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return self.server.server_address
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+# fill bucket with a generated shape
+# keys            number of objects
+# versions        number of versions per object
+# depth           number of prefix levels above the objects
+# fanout          number of prefixes per level
+# deleted         fraction of objects whose latest version is a delete marker
+# seed            seed of the generator, equal parameters generate equal buckets
+# etags           make the ETags of the versions the MD5 of their content
+
+def populate(s3, bucket_name, keys, versions=1, depth=1, fanout=10, deleted=0.0, seed=1, etags=False):
+  r = random.Random(seed)
+  times = [ _timestamp(S3_FAKE_EPOCH - d * 86400) for d in range(versions + 1) ]
+  with s3.lock:
+    b = s3.buckets.get(bucket_name)
+    if b is None:
+      b = s3.buckets[bucket_name] = FakeBucket(bucket_name)
+    b.versioning = "Enabled"
+    names = []
+    for k in range(keys):
+      path = [ "p%02d" % r.randrange(fanout) for level in range(depth) ]
+      names.append("/".join(path + [ "obj%08d" % k ]))
+    names.sort()
+    b.names = names
+    b.objects = {}
+    b.versions = 0
+    b.empty = 0
+    b.sequence = 0
+    for name in names:
+      v = b.objects[name] = []
+      for j in range(versions):
+        version_id = b.version_id()
+        size = r.randrange(1 << 20)
+        content = (name + version_id,)
+        etag = _etag(_content(content, size)) if etags else _etag(name + version_id)
+        v.append((version_id, times[versions - j], size, False, etag, content))
+      v.reverse()
+      if r.random() < deleted:
+        v.insert(0, (b.version_id(), times[0], 0, True, None, None))
+      b.versions += len(v)
+  return b.versions
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  protocol_version = "HTTP/1.1"
+
+  # send every response in one piece, without waiting for delayed acknowledgements
+  wbufsize = -1
+  disable_nagle_algorithm = True
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    self._handle("GET")
+
+  def do_HEAD(self):
+    self._handle("HEAD")
+
+  def do_PUT(self):
+    self._handle("PUT")
+
+  def do_POST(self):
+    self._handle("POST")
+
+  def do_DELETE(self):
+    self._handle("DELETE")
+
+  def _handle(self, method):
+    s3 = self.server.s3
+    url = urlparse.urlsplit(self.path)
+    path = urllib.unquote(url.path).lstrip("/")
+    bucket_name, _, key = path.partition("/")
+    query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+    length = int(self.headers.get("Content-Length") or 0)
+    body = self.rfile.read(length) if length else ""
+    with s3.lock:
+      s3.in_flight += 1
+      throttled = (s3.max_in_flight and s3.in_flight > s3.max_in_flight) or (s3.throttle and random.random() < s3.throttle)
+    try:
+      if s3.latency:
+        time.sleep(s3.latency)
+      if throttled:
+        raise S3Error(503, "SlowDown", "Please reduce your request rate.")
+      op, status, headers, data = self._dispatch(s3, method, bucket_name, key, query, body)
+    except S3Error as e:
+      op = "throttled" if throttled else method.lower()
+      status = e.status
+      headers = {}
+      data = "<Error><Code>%s</Code><Message>%s</Message></Error>" % (e.code, escape(e.message))
+    finally:
+      with s3.lock:
+        s3.in_flight -= 1
+    s3.count(op)
+    if data and "Content-Type" not in headers:
+      data = '<?xml version="1.0" encoding="UTF-8"?>\n' + data
+      headers["Content-Type"] = "application/xml"
+    self.send_response(status)
+    for k, v in headers.items():
+      self.send_header(k, v)
+    if "Content-Length" not in headers:
+      self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    if method != "HEAD":
+      self.wfile.write(data)
+
+  def _dispatch(self, s3, method, bucket_name, key, query, body):
+    with s3.lock:
+      if not bucket_name:
+        return "list_buckets", 200, {}, self._list_buckets(s3)
+      if key:
+        if method == "PUT" and "x-amz-copy-source" in self.headers:
+          headers, data = self._copy_object(s3, bucket_name, key, self.headers["x-amz-copy-source"])
+          return "copy_object", 200, headers, data
+        if method == "PUT":
+          return "put_object", 200, self._put_object(s3, bucket_name, key, body), ""
+        if method == "GET" or method == "HEAD":
+          status, headers, data = self._get_object(s3, bucket_name, key, query.get("versionId"), self.headers.get("Range"), method == "HEAD")
+          return method.lower() + "_object", status, headers, data
+        if method == "DELETE":
+          return "delete_object", 204, self._delete_object(s3, bucket_name, key, query.get("versionId")), ""
+      elif "versions" in query and method == "GET":
+        return "list_versions", 200, {}, self._list_versions(s3, bucket_name, query)
+      elif "delete" in query and method == "POST":
+        return "delete_objects", 200, {}, self._delete_objects(s3, bucket_name, body)
+      elif "versioning" in query:
+        if method == "PUT":
+          s3.bucket(bucket_name).versioning = ElementTree.fromstring(body).findtext("{%s}Status" % S3_FAKE_XMLNS) or "Suspended"
+          return "put_versioning", 200, {}, ""
+        if method == "GET":
+          status = s3.bucket(bucket_name).versioning
+          return "get_versioning", 200, {}, '<VersioningConfiguration xmlns="%s">%s</VersioningConfiguration>' % (S3_FAKE_XMLNS, "<Status>%s</Status>" % status if status else "")
+      elif method == "PUT":
+        if bucket_name not in s3.buckets:
+          s3.buckets[bucket_name] = FakeBucket(bucket_name)
+        return "create_bucket", 200, {}, ""
+      elif method == "HEAD":
+        s3.bucket(bucket_name)
+        return "head_bucket", 200, {}, ""
+      elif method == "DELETE":
+        b = s3.bucket(bucket_name)
+        if b.versions:
+          raise S3Error(409, "BucketNotEmpty", "The bucket you tried to delete is not empty")
+        del s3.buckets[bucket_name]
+        return "delete_bucket", 204, {}, ""
+    raise S3Error(501, "NotImplemented", "%s %s is not implemented" % (method, self.path))
+
+  def _list_buckets(self, s3):
+    buckets = "".join([ "<Bucket><Name>%s</Name><CreationDate>%s</CreationDate></Bucket>" % (escape(name), _timestamp(S3_FAKE_EPOCH)) for name in sorted(s3.buckets) ])
+    return '<ListAllMyBucketsResult xmlns="%s"><Owner><ID>fake</ID><DisplayName>fake</DisplayName></Owner><Buckets>%s</Buckets></ListAllMyBucketsResult>' % (S3_FAKE_XMLNS, buckets)
+
+  def _put_object(self, s3, bucket_name, key, body):
+    b = s3.bucket(bucket_name)
+    version_id = b.version_id() if b.versioning == "Enabled" else "null"
+    if version_id == "null":
+      b.delete(key, "null")
+    etag = _etag(body)
+    metadata = dict([ (k.lower()[len("x-amz-meta-"):], v) for k, v in self.headers.items() if k.lower().startswith("x-amz-meta-") ])
+    b.put(key, (version_id, _timestamp(time.time()), len(body), False, etag, body), metadata)
+    return { "ETag": etag, "x-amz-version-id": version_id }
+
+  # the content of a version or, with a header Range: bytes=first-last, a range of it
+  # only the headers with head
+
+  def _get_object(self, s3, bucket_name, key, version_id, range, head=False):
+    b = s3.bucket(bucket_name)
+    versions = b.objects.get(key) or []
+    if version_id == None:
+      versions = versions[0:1]
+    else:
+      versions = [ v for v in versions if v[0] == version_id ]
+    if not versions:
+      raise S3Error(404, "NoSuchVersion" if version_id else "NoSuchKey", "The specified key does not exist.")
+    version_id, last_modified, size, del_marker, etag, content = versions[0]
+    if del_marker:
+      raise S3Error(404 if version_id == None else 405, "NoSuchKey" if version_id == None else "MethodNotAllowed", "The specified method is not allowed against this resource.")
+    headers = { "ETag": etag, "x-amz-version-id": version_id, "Content-Type": "application/octet-stream", "Last-Modified": _http_date(last_modified) }
+    for k, v in b.metadata.get((key, version_id), {}).items():
+      headers["x-amz-meta-" + k] = v
+    if head:
+      headers["Content-Length"] = str(size)
+      return 200, headers, ""
+    if not range:
+      return 200, headers, _content(content, size)
+    first, _, last = range.partition("=")[2].partition("-")
+    if not first:
+      start, end = max(0, size - int(last)), size
+    else:
+      start, end = int(first), min(size, int(last) + 1 if last else size)
+    if start >= size:
+      raise S3Error(416, "InvalidRange", "The requested range is not satisfiable")
+    headers["Content-Range"] = "bytes %d-%d/%d" % (start, end - 1, size)
+    return 206, headers, _content(content, size, start, end)
+
+  # copy a version of an object of the same bucket, source is bucket/key[?versionId=version-id]
+
+  def _copy_object(self, s3, bucket_name, key, source):
+    b = s3.bucket(bucket_name)
+    source, _, query = source.lstrip("/").partition("?")
+    source_bucket, _, source_key = urllib.unquote(source).partition("/")
+    version_id = dict(urlparse.parse_qsl(query)).get("versionId")
+    if source_bucket != bucket_name:
+      raise S3Error(501, "NotImplemented", "copies between buckets are not implemented")
+    versions = b.objects.get(source_key) or []
+    if version_id == None:
+      versions = versions[0:1]
+    else:
+      versions = [ v for v in versions if v[0] == version_id ]
+    if not versions:
+      raise S3Error(404, "NoSuchVersion" if version_id else "NoSuchKey", "The specified version does not exist.")
+    if versions[0][3]:
+      raise S3Error(400, "InvalidRequest", "The source of a copy request may not specifically refer to a delete marker by version id.")
+    new_version_id = b.version_id() if b.versioning == "Enabled" else "null"
+    if new_version_id == "null":
+      b.delete(key, "null")
+    last_modified = _timestamp(time.time())
+    b.put(key, (new_version_id, last_modified, versions[0][2], False, versions[0][4], versions[0][5]), b.metadata.get((source_key, versions[0][0])))
+    headers = { "x-amz-version-id": new_version_id }
+    if version_id:
+      headers["x-amz-copy-source-version-id"] = version_id
+    return headers, '<CopyObjectResult xmlns="%s"><LastModified>%s</LastModified><ETag>%s</ETag></CopyObjectResult>' % (S3_FAKE_XMLNS, last_modified, versions[0][4])
+
+  # delete a version or, without version id, create a delete marker
+
+  def _delete_object(self, s3, bucket_name, key, version_id):
+    b = s3.bucket(bucket_name)
+    if version_id:
+      b.delete(key, version_id)
+      return { "x-amz-version-id": version_id }
+    version_id = b.version_id() if b.versioning == "Enabled" else "null"
+    if version_id == "null":
+      b.delete(key, "null")
+    b.put(key, (version_id, _timestamp(time.time()), 0, True, None, None))
+    return { "x-amz-version-id": version_id, "x-amz-delete-marker": "true" }
+
+  def _list_versions(self, s3, bucket_name, query):
+    b = s3.bucket(bucket_name)
+    prefix = query.get("prefix", "")
+    delimiter = query.get("delimiter") or None
+    key_marker = query.get("key-marker") or None
+    version_id_marker = query.get("version-id-marker") or None
+    max_keys = min(int(query.get("max-keys", S3_FAKE_MAX_KEYS)), S3_FAKE_MAX_KEYS)
+    entries, prefixes, truncated, last = b.list(prefix, delimiter, key_marker, version_id_marker, max_keys)
+    xml = [ '<ListVersionsResult xmlns="%s"><Name>%s</Name><Prefix>%s</Prefix>' % (S3_FAKE_XMLNS, escape(bucket_name), escape(prefix)) ]
+    xml.append("<MaxKeys>%d</MaxKeys><IsTruncated>%s</IsTruncated>" % (max_keys, "true" if truncated else "false"))
+    if truncated:
+      xml.append("<NextKeyMarker>%s</NextKeyMarker>" % escape(last[0]))
+      if last[1]:
+        xml.append("<NextVersionIdMarker>%s</NextVersionIdMarker>" % last[1])
+    for name, v, is_latest in entries:
+      version_id, last_modified, size, del_marker, etag, content = v
+      latest = "true" if is_latest else "false"
+      if del_marker:
+        xml.append("<DeleteMarker><Key>%s</Key><VersionId>%s</VersionId><IsLatest>%s</IsLatest><LastModified>%s</LastModified></DeleteMarker>" % (escape(name), version_id, latest, last_modified))
+      else:
+        xml.append('<Version><Key>%s</Key><VersionId>%s</VersionId><IsLatest>%s</IsLatest><LastModified>%s</LastModified><ETag>%s</ETag><Size>%d</Size><StorageClass>STANDARD</StorageClass></Version>' % (escape(name), version_id, latest, last_modified, etag, size))
+    for p in prefixes:
+      xml.append("<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>" % escape(p))
+    xml.append("</ListVersionsResult>")
+    return "".join(xml)
+
+  # multi-object delete, deleting a version that does not exist succeeds like on S3
+
+  def _delete_objects(self, s3, bucket_name, body):
+    b = s3.bucket(bucket_name)
+    request = ElementTree.fromstring(body)
+    ns = "{%s}" % S3_FAKE_XMLNS if request.tag.startswith("{") else ""
+    quiet = request.findtext(ns + "Quiet") == "true"
+    xml = [ '<DeleteResult xmlns="%s">' % S3_FAKE_XMLNS ]
+    for o in request.findall(ns + "Object"):
+      name = o.findtext(ns + "Key").encode("utf-8")
+      version_id = o.findtext(ns + "VersionId")
+      if version_id:
+        b.delete(name, version_id)
+        if not quiet:
+          xml.append("<Deleted><Key>%s</Key><VersionId>%s</VersionId></Deleted>" % (escape(name), version_id))
+      else:
+        marker = b.version_id()
+        b.put(name, (marker, _timestamp(time.time()), 0, True, None, None))
+        if not quiet:
+          xml.append("<Deleted><Key>%s</Key><DeleteMarker>true</DeleteMarker><DeleteMarkerVersionId>%s</DeleteMarkerVersionId></Deleted>" % (escape(name), marker))
+    xml.append("</DeleteResult>")
+    return "".join(xml)
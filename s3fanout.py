@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# s3fanout
+#
+# by Walter Graf
+#
+# running a tool for several buckets at once
+#
+# The listing and housekeeping tools take several bucket names or shell
+# patterns like 'logs-*' ('*' being all buckets of the endpoint), which
+# expand() resolves against the bucket list of the endpoint.
+#
+# run() then calls the function processing one bucket of the tool for every
+# bucket in a process of its own, at most a given number at a time. The
+# processes are forked from the tool after it has parsed its arguments, so
+# there is no interpreter start-up per bucket and every process works as if
+# the tool had been started for its bucket alone. The calling process
+# collects the processes as they finish and merges their results in the
+# order of the buckets:
+# - the versions the processes write (to their output file or stdout) are
+#   appended to one output, which gets a single header. Every row carries
+#   its bucket, so s3delov can process the merged output.
+# - the messages of the processes are copied to stderr, prefixed with the
+#   bucket name
+# - the statistics of the processes are added up (see s3stats.merge())
+# The request rate limit of the tool is shared among the running processes.
+# run() returns the highest exit status of the forked processes.
+#
+# A process running tools in threads (s3daemon) must not fork, it sets
+# in_process and run() then processes the buckets one after another in the
+# calling process, merging their versions the same way.
+
+import sys
+import os
+import traceback
+import fnmatch
+import shutil
+import tempfile
+import s3format
+import s3stats
+import s3scheduler
+
+# number of buckets processed at a time
+S3_FANOUT_PROCESSES = 4
+
+# process the buckets in the calling process instead of forking
+in_process = False
+
+def is_pattern(name):
+  return any([ c in name for c in "*?[" ])
+
+# names of the buckets given by names and patterns, sorted and without duplicates
+# connect is only called if there are patterns to resolve
+
+def expand(connect, names):
+  buckets = set([ n for n in names if not is_pattern(n) ])
+  patterns = [ n for n in names if is_pattern(n) ]
+  if patterns:
+    existing = [ b.name for b in connect().get_all_buckets() ]
+    for p in patterns:
+      buckets.update(fnmatch.filter(existing, p))
+  return sorted(buckets)
+
+# process every bucket of buckets in a process of its own, at most processes at a time
+# process is called as process(bucket_name, output_file) in the forked processes and returns
+# their exit status, output_file being the file the process writes its versions to instead
+# of output_file, None to write them to stdout
+# the merged versions are written to output_file or stdout, in format with a single header
+# format None means the tool writes no versions
+# returns the highest exit status of the processes
+
+def run(buckets, processes, output_file, format, compress, process):
+  workdir = tempfile.mkdtemp(prefix="s3fanout", dir=os.path.dirname(os.path.abspath(output_file)) if output_file != None else None)
+  output = None
+  if format != None:
+    output = open(output_file, "wb") if output_file != None else sys.stdout
+    s3format.version_writer(output, buckets[0], format, compress).flush()
+
+  running = {}
+  finished = {}
+  merged = 0
+  status = 0
+  for i, bucket_name in enumerate(buckets):
+    if in_process:
+      print >> sys.stderr, "processing bucket", bucket_name
+      finished[i] = _call(process, bucket_name, _part(workdir, i, "out"))
+      merged, status = _merge(buckets, workdir, output, finished, merged, status)
+      continue
+    while len(running) >= processes:
+      _wait(running, finished)
+      merged, status = _merge(buckets, workdir, output, finished, merged, status)
+    # a forked process must not inherit buffered output, it would write it again at exit
+    if output != None:
+      output.flush()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+      _child(workdir, i, bucket_name, output_file, min(processes, len(buckets)), process)
+    running[pid] = i
+  while running:
+    _wait(running, finished)
+    merged, status = _merge(buckets, workdir, output, finished, merged, status)
+
+  if output != None:
+    output.flush()
+    if output_file != None:
+      output.close()
+  shutil.rmtree(workdir, True)
+  print >> sys.stderr, len(buckets), "buckets processed,", len([ s for s in finished.values() if s != 0 ]), "failed"
+  return status
+
+def _part(workdir, i, kind):
+  return os.path.join(workdir, "%d.%s" % (i, kind))
+
+# process a bucket in a forked process: stdout and stderr go to files of its own, the
+# statistics are handed over at the end and the request rate is shared with the other
+# running processes
+# the process ends right away, it must not return into the caller of run()
+
+def _child(workdir, i, bucket_name, output_file, running, process):
+  if output_file == None:
+    out = os.open(_part(workdir, i, "out"), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    os.dup2(out, 1)
+    os.close(out)
+  err = os.open(_part(workdir, i, "err"), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+  os.dup2(err, 2)
+  os.close(err)
+  s3stats.stats.clear()
+  if s3scheduler.scheduler.requests_per_sec:
+    s3scheduler.scheduler.requests_per_sec /= float(running)
+  try:
+    status = _call(process, bucket_name, _part(workdir, i, "out") if output_file != None else None)
+  except BaseException:
+    status = 1
+  if s3stats.stats.enabled:
+    s3stats.write(_part(workdir, i, "stats"), "json")
+  sys.stdout.flush()
+  sys.stderr.flush()
+  os._exit(status)
+
+# exit status of process(bucket_name, output_file), an exception counts as failure
+
+def _call(process, bucket_name, output_file):
+  try:
+    status = process(bucket_name, output_file)
+  except SystemExit as e:
+    status = e.code
+  except Exception:
+    traceback.print_exc()
+    status = 1
+  if status != None and not isinstance(status, int):
+    print >> sys.stderr, status
+    status = 1
+  return status or 0
+
+def _wait(running, finished):
+  pid, status = os.wait()
+  i = running.pop(pid, None)
+  if i == None:
+    return
+  if os.WIFEXITED(status):
+    finished[i] = os.WEXITSTATUS(status)
+  else:
+    finished[i] = 1
+
+# merge the results of the finished processes following the last merged one in bucket order
+
+def _merge(buckets, workdir, output, finished, merged, status):
+  while merged in finished:
+    bucket_name = buckets[merged]
+    path = _part(workdir, merged, "out")
+    if output != None and os.path.exists(path):
+      with open(path, "rb") as f:
+        shutil.copyfileobj(f, output, 1024 ** 2)
+    path = _part(workdir, merged, "err")
+    if os.path.exists(path):
+      with open(path, "rb") as f:
+        for line in f:
+          sys.stderr.write(bucket_name + ": " + line)
+    path = _part(workdir, merged, "stats")
+    if os.path.exists(path):
+      s3stats.merge(path)
+    if finished[merged] != 0:
+      print >> sys.stderr, bucket_name + ":", "failed with exit status", finished[merged]
+    status = max(status, finished[merged])
+    for kind in [ "out", "err", "stats" ]:
+      if os.path.exists(_part(workdir, merged, kind)):
+        os.remove(_part(workdir, merged, kind))
+    merged += 1
+  return merged, status
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+# s3format
+#
+# by Walter Graf
+#
+# output formats of version lists
+#
+# Version lists are written as csv (the default) or in a compact binary
+# format. Readers detect the format on their own and return the rows of both
+# formats as dictionaries with the keys s3version.S3_CSV_KEYS and the same
+# string values a csv.DictReader returns.
+#
+# The binary format is a header followed by chunks of up to 4096 versions:
+#
+#   header   "S3VB", format version (1 byte), compression (1 byte, 0 none, 1 zlib)
+#   chunk    payload length (4 bytes) followed by the payload, which is
+#            zlib compressed if the header says so
+#   payload  number of versions n (4 bytes), number of bucket names b (2 bytes)
+#            b bucket names (2 bytes length + utf-8)
+#            bucket name index per version (n x 2 bytes, only if b > 1)
+#            object name lengths (n x 4 bytes) followed by the utf-8 names
+#            version id lengths (n x 4 bytes) followed by the version ids
+#            modification times in milliseconds since the epoch (n x 8 bytes)
+#            sizes (n x 8 bytes)
+#            flags (n x 1 byte, bit 0 delete marker, bit 1 latest version)
+#
+# All integers are big endian. Modification times are stored in UTC with
+# millisecond precision and read back in the yyyy-mm-ddThh:mm:ss.mmmZ form
+# S3 uses. Readers hold one chunk in memory at a time.
+
+import csv
+import time
+import struct
+import zlib
+import itertools
+import s3csv
+import s3record
+
+S3_FORMATS = [ "csv", "binary" ]
+
+S3_BINARY_MAGIC = "S3VB"
+S3_BINARY_VERSION = 1
+S3_BINARY_CHUNK = 4096
+
+S3_BINARY_DEL_MARKER = 1
+S3_BINARY_IS_LATEST = 2
+
+# milliseconds since the epoch of an S3 timestamp (yyyy-mm-ddThh:mm:ss.mmmZ)
+
+def time_to_ms(s):
+  ms = 0
+  if len(s) > 20 and s[19] == ".":
+    ms = int(s[20:23].ljust(3, "0"))
+  return s3record.time_to_sec(s) * 1000 + ms
+
+def ms_to_time(ms):
+  return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(ms // 1000)) + ".%03dZ" % (ms % 1000)
+
+def _utf8(s):
+  if isinstance(s, unicode):
+    return s.encode("utf-8")
+  return s
+
+# version list writer in the requested format
+# output        file the versions are written to
+# bucket_name   bucket the versions belong to
+# header        write the file header (not wanted when appending to a resumed listing)
+
+def version_writer(output, bucket_name, format="csv", compress=False, header=True):
+  if format == "binary":
+    return BinaryVersionWriter(output, bucket_name, compress, header)
+  return s3csv.VersionWriter(output, bucket_name, header)
+
+# rows of a version list in either format
+
+def read_rows(input):
+  magic = input.read(len(S3_BINARY_MAGIC))
+  if magic == S3_BINARY_MAGIC:
+    return _read_binary(input)
+  lines = itertools.chain([ magic + input.readline() ], input)
+  return csv.DictReader(lines, delimiter=",", quotechar='"')
+
+class BinaryVersionWriter(object):
+
+  def __init__(self, output, bucket_name, compress=False, header=True):
+    self.output = output
+    self.bucket_name = _utf8(bucket_name)
+    self.compress = compress
+    if header:
+      output.write(S3_BINARY_MAGIC + struct.pack(">BB", S3_BINARY_VERSION, 1 if compress else 0))
+    self._reset()
+
+  def write(self, v):
+    has_del_marker = v.del_marker
+    self.names.append(_utf8(v.name))
+    self.version_ids.append(_utf8(v.version_id))
+    self.times.append(time_to_ms(v.last_modified))
+    self.sizes.append(0 if has_del_marker else int(v.size))
+    self.flags.append((S3_BINARY_DEL_MARKER if has_del_marker else 0) | (S3_BINARY_IS_LATEST if v.is_latest else 0))
+    if len(self.names) >= S3_BINARY_CHUNK:
+      self._write_chunk()
+
+  # write the pending versions as a chunk, e.g. before a checkpoint records the output offset
+
+  def flush(self):
+    if self.names:
+      self._write_chunk()
+    self.output.flush()
+
+  def close(self):
+    self.flush()
+    self.output.close()
+
+  def _reset(self):
+    self.names = []
+    self.version_ids = []
+    self.times = []
+    self.sizes = []
+    self.flags = []
+
+  def _write_chunk(self):
+    n = len(self.names)
+    parts = [ struct.pack(">IHH", n, 1, len(self.bucket_name)), self.bucket_name ]
+    parts.append(struct.pack(">%dI" % n, *[ len(s) for s in self.names ]))
+    parts.extend(self.names)
+    parts.append(struct.pack(">%dI" % n, *[ len(s) for s in self.version_ids ]))
+    parts.extend(self.version_ids)
+    parts.append(struct.pack(">%dq" % n, *self.times))
+    parts.append(struct.pack(">%dQ" % n, *self.sizes))
+    parts.append(struct.pack(">%dB" % n, *self.flags))
+    payload = "".join(parts)
+    if self.compress:
+      payload = zlib.compress(payload)
+    self.output.write(struct.pack(">I", len(payload)) + payload)
+    self._reset()
+
+def _read_exactly(input, n):
+  data = input.read(n)
+  if len(data) != n:
+    raise ValueError("truncated binary version list")
+  return data
+
+def _read_binary(input):
+  version, compression = struct.unpack(">BB", _read_exactly(input, 2))
+  if version != S3_BINARY_VERSION:
+    raise ValueError("unsupported binary version list format %d" % version)
+  while True:
+    frame = input.read(4)
+    if not frame:
+      break
+    if len(frame) < 4:
+      frame += _read_exactly(input, 4 - len(frame))
+    payload = _read_exactly(input, struct.unpack(">I", frame)[0])
+    if compression:
+      payload = zlib.decompress(payload)
+    for row in _decode_chunk(payload):
+      yield row
+
+def _decode_chunk(payload):
+  n, b = struct.unpack_from(">IH", payload, 0)
+  pos = 6
+  buckets = []
+  for i in range(b):
+    l = struct.unpack_from(">H", payload, pos)[0]
+    buckets.append(payload[pos + 2:pos + 2 + l])
+    pos += 2 + l
+  if b > 1:
+    bucket_index = struct.unpack_from(">%dH" % n, payload, pos)
+    pos += 2 * n
+  else:
+    bucket_index = itertools.repeat(0, n)
+  columns = []
+  for c in range(2):
+    lengths = struct.unpack_from(">%dI" % n, payload, pos)
+    pos += 4 * n
+    values = []
+    for l in lengths:
+      values.append(payload[pos:pos + l])
+      pos += l
+    columns.append(values)
+  times = struct.unpack_from(">%dq" % n, payload, pos)
+  pos += 8 * n
+  sizes = struct.unpack_from(">%dQ" % n, payload, pos)
+  pos += 8 * n
+  flags = struct.unpack_from(">%dB" % n, payload, pos)
+  for i, name, version_id, t, size, f in itertools.izip(bucket_index, columns[0], columns[1], times, sizes, flags):
+    yield {
+      "bucket": buckets[i],
+      "object": name,
+      "version_id": version_id,
+      "mod_time": ms_to_time(t),
+      "size": str(size),
+      "del_marker": "yes" if f & S3_BINARY_DEL_MARKER else "no",
+      "is_latest": str(bool(f & S3_BINARY_IS_LATEST))
+    }
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# s3job
+#
+# by Walter Graf
+#
+# usage: s3job.py [-h] [--socket socket-file] [--priority priority] [--status]
+#                 [subcommand] ...
+#
+# run a listing, delete or restore job in s3daemon
+#
+# positional arguments:
+#   subcommand            subcommand of the job, one of lisov, lisdv, listv,
+#                         scan, delov, retain and restore
+#   argument              arguments of the subcommand
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   --socket socket-file  hand the job to the daemon serving this Unix domain
+#                         socket (default: $HOME/s3daemon.sock)
+#   --priority priority   run the job before the queued jobs of lower priority
+#                         (default: 0)
+#   --status              list the running and queued jobs instead
+#
+# s3job hands a job to s3daemon and passes its output and messages on to
+# stdout and stderr as they arrive, e.g.
+#
+#   s3job.py lisov --after 2020-01-01T00:00:00 bucket > new.csv
+#   s3job.py lisdv -o deleted.csv bucket && s3job.py --priority 10 delov -i deleted.csv bucket
+#
+# The options of s3job precede the subcommand, the arguments following it
+# belong to the subcommand. Unless stdin is a terminal, it is sent to the
+# job, so that the versions to delete can be piped into s3job delov. The
+# exit status is the one of the job, 2 if the daemon refused it and 1 if the
+# daemon could not be reached or went away.
+
+import sys
+import os
+import argparse
+import socket
+import threading
+import json
+import s3version
+
+# command line arguments
+
+def make_parser(prog=None):
+  parser = argparse.ArgumentParser(prog = prog, description = "run a listing, delete or restore job in s3daemon")
+  parser.add_argument("command", metavar="subcommand", nargs="?", help="subcommand of the job, one of lisov, lisdv, listv, scan, delov, retain and restore")
+  parser.add_argument("args", metavar="argument", nargs=argparse.REMAINDER, help="arguments of the subcommand")
+  parser.add_argument("--socket", metavar="socket-file", default=s3version.S3_SOCKET, help="hand the job to the daemon serving this Unix domain socket (default: %(default)s)")
+  parser.add_argument("--priority", metavar="priority", type=int, default=0, help="run the job before the queued jobs of lower priority (default: %(default)s)")
+  parser.add_argument("--status", action="store_true", help="list the running and queued jobs instead")
+  return parser
+
+# send stdin to the daemon, then signal its end
+
+def _send_input(connection):
+  try:
+    while True:
+      data = os.read(sys.stdin.fileno(), 64 * 1024)
+      if not data:
+        break
+      connection.sendall(data)
+    connection.shutdown(socket.SHUT_WR)
+  except socket.error:
+    pass
+
+# run the job of the command line arguments argv (default: sys.argv) in the daemon
+# connect is not used, the daemon connects to S3
+# returns the exit status of the job
+
+def main(argv=None, connect=None, prog=None):
+  parser = make_parser(prog)
+  args = parser.parse_args(argv)
+
+  if args.status:
+    request = { "command": "status" }
+  elif args.command == None:
+    parser.error("subcommand required")
+  else:
+    request = { "command": args.command, "args": args.args, "priority": args.priority, "stdin": not sys.stdin.isatty() }
+
+  # connect to the daemon and send the request, followed by stdin if the job reads it
+
+  connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    connection.connect(args.socket)
+  except socket.error as e:
+    print >> sys.stderr, "cannot reach s3daemon at", args.socket, ":", e
+    return 1
+  connection.sendall(json.dumps(request) + "\n")
+  if request.get("stdin"):
+    t = threading.Thread(target=_send_input, args=(connection,))
+    t.daemon = True
+    t.start()
+
+  # pass the answers of the daemon on until the job has finished
+
+  for line in connection.makefile("rb"):
+    answer = json.loads(line)
+    if "stdout" in answer:
+      sys.stdout.write(answer["stdout"].encode("latin-1"))
+    elif "stderr" in answer:
+      sys.stderr.write(answer["stderr"].encode("latin-1"))
+    elif "queued" in answer:
+      if answer["queued"]:
+        print >> sys.stderr, "job", answer["job"], "queued behind", answer["queued"], "jobs"
+    elif "status" in answer:
+      sys.stdout.flush()
+      return answer["status"]
+    elif "error" in answer:
+      print >> sys.stderr, "s3daemon refused the job:", answer["error"]
+      return 2
+    elif "jobs" in answer:
+      for job in answer["jobs"]:
+        print "job", job["job"], job["state"], "priority", job["priority"], ":", job["command"], " ".join(job["args"])
+      return 0
+  print >> sys.stderr, "s3daemon closed the connection before the job finished"
+  return 1
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# s3journal
+#
+# by Walter Graf
+#
+# crash-safe journal of completed deletes
+#
+# The journal is an append-only file of 8 byte records, one per deleted
+# (bucket, object, version_id), each record holding a 64 bit hash of the
+# triple. Completed deletes are appended batch by batch and synced to disk
+# at most once per sync interval (group commit). Records lost in a crash only
+# cause the respective versions to be deleted again, which is harmless as
+# deletes address exact version ids.
+#
+# When a journal is opened its records are loaded into a hashed index:
+# 65536 sorted arrays of 64 bit hashes selected by the top 16 bits of the
+# hash. The index needs about 8 bytes per record, i.e. 80 MB for 10 million
+# deletes, and is looked up with a binary search.
+# The index relies on array typecode "L" being 64 bits wide, which is the
+# case on 64 bit Linux.
+#
+# VerifyJournal records verified versions the same way, keyed by
+# (bucket, object, version_id, etag) so that a version whose ETag changes is
+# verified again.
+
+import os
+import time
+import struct
+import hashlib
+import array
+import bisect
+
+# minimum number of seconds between two syncs of the journal
+S3_JOURNAL_SYNC_INTERVAL = 1.0
+
+S3_JOURNAL_RECORD_SIZE = 8
+S3_JOURNAL_INDEX_BITS = 16
+
+# 64 bit hash of a deleted version, or of a verified version including its etag
+
+def version_hash(bucket, name, version_id, etag=None):
+  parts = [ p.encode("utf-8") if isinstance(p, unicode) else p for p in (bucket, name, version_id) + ((etag,) if etag != None else ()) ]
+  key = "\0".join(parts)
+  return struct.unpack(">Q", hashlib.md5(key).digest()[:S3_JOURNAL_RECORD_SIZE])[0]
+
+class DeleteJournal(object):
+
+  def __init__(self, path, sync_interval=S3_JOURNAL_SYNC_INTERVAL):
+    self.path = path
+    self.sync_interval = sync_interval
+    self.index = [ None ] * (1 << S3_JOURNAL_INDEX_BITS)
+    self.loaded = 0
+    if os.path.exists(path):
+      self._load()
+    self.file = open(path, "ab")
+
+    # cut off a torn record so that new records stay aligned
+
+    size = os.path.getsize(path)
+    if size % S3_JOURNAL_RECORD_SIZE:
+      self.file.truncate(size - size % S3_JOURNAL_RECORD_SIZE)
+    self.synced = time.time()
+
+  # True if the delete of this version has been journaled by a previous run
+
+  def done(self, bucket, name, version_id):
+    return self._contains(version_hash(bucket, name, version_id))
+
+  # append completed deletes, versions is a sequence of (name, version_id, ...) tuples
+
+  def record(self, bucket, versions):
+    self._append([ version_hash(bucket, v[0], v[1]) for v in versions ])
+
+  def _contains(self, h):
+    a = self.index[h >> (64 - S3_JOURNAL_INDEX_BITS)]
+    if a is None:
+      return False
+    i = bisect.bisect_left(a, h)
+    return i < len(a) and a[i] == h
+
+  def _append(self, hashes):
+    self.file.write("".join([ struct.pack(">Q", h) for h in hashes ]))
+    if time.time() - self.synced >= self.sync_interval:
+      self.sync()
+
+  def sync(self):
+    self.file.flush()
+    os.fsync(self.file.fileno())
+    self.synced = time.time()
+
+  def close(self):
+    self.sync()
+    self.file.close()
+
+  # read the journal into the index, a torn record at the end of the file is ignored
+
+  def _load(self):
+    buckets = {}
+    shift = 64 - S3_JOURNAL_INDEX_BITS
+    with open(self.path, "rb") as f:
+      while True:
+        data = f.read(S3_JOURNAL_RECORD_SIZE * 65536)
+        n = len(data) // S3_JOURNAL_RECORD_SIZE
+        if n == 0:
+          break
+        for h in struct.unpack(">%dQ" % n, data[:n * S3_JOURNAL_RECORD_SIZE]):
+          b = h >> shift
+          a = buckets.get(b)
+          if a is None:
+            a = buckets[b] = array.array("L")
+          a.append(h)
+        if len(data) < S3_JOURNAL_RECORD_SIZE * 65536:
+          break
+    for b, a in buckets.items():
+      self.index[b] = array.array("L", sorted(set(a)))
+      self.loaded += len(self.index[b])
+
+class VerifyJournal(DeleteJournal):
+
+  # True if this version has been verified by a previous run
+
+  def done(self, bucket, name, version_id, etag):
+    return self._contains(version_hash(bucket, name, version_id, etag or ""))
+
+  # append verified versions, versions is a sequence of (name, version_id, etag) tuples
+
+  def record(self, bucket, versions):
+    self._append([ version_hash(bucket, v[0], v[1], v[2] or "") for v in versions ])
@@ -6,131 +6,130 @@
 # by Walter Graf
 #
 # usage: s3lisdv.py [-h] [-c s3-config-file] [--output csv-file-output]
-#                  [--before yyyy-mm-ddThh:mm:ss] [--prefix object-prefix]
-#                  bucket-name
+#                   [--prefix object-prefix] [--before yyyy-mm-ddThh:mm:ss]
+#                   [--shards shards] [--split-at object-name]
+#                   [--delimiter delimiter] [--workers workers]
+#                   [--processes processes] [--catalog [catalog-file]]
+#                   [--checkpoint checkpoint-file] [--resume]
+#                   [--format {csv,binary}] [--compress] [--delete]
+#                   [--batch-size batch-size] [--delete-workers workers]
+#                   [--meta key=value] [--meta-cache cache-file]
+#                   [--head-workers workers] [--verbose]
+#                   [--backend {boto,async}] [--retries retries]
+#                   [--max-rate requests-per-sec] [--stats]
+#                   [--stats-file stats-file] [--stats-format {prometheus,json}]
+#                   bucket-name [bucket-name ...]
 #
 # list all versions of a deleted object for a particular bucket
 #
 # positional arguments:
-#   bucket-name           name of bucket
+#   bucket-name           name of bucket, several names or patterns like
+#                         'logs-*' process several buckets ('*' all buckets)
 #
 # optional arguments:
 #   -h, --help            show this help message and exit
 #   -c s3-config-file     use this S3 configuration file (default:
 #                         $HOME/s3versioning.cnf)
 #   --output csv-file-output, -o csv-file-output
-#                         write csv output to this file (default: stdout)
-#   --before yyyy-mm-ddThh:mm:ss
-#                         only list objects deleted before this time
+#                         write csv output to this file (default: stdout, none
+#                         with --delete)
 #   --prefix object-prefix
 #                         only list objects starting with this prefix
+#   --before yyyy-mm-ddThh:mm:ss
+#                         only list objects deleted before this time
+#   --shards shards       split the listing into this many key ranges at common
+#                         prefixes and list them in parallel (default: 1)
+#   --split-at object-name
+#                         split the listing after this object name instead of at
+#                         common prefixes (may be repeated)
+#   --delimiter delimiter
+#                         delimiter used to discover common prefixes (default:
+#                         /)
+#   --workers workers     list this many key ranges in parallel, each using its
+#                         own S3 connection (default: 4)
+#   --processes processes
+#                         process this many of several buckets at a time, each
+#                         in a process of its own (default: 4)
+#   --catalog [catalog-file]
+#                         read the versions from this catalog maintained by
+#                         s3sync instead of listing the bucket (default:
+#                         $HOME/s3versioning.db)
+#   --checkpoint checkpoint-file
+#                         regularly record the listing progress in this file
+#                         (requires --output)
+#   --resume              resume the listing recorded in the checkpoint file
+#   --format {csv,binary}
+#                         write the versions in this format (default: csv)
+#   --compress            compress binary output
+#   --delete              delete the selected versions while listing, the output
+#                         is then a record of the deleted versions
+#   --batch-size batch-size
+#                         number of versions per multi-object delete request, 1
+#                         disables multi-object deletes (default: 1000)
+#   --delete-workers workers
+#                         delete versions with this many parallel workers, each
+#                         using its own S3 connection (default: 1)
+#   --meta key=value      only select versions with this user defined metadata,
+#                         read with a HEAD request per version (may be repeated)
+#   --meta-cache cache-file
+#                         keep the metadata read in this file, so that it is
+#                         only read once per version (default:
+#                         $HOME/s3metadata.db)
+#   --head-workers workers
+#                         read metadata with this many parallel workers, each
+#                         using its own S3 connection (default: 16)
+#   --verbose, -v         log every selected version to stderr
+#   --backend {boto,async}
+#                         send the S3 requests through boto's connections or the
+#                         event loop of s3async (default: boto)
+#   --retries retries     retry throttled or failed S3 requests this many times
+#                         (default: 8)
+#   --max-rate requests-per-sec
+#                         never send more than this many S3 requests per second
+#   --stats               print request and pipeline statistics to stderr at
+#                         exit
+#   --stats-file stats-file
+#                         write request and pipeline statistics to this file at
+#                         exit
+#   --stats-format {prometheus,json}
+#                         format of the statistics file (default: prometheus)
 
 import sys
-import os
-import argparse
-import ConfigParser
 import time
-import boto
-import boto.s3.connection
-import csv
-import s3version
-
-mod_time_in_sec = lambda s : time.mktime(time.strptime(s[0:s.find(".")],"%Y-%m-%dT%H:%M:%S"))
- 
-# parse command line arguments
-
-parser = argparse.ArgumentParser(description = "list all versions of a deleted object for a particular bucket")
-parser.add_argument("bucket", metavar="bucket-name", help="name of bucket")
-parser.add_argument("-c", dest="s3_conf", metavar="s3-config-file", default=s3version.S3_CONF, help="use this S3 configuration file (default: %(default)s)")
-parser.add_argument("--output", "-o", metavar="csv-file-output", type=argparse.FileType("wb"), default=sys.stdout, help="write csv output to this file (default: stdout)")
-parser.add_argument("--before", metavar="yyyy-mm-ddThh:mm:ss", help="only list objects deleted before this time")
-parser.add_argument("--prefix", metavar="object-prefix", help="only list objects starting with this prefix")
-args = parser.parse_args()
-
-s3_conf = args.s3_conf
-bucket_name = args.bucket
-if args.before == None:
-  before_sec = time.time()
-else:
-  before_sec = time.mktime(time.strptime(args.before,"%Y-%m-%dT%H:%M:%S"))
-prefix = args.prefix
-output = args.output
-
-# parse config file
-
-cnf = ConfigParser.RawConfigParser()
-cnf.read(s3_conf)
-
-access = cnf.get("connect", "access")
-secret = cnf.get("connect", "secret")
-host = cnf.get("connect", "host")
-port = cnf.getint("connect", "port")
-is_secure = cnf.getboolean("connect", "is_secure")
-
-# establish S3 connection
-
-s3 = boto.connect_s3(
-  aws_access_key_id = access,
-  aws_secret_access_key = secret,
-  host = host,
-  port = port,
-  is_secure = is_secure,
-  calling_format = boto.s3.connection.OrdinaryCallingFormat()
-  )
+import s3select
+import s3listing
 
-# prepare csv output
+# command line arguments
 
-csv_dict = {}
-csv_writer = csv.DictWriter(output, s3version.S3_CSV_KEYS, delimiter=",", quotechar='"')
+def add_arguments(parser):
+  parser.add_argument("--before", metavar="yyyy-mm-ddThh:mm:ss", help="only list objects deleted before this time")
 
-#csv_writer.writeheader()
-for k in s3version.S3_CSV_KEYS:
-  csv_dict[k] = k
-csv_writer.writerow(csv_dict)
+def make_parser(prog=None):
+  return s3listing.make_parser(prog, "list all versions of a deleted object for a particular bucket", add_arguments)
 
-# list all versions of deleted objects in bucket according to optional criteria
+# list deleted object versions as asked for by the command line arguments argv (default: sys.argv)
+# connect opens the S3 connections instead of the S3 configuration file
+# returns the exit status, the highest one of the buckets if there are several
 
-bucket = s3.get_bucket(bucket_name)
-csv_dict["bucket"] = bucket_name
+def main(argv=None, connect=None, prog=None):
+  parser = make_parser(prog)
+  args = parser.parse_args(argv)
 
-# loop over all object versions
-# please note the extra logic because get_all_versions() can only handle 1000 versions at a time
-# skip objects deleted after or equal specified time (mod_time >= before_sec)
-# populate csv_dict and write to csv file
+  if args.before == None:
+    before_sec = time.time()
+  else:
+    before_sec = time.mktime(time.strptime(args.before,"%Y-%m-%dT%H:%M:%S"))
 
-# to handle pagination
-last_name = None
-last_version_id = None
+  # list all versions of deleted objects in bucket according to optional criteria
+  # skip objects deleted after or equal specified time (mod_time >= before_sec)
 
-# to handle all versions belonging to one name
-current_name = None
+  def make_selector():
+    return s3select.DeletedSelector(before_sec)
 
-while True:
-  versions = bucket.get_all_versions(prefix= prefix, key_marker=last_name, version_id_marker=last_version_id)
+  def catalog_versions(catalog, bucket_name, prefix):
+    return catalog.versions(bucket_name, prefix, deleted_before=time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(before_sec)))
 
-  for v in versions:
-    if v.name != current_name:
-      selected = False
-      current_name = v.name
-    has_del_marker = type(v) == boto.s3.deletemarker.DeleteMarker
-    is_deleted = has_del_marker and v.is_latest
-    if is_deleted and mod_time_in_sec(v.last_modified) < before_sec:
-      selected = True
-    if selected:
-      print >> sys.stderr, "selected", v.name, v.version_id
-      csv_dict["object"] = v.name
-      csv_dict["version_id"] = v.version_id
-      csv_dict["mod_time"] = v.last_modified
-      if has_del_marker:
-        csv_dict["size"] = "0"
-        csv_dict["del_marker"] = "yes"
-      else:
-        csv_dict["size"] = str(v.size)
-        csv_dict["del_marker"] = "no"
-      csv_dict["is_latest"] = str(v.is_latest)
-      csv_writer.writerow(csv_dict)
-    last_name = v.name
-    last_version_id = v.version_id
+  return s3listing.run("s3lisdv", parser, args, make_selector, catalog_versions, connect)
 
-  if not versions.is_truncated:
-    break
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+# s3lister
+#
+# by Walter Graf
+#
+# version listing shared by the listing tools
+#
+# list_versions() yields all object versions of a bucket as s3record.Version
+# records in the order S3 lists them: by object name and within one object
+# newest version first.
+# Without split points the bucket is walked serially page by page.
+# With split points the key space is cut into shards, i.e. the key ranges
+# (None, s1], (s1, s2], ..., (sn, None), which are listed concurrently by
+# worker threads using their own S3 connections. As the shards are disjoint
+# and ordered, handing out the shards one after the other restores the
+# serial order. Bounded queues between the workers and the caller keep
+# memory flat.
+#
+# Split points can be supplied by the user or discovered from the common
+# prefixes below the listing prefix with discover_split_points().
+#
+# A listing can start after a given (name, version_id) marker and report
+# every completed page, which is what checkpointed listings resume from.
+#
+# The listing is planned to fetch as few pages as the selection allows:
+# - a shard between two object names only holds names starting with their
+#   common prefix, which narrows the prefix of its requests
+# - a skip function handed in by the caller tells from a version whether any
+#   of the following versions of the same object can still be selected, e.g.
+#   for s3lisdv an object whose latest version is no delete marker is decided
+#   by that version. The remaining versions of a decided object are dropped
+#   and, when a page ends within it, the next page is requested after the
+#   object (key marker without version id marker) instead of paging through
+#   its history.
+# The marker reported with each page is where the next page starts, so
+# checkpointed listings resume behind skipped objects as well.
+#
+# On the async backend (s3async) the request for the next page is sent as
+# soon as the last version of a page is known, before the page is handed to
+# the caller, so that the listing never waits for a page it could have
+# requested while the previous one was processed.
+
+import os
+import threading
+import Queue
+import s3record
+import s3stats
+
+# number of listing pages a shard worker may read ahead of the caller
+S3_SHARD_READ_AHEAD = 4
+
+# seconds a shard worker waits for room in its queue before checking whether the caller stopped
+S3_SHARD_POLL = 1.0
+
+# pages of versions within the key range (low, high], low and high may be None
+# start is an optional (name, version_id) marker within the range to start after
+# skip is an optional function telling whether the versions following a version of the same object can be skipped
+# yields (page, marker) pairs, marker is the (name, version_id) marker after the page
+
+def _list_pages(bucket, prefix, low, high, start=None, skip=None):
+  if start is None:
+    last_name = low
+    last_version_id = None
+  else:
+    last_name, last_version_id = start
+  prefix = _narrow(prefix, low, high)
+  skipped = None
+  fetch = s3record.request_page(bucket, prefix, last_name, last_version_id)
+  while fetch is not None:
+    versions = fetch()
+    fetch = None
+    page = []
+    dropped = 0
+    for v in versions:
+      if high is not None and v.name > high:
+        break
+      last_name = v.name
+      last_version_id = v.version_id
+      if v.name == skipped:
+        dropped += 1
+        continue
+      page.append(v)
+      if skip is not None and skip(v):
+        skipped = v.name
+    else:
+
+      # a page ending within a decided object continues after the object
+
+      if last_name == skipped:
+        last_version_id = None
+      if versions.is_truncated:
+        fetch = s3record.request_page(bucket, prefix, last_name, last_version_id)
+        if last_version_id is None:
+          s3stats.stats.event("marker_jump")
+    if dropped:
+      s3stats.stats.count("skipped", dropped)
+    if versions:
+      yield page, (last_name, last_version_id)
+
+# narrow the prefix of a listing to the common prefix of the names in (low, high]
+
+def _narrow(prefix, low, high):
+  if low is None or high is None:
+    return prefix
+  common = os.path.commonprefix([ low, high ])
+  if len(common) > len(prefix or "") and common.startswith(prefix or ""):
+    return common
+  return prefix
+
+# find split points dividing the listing into at most shards shards
+# the split points are chosen evenly among the common prefixes found one
+# delimiter level below prefix, so each shard covers whole "directories"
+
+def discover_split_points(bucket, prefix, shards, delimiter="/"):
+  if shards < 2:
+    return []
+  prefixes = []
+  key_marker = None
+  version_id_marker = None
+  while True:
+    versions = s3record.list_page(bucket, prefix, key_marker, version_id_marker, delimiter)
+    prefixes.extend(versions.prefixes)
+    if not versions.is_truncated:
+      break
+    key_marker = versions.next_key_marker
+    version_id_marker = versions.next_version_id_marker
+  split_points = []
+  for i in range(1, shards):
+    p = prefixes[i * len(prefixes) // shards] if prefixes else None
+    if p is not None and p not in split_points:
+      split_points.append(p)
+  return split_points
+
+# list all versions below prefix
+# bucket        bucket used for serial listing
+# split_points  object names to split the listing at (no split points means serial listing)
+# workers       number of shards listed in parallel
+# open_bucket   called once per shard, must return a bucket on a connection of its own
+# start         optional (name, version_id) marker to start the listing after
+# on_page       called with the (name, version_id) marker after each page once the caller has processed the page
+# skip          optional function of a version, true if no later version of the same object can be selected
+
+def list_versions(bucket, prefix=None, split_points=None, workers=1, open_bucket=None, start=None, on_page=None, skip=None):
+  if not split_points:
+    pages = _list_pages(bucket, prefix, None, None, start, skip)
+  else:
+    pages = _ShardedListing(open_bucket, prefix, split_points, workers, start, skip)
+  for page, marker in pages:
+    for v in page:
+      yield v
+    if on_page is not None:
+      on_page(marker)
+
+class _ShardedListing(object):
+
+  def __init__(self, open_bucket, prefix, split_points, workers, start=None, skip=None):
+    bounds = [None] + sorted(set(split_points)) + [None]
+    self.shards = [ (bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1) ]
+
+    # when starting after a marker, shards before the marker are dropped and the
+    # first remaining shard, which contains the marker, starts right after it
+
+    self.start = start
+    if start is not None:
+      self.shards = [ (low, high) for low, high in self.shards if high is None or high >= start[0] ]
+    self.open_bucket = open_bucket
+    self.prefix = prefix
+    self.skip = skip
+    self.slots = threading.Semaphore(max(1, workers))
+    self.queues = [ Queue.Queue(S3_SHARD_READ_AHEAD) for s in self.shards ]
+    self.stopped = False
+
+  # shard workers are started in key order and a slot is only released once the
+  # caller has consumed the shard, so the shard the caller is waiting for is
+  # always being listed and at most workers shards are buffered
+  # when the caller stops early or a shard fails, a slot is released to wake the
+  # starter, which is joined, and the queues are drained, so that no worker
+  # stays blocked on a queue nobody reads any more
+
+  def __iter__(self):
+    starter = threading.Thread(target=self._start_all)
+    starter.daemon = True
+    starter.start()
+    try:
+      for q in self.queues:
+        while True:
+          page = q.get()
+          if page is None:
+            break
+          if isinstance(page, Exception):
+            raise page
+          yield page
+        self.slots.release()
+    finally:
+      self.stopped = True
+      self.slots.release()
+      starter.join()
+      for q in self.queues:
+        try:
+          while True:
+            q.get_nowait()
+        except Queue.Empty:
+          pass
+
+  def _start_all(self):
+    for i in range(len(self.shards)):
+      self.slots.acquire()
+      if self.stopped:
+        return
+      t = threading.Thread(target=self._list_shard, args=(i,))
+      t.daemon = True
+      t.start()
+
+  def _list_shard(self, i):
+    low, high = self.shards[i]
+    q = self.queues[i]
+    try:
+      bucket = self.open_bucket()
+      for page in _list_pages(bucket, self.prefix, low, high, self.start if i == 0 else None, self.skip):
+        if not self._put(q, page):
+          return
+      self._put(q, None)
+    except Exception as e:
+      self._put(q, e)
+
+  # put item on q unless the caller stopped, returns whether it was put
+
+  def _put(self, q, item):
+    while not self.stopped:
+      try:
+        q.put(item, True, S3_SHARD_POLL)
+        return True
+      except Queue.Full:
+        pass
+    return False
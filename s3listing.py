@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+# s3listing
+#
+# by Walter Graf
+#
+# command line and listing run shared by the listing tools
+#
+# s3lisov, s3lisdv and s3listv only differ in how they select versions. Each
+# tool builds its parser with make_parser(), adding the arguments of its
+# selection criteria, and hands a selector (see s3select) and the matching
+# catalog query to run(), which does the rest for every bucket:
+# - read the versions from the catalog or list them from the bucket (s3lister)
+# - select them, optionally by user defined metadata too (s3metadata)
+# - write the selected versions (s3format) and delete them if asked for
+#   (s3pipeline)
+# - record the listing progress in a checkpoint and resume from it
+#   (s3checkpoint), the selector state included
+# Several buckets are processed in processes of their own (s3fanout).
+
+import sys
+import argparse
+import s3version
+import s3stats
+import s3connect
+import s3scheduler
+import s3log
+import s3format
+import s3lister
+import s3catalog
+import s3checkpoint
+import s3deleter
+import s3pipeline
+import s3metadata
+import s3fanout
+
+# command line arguments of a listing tool
+# add_arguments(parser) adds the arguments of the selection criteria of the tool
+# meta tells whether versions can be selected by user defined metadata
+
+def make_parser(prog, description, add_arguments, meta=True):
+  parser = argparse.ArgumentParser(prog = prog, description = description)
+  parser.add_argument("bucket", metavar="bucket-name", nargs="+", help="name of bucket, several names or patterns like 'logs-*' process several buckets ('*' all buckets)")
+  parser.add_argument("-c", dest="s3_conf", metavar="s3-config-file", default=s3version.S3_CONF, help="use this S3 configuration file (default: %(default)s)")
+  parser.add_argument("--output", "-o", metavar="csv-file-output", help="write csv output to this file (default: stdout, none with --delete)")
+  parser.add_argument("--prefix", metavar="object-prefix", help="only list objects starting with this prefix")
+  add_arguments(parser)
+  parser.add_argument("--shards", metavar="shards", type=int, default=1, help="split the listing into this many key ranges at common prefixes and list them in parallel (default: %(default)s)")
+  parser.add_argument("--split-at", metavar="object-name", action="append", help="split the listing after this object name instead of at common prefixes (may be repeated)")
+  parser.add_argument("--delimiter", metavar="delimiter", default="/", help="delimiter used to discover common prefixes (default: %(default)s)")
+  parser.add_argument("--workers", metavar="workers", type=int, default=4, help="list this many key ranges in parallel, each using its own S3 connection (default: %(default)s)")
+  parser.add_argument("--processes", metavar="processes", type=int, default=s3fanout.S3_FANOUT_PROCESSES, help="process this many of several buckets at a time, each in a process of its own (default: %(default)s)")
+  parser.add_argument("--catalog", metavar="catalog-file", nargs="?", const=s3version.S3_CATALOG, help="read the versions from this catalog maintained by s3sync instead of listing the bucket (default: %(const)s)")
+  parser.add_argument("--checkpoint", metavar="checkpoint-file", help="regularly record the listing progress in this file (requires --output)")
+  parser.add_argument("--resume", action="store_true", help="resume the listing recorded in the checkpoint file")
+  parser.add_argument("--format", choices=s3format.S3_FORMATS, default="csv", help="write the versions in this format (default: %(default)s)")
+  parser.add_argument("--compress", action="store_true", help="compress binary output")
+  parser.add_argument("--delete", action="store_true", help="delete the selected versions while listing, the output is then a record of the deleted versions")
+  parser.add_argument("--batch-size", metavar="batch-size", type=int, default=s3deleter.S3_MAX_DELETE_BATCH, help="number of versions per multi-object delete request, 1 disables multi-object deletes (default: %(default)s)")
+  parser.add_argument("--delete-workers", metavar="workers", type=int, default=1, help="delete versions with this many parallel workers, each using its own S3 connection (default: %(default)s)")
+  if meta:
+    parser.add_argument("--meta", metavar="key=value", action="append", help="only select versions with this user defined metadata, read with a HEAD request per version (may be repeated)")
+    parser.add_argument("--meta-cache", metavar="cache-file", default=s3version.S3_METADATA, help="keep the metadata read in this file, so that it is only read once per version (default: %(default)s)")
+    parser.add_argument("--head-workers", metavar="workers", type=int, default=16, help="read metadata with this many parallel workers, each using its own S3 connection (default: %(default)s)")
+  else:
+    parser.set_defaults(meta=None, meta_cache=None, head_workers=1)
+  parser.add_argument("--verbose", "-v", action="store_true", help="log every selected version to stderr")
+  parser.add_argument("--backend", choices=s3connect.S3_BACKENDS, default="boto", help="send the S3 requests through boto's connections or the event loop of s3async (default: %(default)s)")
+  parser.add_argument("--retries", metavar="retries", type=int, default=s3scheduler.S3_SCHEDULER_RETRIES, help="retry throttled or failed S3 requests this many times (default: %(default)s)")
+  parser.add_argument("--max-rate", metavar="requests-per-sec", type=float, help="never send more than this many S3 requests per second")
+  parser.add_argument("--stats", action="store_true", help="print request and pipeline statistics to stderr at exit")
+  parser.add_argument("--stats-file", metavar="stats-file", help="write request and pipeline statistics to this file at exit")
+  parser.add_argument("--stats-format", choices=s3stats.S3_STATS_FORMATS, default="prometheus", help="format of the statistics file (default: %(default)s)")
+  return parser
+
+# list the versions selected by the selectors of make_selector() as asked for by args, parsed by parser
+# tool         name of the tool, used for the statistics
+# make_selector  called once per bucket, must return a new selector (see s3select)
+# catalog_versions  called as catalog_versions(catalog, bucket_name, prefix) when reading from a catalog,
+#              must return the versions of the catalog the selector can select from
+# connect      opens the S3 connections instead of the S3 configuration file
+# label        what the selected versions are logged as with --verbose
+# returns the exit status, the highest one of the buckets if there are several
+
+def run(tool, parser, args, make_selector, catalog_versions, connect=None, label="selected"):
+
+  # record request and pipeline statistics if asked for, they are reported at exit
+
+  s3stats.setup(tool, args.stats, args.stats_file, args.stats_format)
+
+  # retry failed requests and adapt the number of requests in flight to the endpoint
+
+  if args.retries < 0:
+    parser.error("number of retries must not be negative")
+  if args.max_rate != None and args.max_rate <= 0:
+    parser.error("maximum request rate must be positive")
+  s3scheduler.setup(args.retries, args.max_rate)
+
+  s3_conf = args.s3_conf
+  bucket_names = args.bucket
+  prefix = args.prefix
+  output_file = args.output
+  shards = args.shards
+  split_at = args.split_at
+  delimiter = args.delimiter
+  workers = args.workers
+  processes = args.processes
+  catalog_file = args.catalog
+  checkpoint_file = args.checkpoint
+  resume = args.resume
+  format = args.format
+  compress = args.compress
+  delete = args.delete
+  batch_size = args.batch_size
+  delete_workers = args.delete_workers
+  head_workers = args.head_workers
+
+  if shards < 1:
+    parser.error("number of shards must be at least 1")
+  if processes < 1:
+    parser.error("number of processes must be at least 1")
+  if workers < 1:
+    parser.error("number of workers must be at least 1")
+  if delete_workers < 1:
+    parser.error("number of delete workers must be at least 1")
+  if head_workers < 1:
+    parser.error("number of head workers must be at least 1")
+  criteria = None
+  if args.meta:
+    try:
+      criteria = s3metadata.parse_criteria(args.meta)
+    except ValueError as e:
+      parser.error(str(e))
+  if batch_size < 1 or batch_size > s3deleter.S3_MAX_DELETE_BATCH:
+    parser.error("batch size must be between 1 and %d" % s3deleter.S3_MAX_DELETE_BATCH)
+  if checkpoint_file != None and output_file == None:
+    parser.error("--checkpoint requires --output")
+  if checkpoint_file != None and catalog_file != None:
+    parser.error("--checkpoint cannot be combined with --catalog")
+  if resume and checkpoint_file == None:
+    parser.error("--resume requires --checkpoint")
+
+  # parse config file and establish S3 connections, unless the caller hands over its own
+  # parallel listing workers each establish a connection of their own
+
+  if connect == None:
+    connect = s3connect.connector(s3connect.read_config(s3_conf), args.backend)
+
+  # resolve the bucket names and patterns
+
+  bucket_names = s3fanout.expand(connect, bucket_names)
+  if not bucket_names:
+    parser.error("no bucket matches %s" % " ".join(args.bucket))
+  fanned_out = len(bucket_names) > 1
+  if fanned_out and checkpoint_file != None:
+    parser.error("--checkpoint cannot be combined with several buckets")
+
+  # process one bucket, writing its versions to output_file (stdout if None)
+
+  def process(bucket_name, output_file):
+
+    # open catalog and make sure the prefix has been synchronized
+
+    if catalog_file != None:
+      catalog = s3catalog.Catalog(catalog_file)
+      synced = catalog.watermark(bucket_name, prefix)
+      if synced == None:
+        parser.error("prefix %r of bucket %s not found in catalog %s, run s3sync first" % (prefix or "", bucket_name, catalog_file))
+      print >> sys.stderr, "reading catalog", catalog_file, "synchronized at", synced
+
+    # load the checkpoint to resume from
+
+    checkpoint = None
+    resumed = None
+    if checkpoint_file != None:
+      checkpoint = s3checkpoint.Checkpoint(checkpoint_file)
+      if resume:
+        resumed = checkpoint.load()
+        if resumed == None:
+          parser.error("no checkpoint found in %s" % checkpoint_file)
+        if resumed["bucket"] != bucket_name or resumed["prefix"] != prefix:
+          parser.error("checkpoint %s belongs to a different listing" % checkpoint_file)
+        print >> sys.stderr, "resuming after", resumed["key_marker"], resumed["version_id_marker"]
+
+    s3 = connect()
+
+    # prepare output, a record of the deleted versions when deleting
+    # when resuming, drop the output written after the checkpoint and append to it
+
+    if output_file == None:
+      output = None if delete else sys.stdout
+    elif resumed != None:
+      output = open(output_file, "r+b")
+      output.seek(resumed["offset"])
+      output.truncate()
+    else:
+      output = open(output_file, "wb")
+
+    writer = None
+    if output != None:
+      writer = s3format.version_writer(output, bucket_name, format, compress, header = resumed == None and not fanned_out)
+
+    # select the versions according to the criteria of the tool
+    # the selector state is part of the checkpoint, so that a resumed listing carries on in the middle of an object
+
+    selector = make_selector()
+    if resumed != None and "selector" in resumed:
+      selector.restore(resumed["selector"])
+
+    # record the listing progress after each completed page, written to disk once the checkpoint is due
+    # all versions selected for deletion so far are deleted before the checkpoint is written
+
+    def save_checkpoint(marker):
+      if checkpoint.due():
+        if meta_filter != None:
+          for m in meta_filter.flush():
+            emit(m)
+        if stage != None:
+          stage.flush()
+        writer.flush()
+        checkpoint.save({ "bucket": bucket_name, "prefix": prefix, "key_marker": marker[0], "version_id_marker": marker[1], "offset": output.tell(), "selector": selector.state() }, [ output ])
+
+    if resumed != None:
+      start = (resumed["key_marker"], resumed["version_id_marker"])
+    else:
+      start = None
+
+    # delete the selected versions while listing if asked for
+    # the deletes run on a thread of their own in batches of batch_size versions, spread over delete_workers
+
+    def report_failure(name, version_id, code, message, v):
+      print >> sys.stderr, "failed to delete", name, version_id, ":", code, message
+
+    stage = None
+    if delete:
+      deleter = s3deleter.deleter(lambda: connect().get_bucket(bucket_name, validate=False), delete_workers, batch_size, report_failure)
+      stage = s3pipeline.DeleteStage(deleter)
+
+    # select by user defined metadata if asked for
+    # the metadata is read on head_workers threads and kept in the cache, selected versions are
+    # handed back in listing order once their metadata is known
+
+    meta_filter = None
+    if criteria != None:
+      meta_cache = s3metadata.MetadataCache(args.meta_cache)
+      meta_filter = s3metadata.MetadataFilter(lambda: connect().get_bucket(bucket_name, validate=False), head_workers, criteria, meta_cache)
+
+    # read the object versions from the catalog or list them from the bucket
+    # split the listing into shards, either at the specified object names or at common prefixes
+
+    if catalog_file != None:
+      versions = catalog_versions(catalog, bucket_name, prefix)
+    else:
+      bucket = s3.get_bucket(bucket_name)
+      if split_at:
+        split_points = split_at
+      else:
+        split_points = s3lister.discover_split_points(bucket, prefix, shards, delimiter)
+      open_bucket = lambda: connect().get_bucket(bucket_name, validate=False)
+      versions = s3lister.list_versions(bucket, prefix, split_points, workers, open_bucket, start, save_checkpoint if checkpoint != None else None, selector.skip_rest)
+
+    # loop over all object versions
+    # s3lister takes care of pagination when listing the bucket because get_all_versions() can only handle 1000 versions at a time
+    # skip versions not selected by the selector
+    # skip versions without the user defined metadata asked for (meta_filter)
+    # write selected versions to output
+
+    # log selected versions only if asked for, timing the pipeline stages if statistics are recorded
+
+    log = None
+    if args.verbose:
+      log = s3log.VersionLog()
+    select = s3stats.timed_call(selector.select, "select")
+    write = None
+    if writer != None:
+      write = s3stats.timed_call(writer.write, "write", "selected")
+    put = None
+    if stage != None:
+      put = s3stats.timed_call(stage.put, "queue", "selected" if write == None else None)
+
+    def emit(v):
+      if log != None:
+        log.write(label, v.name, v.version_id)
+      if write != None:
+        write(v)
+      if put != None:
+        put(v)
+
+    match = None
+    if meta_filter != None:
+      match = s3stats.timed_call(meta_filter.add, "meta")
+
+    for v in s3stats.timed(versions, "list", "listed"):
+      if not select(v):
+        continue
+      if match != None:
+        for m in match(v):
+          emit(m)
+      else:
+        emit(v)
+
+    # the listing and the deletes are complete, the checkpoint is no longer needed
+
+    if meta_filter != None:
+      for m in s3stats.timed_call(meta_filter.close, "meta")():
+        emit(m)
+      meta_cache.close()
+      print >> sys.stderr, "read metadata of", meta_filter.requests + meta_filter.cached, "versions,", meta_filter.cached, "from cache,", meta_filter.failed, "failed,", meta_filter.requests, "head requests,", meta_filter.matched, "matched"
+      for code, count in sorted(meta_filter.errors.items()):
+        print >> sys.stderr, "  ", count, "x", code
+    if writer != None:
+      writer.flush()
+    if log != None:
+      log.close()
+    if stage != None:
+      s3stats.timed_call(stage.close, "delete")()
+      s3stats.stats.count("deleted", stage.deleted)
+      s3stats.stats.count("failed", stage.failed)
+      print >> sys.stderr, "deleted", stage.deleted, "versions,", stage.failed, "failed,", stage.requests, "delete requests"
+      for code, count in sorted(stage.errors.items()):
+        print >> sys.stderr, "  ", count, "x", code
+    if checkpoint != None:
+      checkpoint.remove()
+    return 0
+
+  # several buckets are processed in processes of their own (see s3fanout), their versions
+  # are merged into one output
+
+  if fanned_out:
+    return s3fanout.run(bucket_names, processes, output_file, None if output_file == None and delete else format, compress, process)
+  return process(bucket_names[0], output_file)
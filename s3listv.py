@@ -7,125 +7,116 @@
 #
 # usage: s3listv.py [-h] [-c s3-config-file] [--output csv-file-output]
 #                   [--prefix object-prefix] [--version-limit version-limit]
-#                   bucket-name
+#                   [--shards shards] [--split-at object-name]
+#                   [--delimiter delimiter] [--workers workers]
+#                   [--processes processes] [--catalog [catalog-file]]
+#                   [--checkpoint checkpoint-file] [--resume]
+#                   [--format {csv,binary}] [--compress] [--delete]
+#                   [--batch-size batch-size] [--delete-workers workers]
+#                   [--verbose] [--backend {boto,async}] [--retries retries]
+#                   [--max-rate requests-per-sec] [--stats]
+#                   [--stats-file stats-file] [--stats-format {prometheus,json}]
+#                   bucket-name [bucket-name ...]
 #
 # list truncated versions for a particular bucket
 #
 # positional arguments:
-#   bucket-name           name of bucket
+#   bucket-name           name of bucket, several names or patterns like
+#                         'logs-*' process several buckets ('*' all buckets)
 #
 # optional arguments:
 #   -h, --help            show this help message and exit
 #   -c s3-config-file     use this S3 configuration file (default:
 #                         $HOME/s3versioning.cnf)
 #   --output csv-file-output, -o csv-file-output
-#                         write csv output to this file (default: stdout)
+#                         write csv output to this file (default: stdout, none
+#                         with --delete)
 #   --prefix object-prefix
 #                         only list objects starting with this prefix
 #   --version-limit version-limit
 #                         list all versions exceeding the specified limit
+#   --shards shards       split the listing into this many key ranges at common
+#                         prefixes and list them in parallel (default: 1)
+#   --split-at object-name
+#                         split the listing after this object name instead of at
+#                         common prefixes (may be repeated)
+#   --delimiter delimiter
+#                         delimiter used to discover common prefixes (default:
+#                         /)
+#   --workers workers     list this many key ranges in parallel, each using its
+#                         own S3 connection (default: 4)
+#   --processes processes
+#                         process this many of several buckets at a time, each
+#                         in a process of its own (default: 4)
+#   --catalog [catalog-file]
+#                         read the versions from this catalog maintained by
+#                         s3sync instead of listing the bucket (default:
+#                         $HOME/s3versioning.db)
+#   --checkpoint checkpoint-file
+#                         regularly record the listing progress in this file
+#                         (requires --output)
+#   --resume              resume the listing recorded in the checkpoint file
+#   --format {csv,binary}
+#                         write the versions in this format (default: csv)
+#   --compress            compress binary output
+#   --delete              delete the selected versions while listing, the output
+#                         is then a record of the deleted versions
+#   --batch-size batch-size
+#                         number of versions per multi-object delete request, 1
+#                         disables multi-object deletes (default: 1000)
+#   --delete-workers workers
+#                         delete versions with this many parallel workers, each
+#                         using its own S3 connection (default: 1)
+#   --verbose, -v         log every selected version to stderr
+#   --backend {boto,async}
+#                         send the S3 requests through boto's connections or the
+#                         event loop of s3async (default: boto)
+#   --retries retries     retry throttled or failed S3 requests this many times
+#                         (default: 8)
+#   --max-rate requests-per-sec
+#                         never send more than this many S3 requests per second
+#   --stats               print request and pipeline statistics to stderr at
+#                         exit
+#   --stats-file stats-file
+#                         write request and pipeline statistics to this file at
+#                         exit
+#   --stats-format {prometheus,json}
+#                         format of the statistics file (default: prometheus)
 
 import sys
-import os
-import argparse
-import ConfigParser
-import time
-import boto
-import boto.s3.connection
-import csv
-import s3version
+import s3select
+import s3listing
 
-# parse command line arguments
+# command line arguments
 
-parser = argparse.ArgumentParser(description = "list truncated versions for a particular bucket")
-parser.add_argument("bucket", metavar="bucket-name", help="name of bucket")
-parser.add_argument("-c", dest="s3_conf", metavar="s3-config-file", default=s3version.S3_CONF, help="use this S3 configuration file (default: %(default)s)")
-parser.add_argument("--output", "-o", metavar="csv-file-output", type=argparse.FileType("wb"), default=sys.stdout, help="write csv output to this file (default: stdout)")
-parser.add_argument("--prefix", metavar="object-prefix", help="only list objects starting with this prefix")
-parser.add_argument("--version-limit", metavar="version-limit", help="list all versions exceeding the specified limit")
-args = parser.parse_args()
+def add_arguments(parser):
+  parser.add_argument("--version-limit", metavar="version-limit", help="list all versions exceeding the specified limit")
 
-s3_conf = args.s3_conf
-bucket_name = args.bucket
-prefix = args.prefix
-output = args.output
-version_limit = int(args.version_limit)
+def make_parser(prog=None):
+  return s3listing.make_parser(prog, "list truncated versions for a particular bucket", add_arguments, meta=False)
 
-# parse config file
+# list the versions exceeding a version limit as asked for by the command line arguments argv
+# (default: sys.argv), connect opens the S3 connections instead of the S3 configuration file
+# returns the exit status, the highest one of the buckets if there are several
 
-cnf = ConfigParser.RawConfigParser()
-cnf.read(s3_conf)
+def main(argv=None, connect=None, prog=None):
+  parser = make_parser(prog)
+  args = parser.parse_args(argv)
 
-access = cnf.get("connect", "access")
-secret = cnf.get("connect", "secret")
-host = cnf.get("connect", "host")
-port = cnf.getint("connect", "port")
-is_secure = cnf.getboolean("connect", "is_secure")
+  version_limit = int(args.version_limit)
 
-# establish S3 connection
+  # list object versions in bucket exceeding the specified version limit
+  # count versions
+  # do not count delete markers
+  # for all versions beyond version limit write to output
 
-s3 = boto.connect_s3(
-  aws_access_key_id = access,
-  aws_secret_access_key = secret,
-  host = host,
-  port = port,
-  is_secure = is_secure,
-  calling_format = boto.s3.connection.OrdinaryCallingFormat()
-  )
+  def make_selector():
+    return s3select.TruncationSelector(version_limit)
 
-# prepare csv output
+  def catalog_versions(catalog, bucket_name, prefix):
+    return catalog.versions(bucket_name, prefix, version_limit=version_limit)
 
-csv_dict = {}
-csv_writer = csv.DictWriter(output, s3version.S3_CSV_KEYS, delimiter=",", quotechar='"')
+  return s3listing.run("s3listv", parser, args, make_selector, catalog_versions, connect, "selected for truncation")
 
-#csv_writer.writeheader()
-for k in s3version.S3_CSV_KEYS:
-  csv_dict[k] = k
-csv_writer.writerow(csv_dict)
-
-# list object versions in bucket exceeding the specified version limit
-
-bucket = s3.get_bucket(bucket_name)
-csv_dict["bucket"] = bucket_name
-
-# loop over all object versions matching the specified prefix
-# please note the extra logic because get_all_versions() can only handle 1000 versions at a time
-# count versions
-# do not count delete markers
-# for all versions beyond version limit populate csv_dict and write to csv file
-
-# to handle pagination
-last_name = None
-last_version_id = None
-
-# to handle correct version count
-current_name = None
-
-while True:
-  versions = bucket.get_all_versions(prefix= prefix, key_marker=last_name, version_id_marker=last_version_id)
-
-  for v in versions:
-    if v.name != current_name:
-      vcount = 0
-      current_name = v.name
-    has_no_del_marker = type(v) != boto.s3.deletemarker.DeleteMarker
-    if has_no_del_marker:
-      vcount += 1
-    if vcount > version_limit:
-      print >> sys.stderr, "selected for truncation", v.name, v.version_id
-      csv_dict["object"] = v.name
-      csv_dict["version_id"] = v.version_id
-      csv_dict["mod_time"] = v.last_modified
-      if has_no_del_marker:
-        csv_dict["size"] = str(v.size)
-        csv_dict["del_marker"] = "no"
-      else:
-        csv_dict["size"] = "0"
-        csv_dict["del_marker"] = "yes"
-      csv_dict["is_latest"] = str(v.is_latest)
-      csv_writer.writerow(csv_dict)
-    last_name = v.name
-    last_version_id = v.version_id
-
-  if not versions.is_truncated:
-    break
+if __name__ == "__main__":
+  sys.exit(main())
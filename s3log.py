@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+# s3log
+#
+# by Walter Graf
+#
+# buffered log of the versions a tool processes
+#
+# Writing one line per version to stderr costs a system call per version and
+# throttles the listing and delete loops, so the tools only log versions
+# when asked to (--verbose) and then collect the lines and write them in
+# blocks. The log is flushed when the buffer is full, when it is closed and
+# at exit.
+
+import sys
+import atexit
+
+# number of lines collected before they are written
+S3_LOG_BUFFER_LINES = 1000
+
+def _utf8(s):
+  if isinstance(s, unicode):
+    return s.encode("utf-8")
+  return str(s)
+
+class VersionLog(object):
+
+  def __init__(self, output=sys.stderr, buffer_lines=S3_LOG_BUFFER_LINES):
+    self.output = output
+    self.buffer_lines = buffer_lines
+    self.lines = []
+    atexit.register(self.flush)
+
+  # log one line made of the space separated fields
+
+  def write(self, *fields):
+    self.lines.append(" ".join([ _utf8(f) for f in fields ]) + "\n")
+    if len(self.lines) >= self.buffer_lines:
+      self.flush()
+
+  def flush(self):
+    if self.lines:
+      self.output.write("".join(self.lines))
+      self.lines = []
+    self.output.flush()
+
+  def close(self):
+    self.flush()
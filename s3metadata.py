@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+# s3metadata
+#
+# by Walter Graf
+#
+# selection of object versions by user defined metadata
+#
+# Version listings do not include the user defined metadata (x-amz-meta-*),
+# it takes a HEAD request per version to read it. MetadataFilter sends these
+# requests from a pool of worker threads, each owning its own S3 connection,
+# while the listing goes on. The versions queue up in listing order and are
+# handed back in that order once their metadata is known, so the output of
+# the listing tools keeps the order of the listing. On the async backend
+# (s3async) the HEAD requests are sent from the event loop instead, with a
+# window of s3async.S3_ASYNC_WINDOW lookups in flight and no worker threads.
+#
+# The metadata of a version never changes, a version can only be deleted.
+# MetadataCache keeps the metadata read so far in a local SQLite database
+# keyed by bucket, object and version id, entries never have to be
+# invalidated. A repeated search of the same versions sends no HEAD requests.
+#
+# Delete markers have no metadata and never match.
+
+import sys
+import urllib
+import threading
+import Queue
+import collections
+import json
+import sqlite3
+import s3async
+
+# metadata lookups in flight per worker
+S3_METADATA_WINDOW = 4
+
+# number of cache entries collected before they are written in one transaction
+S3_METADATA_COMMIT_INTERVAL = 1000
+
+# seconds to wait for another process writing to the cache
+S3_METADATA_TIMEOUT = 60.0
+
+S3_METADATA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (
+  bucket TEXT NOT NULL,
+  object TEXT NOT NULL,
+  version_id TEXT NOT NULL,
+  metadata TEXT NOT NULL,
+  PRIMARY KEY (bucket, object, version_id)
+);
+"""
+
+# parse criteria given as key=value into a list of (key, value) tuples
+# S3 stores the keys of user defined metadata in lower case
+
+def parse_criteria(criteria):
+  parsed = []
+  for c in criteria:
+    key, sep, value = c.partition("=")
+    key = key.strip().lower()
+    if key.startswith("x-amz-meta-"):
+      key = key[len("x-amz-meta-"):]
+    if not sep or not key:
+      raise ValueError("metadata criterion %r is not of the form key=value" % c)
+    parsed.append((key, value.decode("utf-8")))
+  return parsed
+
+# several processes may share the cache (see s3fanout), new entries are therefore collected
+# and written in short transactions
+
+class MetadataCache(object):
+
+  def __init__(self, path):
+    self.db = sqlite3.connect(path, timeout=S3_METADATA_TIMEOUT)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.executescript(S3_METADATA_SCHEMA)
+    self.uncommitted = {}
+
+  # metadata of a version as dict, None if not cached
+
+  def get(self, bucket, name, version_id):
+    metadata = self.uncommitted.get((bucket, name, version_id))
+    if metadata != None:
+      return json.loads(metadata)
+    row = self.db.execute("SELECT metadata FROM metadata WHERE bucket = ? AND object = ? AND version_id = ?", (bucket, name, version_id)).fetchone()
+    if row == None:
+      return None
+    return json.loads(row[0])
+
+  def put(self, bucket, name, version_id, metadata):
+    self.uncommitted[(bucket, name, version_id)] = json.dumps(metadata, sort_keys=True)
+    if len(self.uncommitted) >= S3_METADATA_COMMIT_INTERVAL:
+      self.commit()
+
+  def commit(self):
+    if self.uncommitted:
+      with self.db:
+        self.db.executemany("INSERT OR REPLACE INTO metadata (bucket, object, version_id, metadata) VALUES (?, ?, ?, ?)", [ k + (m,) for k, m in self.uncommitted.items() ])
+      self.uncommitted = {}
+
+  def close(self):
+    self.commit()
+    self.db.close()
+
+# a metadata lookup by a worker
+
+class _Lookup(object):
+
+  __slots__ = ("done", "metadata", "error", "cached")
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.metadata = None
+    self.error = None
+    self.cached = False
+
+class MetadataFilter(object):
+
+  # open_bucket  called once per worker, must return a bucket on a connection of its own
+  # workers      number of worker threads
+  # criteria     list of (key, value), a version matches if its metadata has all of them
+  # cache        MetadataCache or None, only used by the caller's thread
+
+  def __init__(self, open_bucket, workers, criteria, cache=None):
+    if workers < 1:
+      raise ValueError("number of workers must be at least 1")
+    self.criteria = criteria
+    self.cache = cache
+    self.window = workers * S3_METADATA_WINDOW
+    self.queue = Queue.Queue()
+    self.pending = collections.deque()
+    self.matched = 0
+    self.cached = 0
+    self.failed = 0
+    self.requests = 0
+    self.errors = {}
+
+    # connections are opened up front so that connection problems surface in the caller
+    # on the async backend the lookups are sent by its client
+
+    self.buckets = [ open_bucket() ]
+    self.bucket_name = self.buckets[0].name
+    self.client = s3async.client_of(self.buckets[0])
+    if self.client != None:
+      self.window = s3async.S3_ASYNC_WINDOW
+      workers = 0
+    self.buckets += [ open_bucket() for i in range(workers - 1) ]
+    self.threads = []
+    for b in self.buckets:
+      t = threading.Thread(target=self._work, args=(b,))
+      t.daemon = True
+      t.start()
+      self.threads.append(t)
+
+  # queue version v, returns the versions queued earlier that turned out to match, in order
+  # blocks while window lookups are in flight
+
+  def add(self, v):
+    if v.del_marker:
+      return []
+    lookup = _Lookup()
+    if self.cache != None:
+      lookup.metadata = self.cache.get(self.bucket_name, v.name, v.version_id)
+    if lookup.metadata != None:
+      lookup.cached = True
+      lookup.done.set()
+      self.cached += 1
+    elif self.client != None:
+      self.requests += 1
+      self.client.submit("HEAD", self.bucket_name, v.name, query_args="versionId=" + urllib.quote(v.version_id, safe=""), callback=lambda request: self._looked_up(request, lookup))
+    else:
+      self.requests += 1
+      self.queue.put((v.name, v.version_id, lookup))
+    self.pending.append((v, lookup))
+    matched = []
+    while len(self.pending) > self.window:
+      self._consume(matched)
+    return matched
+
+  # wait for all lookups, returns the remaining matching versions in order
+
+  def flush(self):
+    matched = []
+    while self.pending:
+      self._consume(matched)
+    if self.cache != None:
+      self.cache.commit()
+    return matched
+
+  # stop the workers, returns the remaining matching versions in order
+
+  def close(self):
+    matched = self.flush()
+    for t in self.threads:
+      self.queue.put(None)
+    for t in self.threads:
+      t.join()
+    return matched
+
+  def _consume(self, matched):
+    v, lookup = self.pending.popleft()
+    lookup.done.wait()
+    if lookup.error != None:
+      code, message = lookup.error
+      self.failed += 1
+      self.errors[code] = self.errors.get(code, 0) + 1
+      print >> sys.stderr, "failed to read metadata of", v.name, v.version_id, ":", code, message
+      return
+    if lookup.metadata == None:
+      return # deleted since it was listed
+    if self.cache != None and not lookup.cached:
+      self.cache.put(self.bucket_name, v.name, v.version_id, lookup.metadata)
+    for key, value in self.criteria:
+      if lookup.metadata.get(key) != value:
+        return
+    self.matched += 1
+    matched.append(v)
+
+  def _work(self, bucket):
+    import boto.exception
+    while True:
+      item = self.queue.get()
+      if item is None:
+        break
+      name, version_id, lookup = item
+      try:
+        key = bucket.get_key(name, version_id=version_id)
+        if key != None:
+          lookup.metadata = dict(key.metadata)
+      except boto.exception.S3ResponseError as e:
+        lookup.error = (e.error_code or str(e.status), e.message or e.reason)
+      except Exception as e:
+        lookup.error = (e.__class__.__name__, str(e))
+      lookup.done.set()
+
+  # the HEAD request of lookup is done, called from the event loop of the async backend
+
+  def _looked_up(self, request, lookup):
+    import boto.utils
+    if request.error != None:
+      lookup.error = (request.error.__class__.__name__, str(request.error))
+    elif request.response.status == 200:
+      lookup.metadata = boto.utils.get_aws_metadata(request.response.msg, self.buckets[0].connection.provider)
+    elif request.response.status != 404:
+      lookup.error = s3async.error(request.response)
+    lookup.done.set()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+# s3pipeline
+#
+# by Walter Graf
+#
+# streaming hand-over of listed versions to a deleter
+#
+# A DeleteStage runs a deleter (s3deleter.VersionDeleter or ParallelDeleter)
+# in a thread of its own, fed through a bounded queue. The listing tools put
+# the versions they select into the stage while the listing goes on, so the
+# deletes overlap with the listing and the versions never take the round
+# trip through a csv file and s3delov. Once the queue is full the listing
+# waits for the deletes, which keeps memory flat for any number of versions.
+#
+# Versions are handed over in chunks to keep the locking off the hot loop.
+
+import sys
+import threading
+import Queue
+
+# number of versions per chunk and maximum number of chunks waiting in the queue
+S3_PIPELINE_CHUNK = 100
+S3_PIPELINE_QUEUE = 100
+
+_FLUSH = "flush"
+
+class DeleteStage(object):
+
+  # deleter      s3deleter.VersionDeleter or ParallelDeleter, only used by the stage's thread
+
+  def __init__(self, deleter, chunk_size=S3_PIPELINE_CHUNK, queue_size=S3_PIPELINE_QUEUE):
+    self.deleter = deleter
+    self.chunk_size = chunk_size
+    self.queue = Queue.Queue(queue_size)
+    self.pending = []
+    self.error = None
+    self.thread = threading.Thread(target=self._work)
+    self.thread.daemon = True
+    self.thread.start()
+
+  # queue version v for deletion from the bucket of the deleter, blocks while the queue is full
+
+  def put(self, v):
+    self.pending.append(v)
+    if len(self.pending) >= self.chunk_size:
+      self.queue.put(self.pending)
+      self.pending = []
+
+  # wait until all versions queued so far have been deleted
+
+  def flush(self):
+    if self.pending:
+      self.queue.put(self.pending)
+      self.pending = []
+    self.queue.put(_FLUSH)
+    self.queue.join()
+    self._check()
+
+  # delete all queued versions and stop the stage
+
+  def close(self):
+    if self.pending:
+      self.queue.put(self.pending)
+      self.pending = []
+    self.queue.put(None)
+    self.thread.join()
+    self._check()
+
+  # the statistics of the deleter, complete after close()
+
+  @property
+  def deleted(self):
+    return self.deleter.deleted
+
+  @property
+  def failed(self):
+    return self.deleter.failed
+
+  @property
+  def requests(self):
+    return self.deleter.requests
+
+  @property
+  def errors(self):
+    return self.deleter.errors
+
+  # an error of the stage's thread is raised in the caller
+
+  def _check(self):
+    if self.error != None:
+      raise self.error[0], self.error[1], self.error[2]
+
+  # after an error the queue is still drained so that put() never blocks forever
+
+  def _work(self):
+    while True:
+      chunk = self.queue.get()
+      try:
+        if self.error == None:
+          if chunk is None:
+            self.deleter.close()
+          elif chunk is _FLUSH:
+            self.deleter.flush()
+          else:
+            for v in chunk:
+              self.deleter.add(v.name, v.version_id, v)
+      except Exception:
+        self.error = sys.exc_info()
+      finally:
+        self.queue.task_done()
+      if chunk is None:
+        break
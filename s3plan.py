@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# s3plan
+#
+# by Walter Graf
+#
+# usage: s3plan.py [-h] [--input csv-file-input] [--output csv-file-output]
+#                  [--shards shards] [--keep-latest] [--flagged csv-file-output]
+#                  [--rejected csv-file-output] [--batch-size batch-size]
+#                  [--run-size rows] [--temp-dir directory] [--stats]
+#                  [--stats-file stats-file] [--stats-format {prometheus,json}]
+#                  bucket-name
+#
+# compile version lists into a sorted, deduplicated and sharded delete plan for
+# s3delov
+#
+# positional arguments:
+#   bucket-name           bucket hosting the to be deleted versioned objects
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   --input csv-file-input, -i csv-file-input
+#                         read csv or binary input from this file (default:
+#                         stdin, may be repeated)
+#   --output csv-file-output, -o csv-file-output
+#                         write the plan to this file, shard i of several to
+#                         file.i.ext for file.ext (default: stdout)
+#   --shards shards       split the plan into this many key ranges of about the
+#                         same number of versions (default: 1)
+#   --keep-latest         leave versions that were the latest version of their
+#                         object out of the plan
+#   --flagged csv-file-output
+#                         write csv rows of versions that were the latest
+#                         version of their object to this file
+#   --rejected csv-file-output
+#                         write csv rows of other buckets and invalid rows to
+#                         this file
+#   --batch-size batch-size
+#                         number of versions per multi-object delete request
+#                         s3delov is run with, for the summary (default: 1000)
+#   --run-size rows       sort this many rows in memory at a time (default:
+#                         500000)
+#   --temp-dir directory  keep the sorted runs in this directory (default:
+#                         directory of the output)
+#   --stats               print pipeline statistics to stderr at exit
+#   --stats-file stats-file
+#                         write pipeline statistics to this file at exit
+#   --stats-format {prometheus,json}
+#                         format of the statistics file (default: prometheus)
+#
+# The version lists handed to s3delov are often several listing runs
+# concatenated, with duplicates, rows of other buckets and the objects in no
+# particular order. s3plan compiles them into a delete plan before anything
+# is deleted:
+# - rows of other buckets and rows without object name or version id or with
+#   a malformed size are dropped (and written to --rejected if asked for)
+# - the rows are sorted by object name and version id with an external merge
+#   sort: runs of --run-size rows are sorted in memory and written to
+#   temporary files, which are then merged, so memory stays bounded for
+#   inputs of any size
+# - duplicate (bucket, object, version_id) rows are removed
+# - rows deleting the version that was the latest one of its object when it
+#   was listed are flagged (written to --flagged if asked for) and left out of
+#   the plan with --keep-latest
+# - the plan is split into --shards shards of about the same number of
+#   versions by key range, never splitting the versions of an object, to be
+#   run by s3delov processes in parallel
+# A summary of the versions, delete requests and bytes each shard reclaims
+# is printed to stderr.
+
+import sys
+import os
+import argparse
+import csv
+import heapq
+import itertools
+import shutil
+import tempfile
+import s3version
+import s3stats
+import s3format
+import s3deleter
+
+# number of rows sorted in memory at a time
+S3_PLAN_RUN_SIZE = 500000
+
+# command line arguments
+
+def make_parser(prog=None):
+  parser = argparse.ArgumentParser(prog = prog, description = "compile version lists into a sorted, deduplicated and sharded delete plan for s3delov")
+  parser.add_argument("bucket", metavar="bucket-name", help="bucket hosting the to be deleted versioned objects")
+  parser.add_argument("--input", "-i", metavar="csv-file-input", type=argparse.FileType("rb"), action="append", help="read csv or binary input from this file (default: stdin, may be repeated)")
+  parser.add_argument("--output", "-o", metavar="csv-file-output", help="write the plan to this file, shard i of several to file.i.ext for file.ext (default: stdout)")
+  parser.add_argument("--shards", metavar="shards", type=int, default=1, help="split the plan into this many key ranges of about the same number of versions (default: %(default)s)")
+  parser.add_argument("--keep-latest", action="store_true", help="leave versions that were the latest version of their object out of the plan")
+  parser.add_argument("--flagged", metavar="csv-file-output", help="write csv rows of versions that were the latest version of their object to this file")
+  parser.add_argument("--rejected", metavar="csv-file-output", help="write csv rows of other buckets and invalid rows to this file")
+  parser.add_argument("--batch-size", metavar="batch-size", type=int, default=s3deleter.S3_MAX_DELETE_BATCH, help="number of versions per multi-object delete request s3delov is run with, for the summary (default: %(default)s)")
+  parser.add_argument("--run-size", metavar="rows", type=int, default=S3_PLAN_RUN_SIZE, help="sort this many rows in memory at a time (default: %(default)s)")
+  parser.add_argument("--temp-dir", metavar="directory", help="keep the sorted runs in this directory (default: directory of the output)")
+  parser.add_argument("--stats", action="store_true", help="print pipeline statistics to stderr at exit")
+  parser.add_argument("--stats-file", metavar="stats-file", help="write pipeline statistics to this file at exit")
+  parser.add_argument("--stats-format", choices=s3stats.S3_STATS_FORMATS, default="prometheus", help="format of the statistics file (default: %(default)s)")
+  return parser
+
+# csv writer of rows with the columns s3version.S3_CSV_KEYS, starting with the header row
+
+def _row_writer(output):
+  writer = csv.DictWriter(output, s3version.S3_CSV_KEYS, delimiter=",", quotechar='"', extrasaction="ignore")
+  writer.writerow(dict([ (k, k) for k in s3version.S3_CSV_KEYS ]))
+  return writer
+
+def _sort_key(row):
+  return (row["object"], row["version_id"])
+
+# sorted run of rows written to a temporary file in workdir
+
+def _write_run(workdir, rows):
+  rows.sort(key=_sort_key)
+  fd, path = tempfile.mkstemp(prefix="run", suffix=".csv", dir=workdir)
+  with os.fdopen(fd, "wb") as f:
+    writer = _row_writer(f)
+    for row in rows:
+      writer.writerow(row)
+  return path
+
+# (sort key, row) pairs of a run file
+
+def _read_run(path):
+  with open(path, "rb") as f:
+    for row in csv.DictReader(f, delimiter=",", quotechar='"'):
+      yield _sort_key(row), row
+
+# rows of sorted runs merged into one sorted stream without duplicates
+# a duplicate row that was the latest version makes the remaining row the latest version
+
+def merge(runs):
+  for key, group in itertools.groupby(heapq.merge(*runs), lambda kr: kr[0]):
+    rows = [ row for k, row in group ]
+    row = rows[0]
+    if len(rows) > 1 and any([ r["is_latest"] == "True" for r in rows ]):
+      row = dict(row, is_latest="True")
+    yield row, len(rows) - 1
+
+# path of shard i of output_file, file.ext becomes file.i.ext
+
+def shard_path(output_file, i):
+  base, ext = os.path.splitext(output_file)
+  return "%s.%d%s" % (base, i, ext)
+
+# one shard of the plan, keeping count of what it deletes
+
+class Shard(object):
+
+  def __init__(self, path, output):
+    self.path = path
+    self.output = output
+    self.writer = _row_writer(output)
+    self.versions = 0
+    self.bytes = 0
+    self.first = None
+    self.last = None
+
+  def write(self, row):
+    self.writer.writerow(row)
+    self.versions += 1
+    if row.get("del_marker") != "yes":
+      self.bytes += int(row.get("size") or 0)
+    if self.first == None:
+      self.first = row["object"]
+    self.last = row["object"]
+
+  def requests(self, batch_size):
+    return (self.versions + batch_size - 1) // batch_size
+
+  def close(self):
+    if self.output == sys.stdout:
+      self.output.flush()
+    else:
+      self.output.close()
+
+# split the plan in plan_file into shards of about the same number of versions,
+# each one ending at an object boundary
+
+def split(plan_file, planned, shards, output_file):
+  result = []
+  shard = None
+  written = 0
+  with open(plan_file, "rb") as f:
+    for row in csv.DictReader(f, delimiter=",", quotechar='"'):
+      if shard == None or (len(result) < shards and written >= planned * len(result) // shards and row["object"] != shard.last):
+        if shard != None:
+          shard.close()
+        path = shard_path(output_file, len(result) + 1)
+        shard = Shard(path, open(path, "wb"))
+        result.append(shard)
+      shard.write(row)
+      written += 1
+  if shard != None:
+    shard.close()
+  return result
+
+# compile the delete plan as asked for by the command line arguments argv (default: sys.argv)
+# connect is accepted like in all tools, the plan does not connect to S3
+# returns the exit status
+
+def main(argv=None, connect=None, prog=None):
+  parser = make_parser(prog)
+  args = parser.parse_args(argv)
+
+  # record pipeline statistics if asked for, they are reported at exit
+
+  s3stats.setup("s3plan", args.stats, args.stats_file, args.stats_format)
+
+  bucket_name = args.bucket
+  inputs = args.input or [ sys.stdin ]
+  output_file = args.output
+  shards = args.shards
+  keep_latest = args.keep_latest
+  batch_size = args.batch_size
+  run_size = args.run_size
+
+  if shards < 1:
+    parser.error("number of shards must be at least 1")
+  if shards > 1 and output_file == None:
+    parser.error("--shards requires --output")
+  if batch_size < 1 or batch_size > s3deleter.S3_MAX_DELETE_BATCH:
+    parser.error("batch size must be between 1 and %d" % s3deleter.S3_MAX_DELETE_BATCH)
+  if run_size < 1:
+    parser.error("run size must be at least 1")
+  temp_dir = args.temp_dir
+  if temp_dir == None and output_file != None:
+    temp_dir = os.path.dirname(os.path.abspath(output_file))
+
+  reports = []
+  rejected = None
+  if args.rejected != None:
+    reports.append(open(args.rejected, "wb"))
+    rejected = _row_writer(reports[-1])
+  flagged = None
+  if args.flagged != None:
+    reports.append(open(args.flagged, "wb"))
+    flagged = _row_writer(reports[-1])
+
+  workdir = tempfile.mkdtemp(prefix="s3plan", dir=temp_dir)
+  try:
+
+    # read all inputs, drop rows of other buckets and invalid rows
+    # sort runs of run_size rows and write them to the work directory
+
+    read = 0
+    other_buckets = 0
+    invalid = 0
+    runs = []
+    rows = []
+    for input in inputs:
+      for row in s3stats.timed(s3format.read_rows(input), "read", "read"):
+        read += 1
+        if row.get("bucket") != bucket_name:
+          other_buckets += 1
+        elif not row.get("object") or not row.get("version_id") or not (row.get("size") or "0").isdigit():
+          invalid += 1
+        else:
+          rows.append(row)
+          if len(rows) >= run_size:
+            runs.append(s3stats.timed_call(_write_run, "sort")(workdir, rows))
+            rows = []
+          continue
+        if rejected != None:
+          rejected.writerow(row)
+
+    # the last run stays in memory
+
+    rows.sort(key=_sort_key)
+    sorted_runs = [ _read_run(path) for path in runs ] + [ [ (_sort_key(row), row) for row in rows ] ]
+
+    # merge the runs into the plan, removing duplicates and flagging latest versions
+    # with several shards the plan is written to the work directory first and then
+    # split into shards once the number of its versions is known
+
+    duplicates = 0
+    latest = 0
+    if shards == 1:
+      plan = Shard(output_file or "stdout", open(output_file, "wb") if output_file != None else sys.stdout)
+    else:
+      plan = Shard(None, open(os.path.join(workdir, "plan.csv"), "wb"))
+    for row, n in s3stats.timed(merge(sorted_runs), "merge"):
+      duplicates += n
+      if row["is_latest"] == "True":
+        latest += 1
+        if flagged != None:
+          flagged.writerow(row)
+        if keep_latest:
+          continue
+      plan.write(row)
+    plan.close()
+    planned = plan.versions
+    if shards == 1:
+      result = [ plan ]
+    else:
+      result = s3stats.timed_call(split, "split")(os.path.join(workdir, "plan.csv"), planned, shards, output_file)
+  finally:
+    shutil.rmtree(workdir, True)
+    for f in reports:
+      f.close()
+
+  # summary of the plan, per shard and in total
+
+  print >> sys.stderr, "read", read, "rows,", other_buckets, "of other buckets,", invalid, "invalid,", duplicates, "duplicates"
+  print >> sys.stderr, latest, "versions were the latest version of their object,", "left out" if keep_latest else "flagged"
+  for shard in result:
+    print >> sys.stderr, "  %s: %d versions, %d delete requests, %d bytes, objects %s to %s" % (shard.path, shard.versions, shard.requests(batch_size), shard.bytes, shard.first, shard.last)
+  print >> sys.stderr, "plan of", planned, "versions,", sum([ shard.requests(batch_size) for shard in result ]), "delete requests,", plan.bytes, "bytes to be reclaimed"
+  s3stats.stats.count("planned", planned)
+  s3stats.stats.count("duplicate", duplicates)
+  s3stats.stats.count("rejected", other_buckets + invalid)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+# s3policy
+#
+# by Walter Graf
+#
+# retention policies for object versions
+#
+# Policies are read from the S3 configuration file. The section [retention]
+# applies to all objects, sections [retention <prefix>] to the objects
+# starting with prefix; the policy with the longest matching prefix wins.
+#
+#   [retention]
+#   keep_versions = 5                 keep the 5 newest versions
+#   keep_days = 30                    keep the versions current within the last 30 days
+#   keep_daily = 7                    keep the versions current at the end of the last 7 days
+#   keep_weekly = 4                   ... of the last 4 weeks (ending Monday 00:00 UTC)
+#   keep_monthly = 12                 ... of the last 12 months
+#   expire_delete_markers = 90        remove delete markers older than 90 days once
+#                                     no other version of the object is left
+#
+#   [retention logs/]
+#   keep_versions = 1
+#
+# A policy is applied to the versions of one object at a time. The latest
+# version of an object is never removed unless it is an expired delete
+# marker. Older versions, including older delete markers, are removed unless
+# one of the keep rules keeps them; keep_versions only counts versions that
+# are not delete markers. A policy without keep rules keeps all versions.
+
+import time
+import calendar
+
+S3_POLICY_SECTION = "retention"
+S3_POLICY_RULES = [ "keep_versions", "keep_days", "keep_daily", "keep_weekly", "keep_monthly", "expire_delete_markers" ]
+
+S3_DAY = 86400
+
+class Policy(object):
+
+  def __init__(self, prefix="", keep_versions=None, keep_days=None, keep_daily=None, keep_weekly=None, keep_monthly=None, expire_delete_markers=None):
+    self.prefix = prefix
+    self.keep_versions = keep_versions
+    self.keep_days = keep_days
+    self.keep_daily = keep_daily
+    self.keep_weekly = keep_weekly
+    self.keep_monthly = keep_monthly
+    self.expire_delete_markers = expire_delete_markers
+    self.keeps = [ r for r in [ keep_versions, keep_days, keep_daily, keep_weekly, keep_monthly ] if r != None ]
+    self.now = None
+
+  # prepare the evaluation at time now (seconds since the epoch)
+
+  def start(self, now):
+    self.now = now
+    self.boundaries = _gfs_boundaries(now, self.keep_daily or 0, self.keep_weekly or 0, self.keep_monthly or 0)
+
+  # versions of one object (newest first) to be removed, in the order they are to be removed
+
+  def expired(self, versions):
+    now = self.now
+    expired = []
+    if self.keeps:
+      keep = [ False ] * len(versions)
+      keep[0] = True
+      if self.keep_versions != None:
+        n = 0
+        for i, v in enumerate(versions):
+          if not v.del_marker:
+            n += 1
+            if n <= self.keep_versions:
+              keep[i] = True
+      if self.keep_days != None:
+        since = now - self.keep_days * S3_DAY
+        for i in range(1, len(versions)):
+          if versions[i - 1].mod_time > since:
+            keep[i] = True
+      if self.boundaries:
+        i = 0
+        for t in self.boundaries:
+          while i < len(versions) and versions[i].mod_time > t:
+            i += 1
+          if i == len(versions):
+            break
+          keep[i] = True
+      expired = [ v for i, v in enumerate(versions) if not keep[i] ]
+
+    # the latest delete marker only expires with all versions behind it and goes last, the
+    # caller must not remove it before those have been removed (see s3retain)
+
+    latest = versions[0]
+    if self.expire_delete_markers != None and latest.del_marker and latest.mod_time < now - self.expire_delete_markers * S3_DAY:
+      if len(expired) == len(versions) - 1:
+        expired.append(latest)
+    return expired
+
+# points in time (newest first) at which the current version is kept by the grandfather-father-son rules
+
+def _gfs_boundaries(now, daily, weekly, monthly):
+  today = int(now) // S3_DAY * S3_DAY
+  boundaries = [ today - d * S3_DAY for d in range(daily) ]
+  monday = today - time.gmtime(today).tm_wday * S3_DAY
+  boundaries += [ monday - w * 7 * S3_DAY for w in range(weekly) ]
+  year, month = time.gmtime(today)[0:2]
+  for m in range(monthly):
+    boundaries.append(calendar.timegm((year, month, 1, 0, 0, 0)))
+    month -= 1
+    if month == 0:
+      year, month = year - 1, 12
+  return sorted(set(boundaries), reverse=True)
+
+class Policies(object):
+
+  def __init__(self, policies):
+    self.policies = sorted(policies, key=lambda p: len(p.prefix), reverse=True)
+
+  def start(self, now):
+    for p in self.policies:
+      p.start(now)
+
+  # policy applying to object name, None if there is none
+
+  def select(self, name):
+    for p in self.policies:
+      if name.startswith(p.prefix):
+        return p
+    return None
+
+# policies of a parsed configuration file, raises ValueError on invalid rules
+
+def load(cnf):
+  policies = []
+  for section in cnf.sections():
+    words = section.split(None, 1)
+    if not words or words[0] != S3_POLICY_SECTION:
+      continue
+    prefix = words[1] if len(words) > 1 else ""
+    rules = {}
+    for option, value in cnf.items(section):
+      if option not in S3_POLICY_RULES:
+        raise ValueError("unknown retention rule %s in section [%s]" % (option, section))
+      try:
+        rules[option] = int(value)
+      except ValueError:
+        raise ValueError("retention rule %s in section [%s] is not a number: %s" % (option, section, value))
+      if rules[option] < 0 or (option == "keep_versions" and rules[option] < 1):
+        raise ValueError("retention rule %s in section [%s] is out of range: %s" % (option, section, value))
+    policies.append(Policy(prefix, **rules))
+  return Policies(policies)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+# s3record
+#
+# by Walter Graf
+#
+# compact version records and a fast version listing parser
+#
+# boto turns every entry of a version listing into a Key or DeleteMarker
+# object through a SAX handler, which costs more CPU and memory than the
+# listing tools can afford for millions of versions. list_page() instead
+# sends the ListObjectVersions request through the boto connection (which
+# takes care of signing) and parses the response with cElementTree straight
+# into Version records.
+#
+# Version records carry the attributes of boto keys the tools use plus
+# del_marker and mod_time, the modification time in seconds since the epoch.
+# S3 timestamps are UTC, time_to_sec() converts them without strptime by
+# caching the epoch of every day it has seen.
+#
+# request_page() sends the request without waiting for its response if the
+# bucket is on the async backend (s3async), so that the next page can be in
+# flight while the current one is processed.
+
+import time
+import calendar
+import urllib
+import xml.etree.cElementTree as ElementTree
+import s3stats
+import s3async
+
+class Version(object):
+
+  __slots__ = ("name", "version_id", "last_modified", "mod_time", "size", "is_latest", "del_marker", "etag", "storage_class")
+
+  def __init__(self, name, version_id, last_modified, size=0, is_latest=False, del_marker=False, etag=None, storage_class=None):
+    self.name = name
+    self.version_id = version_id
+    self.last_modified = last_modified
+    self.mod_time = time_to_sec(last_modified)
+    self.size = size
+    self.is_latest = is_latest
+    self.del_marker = del_marker
+    self.etag = etag
+    self.storage_class = storage_class
+
+# seconds since the epoch of an S3 timestamp (yyyy-mm-ddThh:mm:ss.mmmZ, UTC)
+# fractions of a second are ignored
+
+_day_sec = {}
+
+def time_to_sec(s):
+  day = s[0:10]
+  sec = _day_sec.get(day)
+  if sec is None:
+    sec = _day_sec[day] = calendar.timegm((int(s[0:4]), int(s[5:7]), int(s[8:10]), 0, 0, 0))
+  return sec + int(s[11:13]) * 3600 + int(s[14:16]) * 60 + int(s[17:19])
+
+class Page(list):
+
+  # one page of a version listing: the Version records plus the listing state
+
+  def __init__(self):
+    list.__init__(self)
+    self.prefixes = []
+    self.is_truncated = False
+    self.next_key_marker = None
+    self.next_version_id_marker = None
+
+# list one page of versions of bucket
+
+def list_page(bucket, prefix=None, key_marker=None, version_id_marker=None, delimiter=None, max_keys=None):
+  return request_page(bucket, prefix, key_marker, version_id_marker, delimiter, max_keys)()
+
+# request one page of versions of bucket, returns a function returning the page
+# on the async backend the request is on its way when request_page() returns, on the boto
+# backend it is only sent by the returned function
+
+def request_page(bucket, prefix=None, key_marker=None, version_id_marker=None, delimiter=None, max_keys=None):
+  params = [ ("delimiter", delimiter), ("key-marker", key_marker), ("max-keys", max_keys), ("prefix", prefix), ("version-id-marker", version_id_marker) ]
+  query_args = "versions"
+  for k, value in params:
+    if value is None or value == "":
+      continue
+    if isinstance(value, unicode):
+      value = value.encode("utf-8")
+    query_args += "&%s=%s" % (k, urllib.quote(str(value)))
+  client = s3async.client_of(bucket)
+  if client == None:
+    return lambda: _page(bucket, bucket.connection.make_request("GET", bucket.name, query_args=query_args))
+  request = client.submit("GET", bucket.name, query_args=query_args)
+  return lambda: _page(bucket, request.wait())
+
+def _page(bucket, response):
+  body = response.read()
+  if response.status != 200:
+    raise bucket.connection.provider.storage_response_error(response.status, response.reason, body)
+  if not s3stats.stats.enabled:
+    return parse_page(body)
+  started = time.time()
+  page = parse_page(body)
+  s3stats.stats.stage("parse", time.time() - started)
+  return page
+
+# parse a ListVersionsResult document
+
+def _local(tag):
+  return tag[tag.find("}") + 1:]
+
+def parse_page(body):
+  page = Page()
+  for e in ElementTree.fromstring(body):
+    tag = _local(e.tag)
+    if tag == "Version" or tag == "DeleteMarker":
+      fields = {}
+      for f in e:
+        fields[_local(f.tag)] = f.text
+      if tag == "Version":
+        page.append(Version(fields["Key"], fields["VersionId"], fields["LastModified"], int(fields["Size"]), fields["IsLatest"] == "true", False, fields.get("ETag"), fields.get("StorageClass")))
+      else:
+        page.append(Version(fields["Key"], fields["VersionId"], fields["LastModified"], 0, fields["IsLatest"] == "true", True))
+    elif tag == "CommonPrefixes":
+      for f in e:
+        if _local(f.tag) == "Prefix":
+          page.prefixes.append(f.text)
+    elif tag == "IsTruncated":
+      page.is_truncated = e.text == "true"
+    elif tag == "NextKeyMarker":
+      page.next_key_marker = e.text
+    elif tag == "NextVersionIdMarker":
+      page.next_version_id_marker = e.text
+  return page
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# s3restore
+#
+# by Walter Graf
+#
+# usage: s3restore.py [-h] [-c s3-config-file] --at yyyy-mm-ddThh:mm:ss
+#                     [--prefix object-prefix] [--keep-newer] [--dry-run]
+#                     [--shards shards] [--split-at object-name]
+#                     [--delimiter delimiter] [--workers workers]
+#                     [--copy-workers workers] [--batch-size batch-size]
+#                     [--delete-workers workers] [--verbose]
+#                     [--backend {boto,async}] [--retries retries]
+#                     [--max-rate requests-per-sec] [--stats]
+#                     [--stats-file stats-file]
+#                     [--stats-format {prometheus,json}]
+#                     bucket-name
+#
+# restore the objects of a bucket to the versions current at a point in time
+#
+# positional arguments:
+#   bucket-name           name of bucket
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   -c s3-config-file     use this S3 configuration file (default:
+#                         $HOME/s3versioning.cnf)
+#   --at yyyy-mm-ddThh:mm:ss
+#                         restore the objects to the versions current at this
+#                         time
+#   --prefix object-prefix
+#                         only restore objects starting with this prefix
+#   --keep-newer          keep objects created after the restore time instead of
+#                         putting a delete marker on top
+#   --dry-run             only report what would be restored
+#   --shards shards       split the listing into this many key ranges at common
+#                         prefixes and list them in parallel (default: 1)
+#   --split-at object-name
+#                         split the listing after this object name instead of at
+#                         common prefixes (may be repeated)
+#   --delimiter delimiter
+#                         delimiter used to discover common prefixes (default:
+#                         /)
+#   --workers workers     list this many key ranges in parallel, each using its
+#                         own S3 connection (default: 4)
+#   --copy-workers workers
+#                         copy versions with this many parallel workers, each
+#                         using its own S3 connection (default: 16)
+#   --batch-size batch-size
+#                         number of delete markers per multi-object delete
+#                         request, 1 disables multi-object deletes (default:
+#                         1000)
+#   --delete-workers workers
+#                         remove and create delete markers with this many
+#                         parallel workers, each using its own S3 connection
+#                         (default: 1)
+#   --verbose, -v         log every restored object to stderr
+#   --backend {boto,async}
+#                         send the S3 requests through boto's connections or the
+#                         event loop of s3async (default: boto)
+#   --retries retries     retry throttled or failed S3 requests this many times
+#                         (default: 8)
+#   --max-rate requests-per-sec
+#                         never send more than this many S3 requests per second
+#   --stats               print request and pipeline statistics to stderr at
+#                         exit
+#   --stats-file stats-file
+#                         write request and pipeline statistics to this file at
+#                         exit
+#   --stats-format {prometheus,json}
+#                         format of the statistics file (default: prometheus)
+#
+# every object is restored to the version that was current at the given time:
+# - if that version is still current or a copy of it is, nothing is done
+# - if only delete markers have been put on top of it, the delete markers are removed
+# - otherwise it is copied onto the object server-side and thus becomes the current version again
+# - if the object was deleted at that time or did not exist yet, a delete marker is put on top
+#   (objects created later are left alone with --keep-newer)
+# no version is deleted except for the removed delete markers, the history after the
+# restore time stays available
+
+import sys
+import os
+import argparse
+import time
+import itertools
+import collections
+import s3version
+import s3stats
+import s3connect
+import s3scheduler
+import s3log
+import s3lister
+import s3deleter
+import s3pipeline
+import s3copier
+
+# command line arguments
+
+def make_parser(prog=None):
+  parser = argparse.ArgumentParser(prog = prog, description = "restore the objects of a bucket to the versions current at a point in time")
+  parser.add_argument("bucket", metavar="bucket-name", help="name of bucket")
+  parser.add_argument("-c", dest="s3_conf", metavar="s3-config-file", default=s3version.S3_CONF, help="use this S3 configuration file (default: %(default)s)")
+  parser.add_argument("--at", metavar="yyyy-mm-ddThh:mm:ss", required=True, help="restore the objects to the versions current at this time")
+  parser.add_argument("--prefix", metavar="object-prefix", help="only restore objects starting with this prefix")
+  parser.add_argument("--keep-newer", action="store_true", help="keep objects created after the restore time instead of putting a delete marker on top")
+  parser.add_argument("--dry-run", action="store_true", help="only report what would be restored")
+  parser.add_argument("--shards", metavar="shards", type=int, default=1, help="split the listing into this many key ranges at common prefixes and list them in parallel (default: %(default)s)")
+  parser.add_argument("--split-at", metavar="object-name", action="append", help="split the listing after this object name instead of at common prefixes (may be repeated)")
+  parser.add_argument("--delimiter", metavar="delimiter", default="/", help="delimiter used to discover common prefixes (default: %(default)s)")
+  parser.add_argument("--workers", metavar="workers", type=int, default=4, help="list this many key ranges in parallel, each using its own S3 connection (default: %(default)s)")
+  parser.add_argument("--copy-workers", metavar="workers", type=int, default=16, help="copy versions with this many parallel workers, each using its own S3 connection (default: %(default)s)")
+  parser.add_argument("--batch-size", metavar="batch-size", type=int, default=s3deleter.S3_MAX_DELETE_BATCH, help="number of delete markers per multi-object delete request, 1 disables multi-object deletes (default: %(default)s)")
+  parser.add_argument("--delete-workers", metavar="workers", type=int, default=1, help="remove and create delete markers with this many parallel workers, each using its own S3 connection (default: %(default)s)")
+  parser.add_argument("--verbose", "-v", action="store_true", help="log every restored object to stderr")
+  parser.add_argument("--backend", choices=s3connect.S3_BACKENDS, default="boto", help="send the S3 requests through boto's connections or the event loop of s3async (default: %(default)s)")
+  parser.add_argument("--retries", metavar="retries", type=int, default=s3scheduler.S3_SCHEDULER_RETRIES, help="retry throttled or failed S3 requests this many times (default: %(default)s)")
+  parser.add_argument("--max-rate", metavar="requests-per-sec", type=float, help="never send more than this many S3 requests per second")
+  parser.add_argument("--stats", action="store_true", help="print request and pipeline statistics to stderr at exit")
+  parser.add_argument("--stats-file", metavar="stats-file", help="write request and pipeline statistics to this file at exit")
+  parser.add_argument("--stats-format", choices=s3stats.S3_STATS_FORMATS, default="prometheus", help="format of the statistics file (default: %(default)s)")
+  return parser
+
+# restore a bucket to a point in time as asked for by the command line arguments argv
+# (default: sys.argv), connect opens the S3 connections instead of the S3 configuration file
+# returns the exit status
+
+def main(argv=None, connect=None, prog=None):
+  parser = make_parser(prog)
+  args = parser.parse_args(argv)
+
+  # record request and pipeline statistics if asked for, they are reported at exit
+
+  s3stats.setup("s3restore", args.stats, args.stats_file, args.stats_format)
+
+  # retry failed requests and adapt the number of requests in flight to the endpoint
+
+  if args.retries < 0:
+    parser.error("number of retries must not be negative")
+  if args.max_rate != None and args.max_rate <= 0:
+    parser.error("maximum request rate must be positive")
+  s3scheduler.setup(args.retries, args.max_rate)
+
+  s3_conf = args.s3_conf
+  bucket_name = args.bucket
+  at_sec = time.mktime(time.strptime(args.at,"%Y-%m-%dT%H:%M:%S"))
+  prefix = args.prefix
+  keep_newer = args.keep_newer
+  dry_run = args.dry_run
+  shards = args.shards
+  split_at = args.split_at
+  delimiter = args.delimiter
+  workers = args.workers
+  copy_workers = args.copy_workers
+  batch_size = args.batch_size
+  delete_workers = args.delete_workers
+
+  if shards < 1:
+    parser.error("number of shards must be at least 1")
+  if workers < 1 or copy_workers < 1 or delete_workers < 1:
+    parser.error("number of workers must be at least 1")
+  if batch_size < 1 or batch_size > s3deleter.S3_MAX_DELETE_BATCH:
+    parser.error("batch size must be between 1 and %d" % s3deleter.S3_MAX_DELETE_BATCH)
+  if at_sec > time.time():
+    parser.error("restore time lies in the future")
+
+  # parse config file and establish S3 connections, unless the caller hands over its own
+  # parallel listing, copy and delete workers each establish a connection of their own
+
+  if connect == None:
+    connect = s3connect.connector(s3connect.read_config(s3_conf), args.backend)
+
+  s3 = connect()
+  bucket = s3.get_bucket(bucket_name)
+  open_bucket = lambda: connect().get_bucket(bucket_name, validate=False)
+
+  # copies run on copy_workers threads, removing and creating delete markers on a thread of
+  # its own in batches of batch_size markers, spread over delete_workers
+  # a delete without version id creates a delete marker
+
+  def report_failure(name, version_id, code, message, row):
+    print >> sys.stderr, "failed to restore", name, version_id, ":", code, message
+
+  DeleteMarker = collections.namedtuple("DeleteMarker", "name version_id")
+
+  copier = None
+  stage = None
+  if not dry_run:
+    copier = s3copier.copier(open_bucket, copy_workers, report_failure)
+    deleter = s3deleter.deleter(open_bucket, delete_workers, batch_size, report_failure)
+    stage = s3pipeline.DeleteStage(deleter)
+
+  # list the object versions, split into shards either at the specified object names or at common prefixes
+
+  if split_at:
+    split_points = split_at
+  else:
+    split_points = s3lister.discover_split_points(bucket, prefix, shards, delimiter)
+  versions = s3lister.list_versions(bucket, prefix, split_points, workers, open_bucket)
+
+  # the listing returns the versions of an object next to each other, newest first
+  # S3 timestamps have a resolution of a millisecond, a version modified within the
+  # second of the restore time counts as current at the restore time
+
+  print >> sys.stderr, "dry run, nothing is restored" if dry_run else "restoring objects in bucket %s to %s :" % (bucket_name, args.at)
+
+  log = None
+  if args.verbose:
+    log = s3log.VersionLog()
+  copy = s3stats.timed_call(copier.copy, "copy") if copier != None else None
+  put = s3stats.timed_call(stage.put, "delete") if stage != None else None
+
+  objects = 0
+  current = 0
+  copies = 0
+  copied_bytes = 0
+  removed_markers = 0
+  created_markers = 0
+
+  for name, group in itertools.groupby(s3stats.timed(versions, "list", "listed"), lambda v: v.name):
+    objects += 1
+    group = list(group)
+    latest = group[0]
+    target = None
+    for i, v in enumerate(group):
+      if v.mod_time <= at_sec:
+        target = v
+        break
+
+    # deleted or not yet existing at the restore time
+
+    if target == None or target.del_marker:
+      if latest.del_marker or (target == None and keep_newer):
+        current += 1
+        continue
+      created_markers += 1
+      if log != None:
+        log.write("deleting", name, "")
+      if put != None:
+        put(DeleteMarker(name, None))
+      continue
+
+    # still current or already restored by a copy
+
+    if target is latest or (not latest.del_marker and latest.etag == target.etag and latest.size == target.size):
+      current += 1
+      continue
+
+    # only delete markers on top of the target version
+
+    newer = group[0:i]
+    if all([ v.del_marker for v in newer ]):
+      removed_markers += len(newer)
+      if log != None:
+        log.write("undeleting", name, target.version_id)
+      if put != None:
+        for v in newer:
+          put(v)
+      continue
+
+    copies += 1
+    copied_bytes += target.size
+    if log != None:
+      log.write("copying", name, target.version_id)
+    if copy != None:
+      copy(name, target.version_id, target.size, target.storage_class)
+
+  # wait for the copies and deletes to complete
+
+  if copier != None:
+    s3stats.timed_call(copier.close, "copy")()
+    s3stats.timed_call(stage.close, "delete")()
+  if log != None:
+    log.close()
+  s3stats.stats.count("selected", copies + removed_markers + created_markers)
+
+  print >> sys.stderr, objects, "objects,", current, "current,", copies, "versions to copy (", copied_bytes, "bytes ),", removed_markers, "delete markers to remove,", created_markers, "delete markers to create"
+  if copier != None:
+    s3stats.stats.count("copied", copier.copied)
+    s3stats.stats.count("deleted", stage.deleted)
+    s3stats.stats.count("failed", copier.failed + stage.failed)
+    print >> sys.stderr, "copied", copier.copied, "versions,", copier.bytes, "bytes,", copier.failed, "failed,", copier.requests, "copy requests"
+    print >> sys.stderr, "removed or created", stage.deleted, "delete markers,", stage.failed, "failed,", stage.requests, "delete requests"
+    errors = dict(copier.errors)
+    for code, count in stage.errors.items():
+      errors[code] = errors.get(code, 0) + count
+    for code, count in sorted(errors.items()):
+      print >> sys.stderr, "  ", count, "x", code
+    if copier.failed + stage.failed > 0:
+      return 1
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
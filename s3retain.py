@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# s3retain
+#
+# by Walter Graf
+#
+# usage: s3retain.py [-h] [-c s3-config-file] [--prefix object-prefix]
+#                    [--dry-run] [--output csv-file-output]
+#                    [--format {csv,binary}] [--compress] [--shards shards]
+#                    [--split-at object-name] [--delimiter delimiter]
+#                    [--workers workers] [--processes processes]
+#                    [--batch-size batch-size] [--delete-workers workers]
+#                    [--verbose] [--backend {boto,async}] [--retries retries]
+#                    [--max-rate requests-per-sec] [--stats]
+#                    [--stats-file stats-file]
+#                    [--stats-format {prometheus,json}]
+#                    bucket-name [bucket-name ...]
+#
+# remove the versions of a bucket expired by the retention policies of the S3
+# configuration file
+#
+# positional arguments:
+#   bucket-name           name of bucket, several names or patterns like
+#                         'logs-*' process several buckets ('*' all buckets)
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   -c s3-config-file     use this S3 configuration file (default:
+#                         $HOME/s3versioning.cnf)
+#   --prefix object-prefix
+#                         only apply the policies to objects starting with this
+#                         prefix
+#   --dry-run             only report the expired versions and the bytes they
+#                         occupy, do not remove them
+#   --output csv-file-output, -o csv-file-output
+#                         write the expired versions to this file
+#   --format {csv,binary}
+#                         write the versions in this format (default: csv)
+#   --compress            compress binary output
+#   --shards shards       split the listing into this many key ranges at common
+#                         prefixes and list them in parallel (default: 1)
+#   --split-at object-name
+#                         split the listing after this object name instead of at
+#                         common prefixes (may be repeated)
+#   --delimiter delimiter
+#                         delimiter used to discover common prefixes (default:
+#                         /)
+#   --workers workers     list this many key ranges in parallel, each using its
+#                         own S3 connection (default: 4)
+#   --processes processes
+#                         process this many of several buckets at a time, each
+#                         in a process of its own (default: 4)
+#   --batch-size batch-size
+#                         number of versions per multi-object delete request, 1
+#                         disables multi-object deletes (default: 1000)
+#   --delete-workers workers
+#                         delete versions with this many parallel workers, each
+#                         using its own S3 connection (default: 1)
+#   --verbose, -v         log every expired version to stderr
+#   --backend {boto,async}
+#                         send the S3 requests through boto's connections or the
+#                         event loop of s3async (default: boto)
+#   --retries retries     retry throttled or failed S3 requests this many times
+#                         (default: 8)
+#   --max-rate requests-per-sec
+#                         never send more than this many S3 requests per second
+#   --stats               print request and pipeline statistics to stderr at
+#                         exit
+#   --stats-file stats-file
+#                         write request and pipeline statistics to this file at
+#                         exit
+#   --stats-format {prometheus,json}
+#                         format of the statistics file (default: prometheus)
+#
+# retention policies:
+#   the policies are read from the S3 configuration file, see s3policy
+#
+#   [retention]
+#   keep_versions = 5
+#   keep_days = 30
+#   keep_daily = 7
+#   keep_weekly = 4
+#   keep_monthly = 12
+#   expire_delete_markers = 90
+#
+#   [retention logs/]
+#   keep_versions = 1
+
+import sys
+import os
+import argparse
+import time
+import itertools
+import s3version
+import s3stats
+import s3connect
+import s3scheduler
+import s3log
+import s3format
+import s3lister
+import s3deleter
+import s3policy
+import s3fanout
+
+# number of expired latest delete markers held back before the deletes queued so far are
+# waited for and the markers of the objects removed completely are removed
+S3_RETAIN_MARKER_BATCH = 10000
+
+# command line arguments
+
+def make_parser(prog=None):
+  parser = argparse.ArgumentParser(prog = prog, description = "remove the versions of a bucket expired by the retention policies of the S3 configuration file")
+  parser.add_argument("bucket", metavar="bucket-name", nargs="+", help="name of bucket, several names or patterns like 'logs-*' process several buckets ('*' all buckets)")
+  parser.add_argument("-c", dest="s3_conf", metavar="s3-config-file", default=s3version.S3_CONF, help="use this S3 configuration file (default: %(default)s)")
+  parser.add_argument("--prefix", metavar="object-prefix", help="only apply the policies to objects starting with this prefix")
+  parser.add_argument("--dry-run", action="store_true", help="only report the expired versions and the bytes they occupy, do not remove them")
+  parser.add_argument("--output", "-o", metavar="csv-file-output", help="write the expired versions to this file")
+  parser.add_argument("--format", choices=s3format.S3_FORMATS, default="csv", help="write the versions in this format (default: %(default)s)")
+  parser.add_argument("--compress", action="store_true", help="compress binary output")
+  parser.add_argument("--shards", metavar="shards", type=int, default=1, help="split the listing into this many key ranges at common prefixes and list them in parallel (default: %(default)s)")
+  parser.add_argument("--split-at", metavar="object-name", action="append", help="split the listing after this object name instead of at common prefixes (may be repeated)")
+  parser.add_argument("--delimiter", metavar="delimiter", default="/", help="delimiter used to discover common prefixes (default: %(default)s)")
+  parser.add_argument("--workers", metavar="workers", type=int, default=4, help="list this many key ranges in parallel, each using its own S3 connection (default: %(default)s)")
+  parser.add_argument("--processes", metavar="processes", type=int, default=s3fanout.S3_FANOUT_PROCESSES, help="process this many of several buckets at a time, each in a process of its own (default: %(default)s)")
+  parser.add_argument("--batch-size", metavar="batch-size", type=int, default=s3deleter.S3_MAX_DELETE_BATCH, help="number of versions per multi-object delete request, 1 disables multi-object deletes (default: %(default)s)")
+  parser.add_argument("--delete-workers", metavar="workers", type=int, default=1, help="delete versions with this many parallel workers, each using its own S3 connection (default: %(default)s)")
+  parser.add_argument("--verbose", "-v", action="store_true", help="log every expired version to stderr")
+  parser.add_argument("--backend", choices=s3connect.S3_BACKENDS, default="boto", help="send the S3 requests through boto's connections or the event loop of s3async (default: %(default)s)")
+  parser.add_argument("--retries", metavar="retries", type=int, default=s3scheduler.S3_SCHEDULER_RETRIES, help="retry throttled or failed S3 requests this many times (default: %(default)s)")
+  parser.add_argument("--max-rate", metavar="requests-per-sec", type=float, help="never send more than this many S3 requests per second")
+  parser.add_argument("--stats", action="store_true", help="print request and pipeline statistics to stderr at exit")
+  parser.add_argument("--stats-file", metavar="stats-file", help="write request and pipeline statistics to this file at exit")
+  parser.add_argument("--stats-format", choices=s3stats.S3_STATS_FORMATS, default="prometheus", help="format of the statistics file (default: %(default)s)")
+  return parser
+
+# apply the retention policies as asked for by the command line arguments argv (default: sys.argv)
+# connect opens the S3 connections instead of the S3 configuration file
+# returns the exit status, the highest one of the buckets if there are several
+
+def main(argv=None, connect=None, prog=None):
+  parser = make_parser(prog)
+  args = parser.parse_args(argv)
+
+  # record request and pipeline statistics if asked for, they are reported at exit
+
+  s3stats.setup("s3retain", args.stats, args.stats_file, args.stats_format)
+
+  # retry failed requests and adapt the number of requests in flight to the endpoint
+
+  if args.retries < 0:
+    parser.error("number of retries must not be negative")
+  if args.max_rate != None and args.max_rate <= 0:
+    parser.error("maximum request rate must be positive")
+  s3scheduler.setup(args.retries, args.max_rate)
+
+  s3_conf = args.s3_conf
+  bucket_names = args.bucket
+  prefix = args.prefix
+  dry_run = args.dry_run
+  output_file = args.output
+  format = args.format
+  compress = args.compress
+  shards = args.shards
+  split_at = args.split_at
+  delimiter = args.delimiter
+  workers = args.workers
+  processes = args.processes
+  batch_size = args.batch_size
+  delete_workers = args.delete_workers
+
+  if shards < 1:
+    parser.error("number of shards must be at least 1")
+  if processes < 1:
+    parser.error("number of processes must be at least 1")
+  if workers < 1 or delete_workers < 1:
+    parser.error("number of workers must be at least 1")
+  if batch_size < 1 or batch_size > s3deleter.S3_MAX_DELETE_BATCH:
+    parser.error("batch size must be between 1 and %d" % s3deleter.S3_MAX_DELETE_BATCH)
+
+  # parse config file including the retention policies
+
+  cnf = s3connect.read_config(s3_conf)
+  try:
+    policies = s3policy.load(cnf)
+  except ValueError as e:
+    parser.error(str(e))
+  if not policies.policies:
+    parser.error("no retention policy found in %s" % s3_conf)
+
+  # establish S3 connections, unless the caller hands over its own
+  # parallel listing and delete workers each establish a connection of their own
+
+  if connect == None:
+    connect = s3connect.connector(cnf, args.backend)
+
+  # resolve the bucket names and patterns
+
+  bucket_names = s3fanout.expand(connect, bucket_names)
+  if not bucket_names:
+    parser.error("no bucket matches %s" % " ".join(args.bucket))
+  fanned_out = len(bucket_names) > 1
+
+  # process one bucket, writing its versions to output_file (stdout if None)
+
+  def process(bucket_name, output_file):
+
+    s3 = connect()
+    bucket = s3.get_bucket(bucket_name)
+    open_bucket = lambda: connect().get_bucket(bucket_name, validate=False)
+
+    # prepare output of the expired versions
+
+    writer = None
+    if output_file != None:
+      output = open(output_file, "wb")
+      writer = s3format.version_writer(output, bucket_name, format, compress, header = not fanned_out)
+
+    # the expired versions are removed while the listing goes on, in batches of batch_size versions
+    # spread over the delete workers; the size of every version travels along to account the reclaimed bytes
+
+    # the names of the objects with a version that failed to be removed are remembered, their
+    # expired latest delete markers must stay
+
+    failed_names = set()
+
+    def report_failure(name, version_id, code, message, size):
+      print >> sys.stderr, "failed to remove", name, version_id, ":", code, message
+      failed_names.add(name)
+
+    reclaimed = [ 0 ]
+
+    def report_deleted(versions):
+      reclaimed[0] += sum([ size for name, version_id, size in versions ])
+
+    deleter = None
+    if not dry_run:
+      deleter = s3deleter.deleter(open_bucket, delete_workers, batch_size, report_failure, report_deleted)
+
+    # list the object versions, split into shards either at the specified object names or at common prefixes
+
+    if split_at:
+      split_points = split_at
+    else:
+      split_points = s3lister.discover_split_points(bucket, prefix, shards, delimiter)
+    versions = s3lister.list_versions(bucket, prefix, split_points, workers, open_bucket)
+
+    # apply the policy of every object to all its versions at once
+    # the listing returns the versions of an object next to each other, newest first
+
+    print >> sys.stderr, "dry run, expired versions are not removed" if dry_run else "removing expired versions in bucket %s :" % bucket_name
+
+    policies.start(time.time())
+
+    log = None
+    if args.verbose:
+      log = s3log.VersionLog()
+    write = s3stats.timed_call(writer.write, "write") if writer != None else None
+    delete = s3stats.timed_call(deleter.add, "delete") if deleter != None else None
+
+    # an expired latest delete marker is only removed once all other versions of its object are
+    # gone, otherwise an older version would become the current one again
+    # the markers are held back until the deletes queued so far are complete and only those of
+    # objects without failed deletes are removed then
+
+    markers = []
+
+    def remove_markers():
+      deleter.flush()
+      for v in markers:
+        if v.name not in failed_names:
+          deleter.add(v.name, v.version_id, v.size)
+      del markers[:]
+      failed_names.clear()
+
+    objects = 0
+    expired_versions = 0
+    expired_markers = 0
+    expired_bytes = 0
+
+    for name, group in itertools.groupby(s3stats.timed(versions, "list", "listed"), lambda v: v.name):
+      policy = policies.select(name)
+      if policy == None:
+        continue
+      objects += 1
+      for v in s3stats.timed_call(policy.expired, "select")(list(group)):
+        if v.del_marker:
+          expired_markers += 1
+        else:
+          expired_versions += 1
+          expired_bytes += v.size
+        if log != None:
+          log.write("expired", v.name, v.version_id)
+        if write != None:
+          write(v)
+        if delete != None:
+          if v.del_marker and v.is_latest:
+            markers.append(v)
+          else:
+            delete(v.name, v.version_id, v.size)
+      if len(markers) >= S3_RETAIN_MARKER_BATCH:
+        s3stats.timed_call(remove_markers, "delete")()
+
+    if deleter != None:
+      s3stats.timed_call(remove_markers, "delete")()
+      s3stats.timed_call(deleter.close, "delete")()
+    if writer != None:
+      writer.flush()
+      output.close()
+    if log != None:
+      log.close()
+    s3stats.stats.count("selected", expired_versions + expired_markers)
+
+    print >> sys.stderr, objects, "objects,", expired_versions, "versions and", expired_markers, "delete markers expired,", expired_bytes, "bytes reclaimable"
+    if deleter != None:
+      s3stats.stats.count("deleted", deleter.deleted)
+      s3stats.stats.count("failed", deleter.failed)
+      print >> sys.stderr, "removed", deleter.deleted, "versions,", deleter.failed, "failed,", deleter.requests, "delete requests,", reclaimed[0], "bytes reclaimed"
+      for code, count in sorted(deleter.errors.items()):
+        print >> sys.stderr, "  ", count, "x", code
+      if deleter.failed > 0:
+        return 1
+    return 0
+
+  # several buckets are processed in processes of their own (see s3fanout), their versions
+  # are merged into one output
+
+  if fanned_out:
+    return s3fanout.run(bucket_names, processes, output_file, None if output_file == None else format, compress, process)
+  return process(bucket_names[0], output_file)
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# s3scan
+#
+# by Walter Graf
+#
+# usage: s3scan.py [-h] [-c s3-config-file] [--prefix object-prefix] --query
+#                  query [--shards shards] [--split-at object-name]
+#                  [--delimiter delimiter] [--workers workers]
+#                  [--format {csv,binary}] [--compress] [--verbose]
+#                  [--backend {boto,async}] [--retries retries]
+#                  [--max-rate requests-per-sec] [--stats]
+#                  [--stats-file stats-file] [--stats-format {prometheus,json}]
+#                  bucket-name
+#
+# run several listing queries in a single pass over the versions of a particular
+# bucket
+#
+# positional arguments:
+#   bucket-name           name of bucket
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   -c s3-config-file     use this S3 configuration file (default:
+#                         $HOME/s3versioning.cnf)
+#   --prefix object-prefix
+#                         only scan objects starting with this prefix (default:
+#                         common prefix of all queries)
+#   --query query         listing query, i.e. the name of a listing tool
+#                         followed by its selection options and --output (may be
+#                         repeated)
+#   --shards shards       split the listing into this many key ranges at common
+#                         prefixes and list them in parallel (default: 1)
+#   --split-at object-name
+#                         split the listing after this object name instead of at
+#                         common prefixes (may be repeated)
+#   --delimiter delimiter
+#                         delimiter used to discover common prefixes (default:
+#                         /)
+#   --workers workers     list this many key ranges in parallel, each using its
+#                         own S3 connection (default: 4)
+#   --format {csv,binary}
+#                         write the versions in this format (default: csv)
+#   --compress            compress binary output
+#   --verbose, -v         log every selected version to stderr
+#   --backend {boto,async}
+#                         send the S3 requests through boto's connections or the
+#                         event loop of s3async (default: boto)
+#   --retries retries     retry throttled or failed S3 requests this many times
+#                         (default: 8)
+#   --max-rate requests-per-sec
+#                         never send more than this many S3 requests per second
+#   --stats               print request and pipeline statistics to stderr at
+#                         exit
+#   --stats-file stats-file
+#                         write request and pipeline statistics to this file at
+#                         exit
+#   --stats-format {prometheus,json}
+#                         format of the statistics file (default: prometheus)
+#
+# queries:
+#   s3lisov --output csv-file-output [--after yyyy-mm-ddThh:mm:ss]
+#           [--prefix object-prefix] [--only-deleted | --no-deleted]
+#   s3lisdv --output csv-file-output [--before yyyy-mm-ddThh:mm:ss]
+#           [--prefix object-prefix]
+#   s3listv --output csv-file-output --version-limit version-limit
+#           [--prefix object-prefix]
+#
+# example:
+#   s3scan.py --query "s3lisov --after 2017-01-01T00:00:00 -o changed.csv"
+#             --query "s3listv --version-limit 5 -o truncate.csv" bucket-name
+
+import sys
+import os
+import argparse
+import time
+import shlex
+import s3version
+import s3stats
+import s3connect
+import s3scheduler
+import s3log
+import s3format
+import s3select
+import s3lister
+
+# parsers of the queries, their options match the ones of the listing tools
+
+class QueryParser(argparse.ArgumentParser):
+
+  # hand query errors to main(), which reports them as errors of the s3scan command line
+
+  def error(self, message):
+    raise ValueError("query %s: %s" % (self.prog, message))
+
+query_parsers = {}
+
+q = QueryParser(prog="s3lisov", add_help=False)
+q.add_argument("--output", "-o", metavar="csv-file-output", required=True)
+q.add_argument("--after", metavar="yyyy-mm-ddThh:mm:ss")
+q.add_argument("--prefix", metavar="object-prefix")
+qgroup=q.add_mutually_exclusive_group()
+qgroup.add_argument("--only-deleted", action="store_true")
+qgroup.add_argument("--no-deleted", action="store_true")
+query_parsers["s3lisov"] = q
+
+q = QueryParser(prog="s3lisdv", add_help=False)
+q.add_argument("--output", "-o", metavar="csv-file-output", required=True)
+q.add_argument("--before", metavar="yyyy-mm-ddThh:mm:ss")
+q.add_argument("--prefix", metavar="object-prefix")
+query_parsers["s3lisdv"] = q
+
+q = QueryParser(prog="s3listv", add_help=False)
+q.add_argument("--output", "-o", metavar="csv-file-output", required=True)
+q.add_argument("--version-limit", metavar="version-limit", type=int, required=True)
+q.add_argument("--prefix", metavar="object-prefix")
+query_parsers["s3listv"] = q
+
+# command line arguments
+
+def make_parser(prog=None):
+  parser = argparse.ArgumentParser(prog = prog, description = "run several listing queries in a single pass over the versions of a particular bucket")
+  parser.add_argument("bucket", metavar="bucket-name", help="name of bucket")
+  parser.add_argument("-c", dest="s3_conf", metavar="s3-config-file", default=s3version.S3_CONF, help="use this S3 configuration file (default: %(default)s)")
+  parser.add_argument("--prefix", metavar="object-prefix", help="only scan objects starting with this prefix (default: common prefix of all queries)")
+  parser.add_argument("--query", metavar="query", action="append", required=True, help="listing query, i.e. the name of a listing tool followed by its selection options and --output (may be repeated)")
+  parser.add_argument("--shards", metavar="shards", type=int, default=1, help="split the listing into this many key ranges at common prefixes and list them in parallel (default: %(default)s)")
+  parser.add_argument("--split-at", metavar="object-name", action="append", help="split the listing after this object name instead of at common prefixes (may be repeated)")
+  parser.add_argument("--delimiter", metavar="delimiter", default="/", help="delimiter used to discover common prefixes (default: %(default)s)")
+  parser.add_argument("--workers", metavar="workers", type=int, default=4, help="list this many key ranges in parallel, each using its own S3 connection (default: %(default)s)")
+  parser.add_argument("--format", choices=s3format.S3_FORMATS, default="csv", help="write the versions in this format (default: %(default)s)")
+  parser.add_argument("--compress", action="store_true", help="compress binary output")
+  parser.add_argument("--verbose", "-v", action="store_true", help="log every selected version to stderr")
+  parser.add_argument("--backend", choices=s3connect.S3_BACKENDS, default="boto", help="send the S3 requests through boto's connections or the event loop of s3async (default: %(default)s)")
+  parser.add_argument("--retries", metavar="retries", type=int, default=s3scheduler.S3_SCHEDULER_RETRIES, help="retry throttled or failed S3 requests this many times (default: %(default)s)")
+  parser.add_argument("--max-rate", metavar="requests-per-sec", type=float, help="never send more than this many S3 requests per second")
+  parser.add_argument("--stats", action="store_true", help="print request and pipeline statistics to stderr at exit")
+  parser.add_argument("--stats-file", metavar="stats-file", help="write request and pipeline statistics to this file at exit")
+  parser.add_argument("--stats-format", choices=s3stats.S3_STATS_FORMATS, default="prometheus", help="format of the statistics file (default: %(default)s)")
+  return parser
+
+# answer the queries of the command line arguments argv (default: sys.argv) with one listing
+# connect opens the S3 connections instead of the S3 configuration file, returns the exit status
+
+def main(argv=None, connect=None, prog=None):
+  parser = make_parser(prog)
+  args = parser.parse_args(argv)
+
+  # record request and pipeline statistics if asked for, they are reported at exit
+
+  s3stats.setup("s3scan", args.stats, args.stats_file, args.stats_format)
+
+  # retry failed requests and adapt the number of requests in flight to the endpoint
+
+  if args.retries < 0:
+    parser.error("number of retries must not be negative")
+  if args.max_rate != None and args.max_rate <= 0:
+    parser.error("maximum request rate must be positive")
+  s3scheduler.setup(args.retries, args.max_rate)
+
+  s3_conf = args.s3_conf
+  bucket_name = args.bucket
+  prefix = args.prefix
+  shards = args.shards
+  split_at = args.split_at
+  delimiter = args.delimiter
+  workers = args.workers
+  format = args.format
+  compress = args.compress
+
+  if shards < 1:
+    parser.error("number of shards must be at least 1")
+  if workers < 1:
+    parser.error("number of workers must be at least 1")
+
+  # parse queries into (prefix, selector, output file) triples
+
+  queries = []
+  for query in args.query:
+    words = shlex.split(query)
+    if not words or os.path.splitext(os.path.basename(words[0]))[0] not in query_parsers:
+      parser.error("unknown query %r, queries start with one of %s" % (query, ", ".join(sorted(query_parsers))))
+    tool = os.path.splitext(os.path.basename(words[0]))[0]
+    try:
+      qargs = query_parsers[tool].parse_args(words[1:])
+    except ValueError as e:
+      parser.error(str(e))
+    if tool == "s3lisov":
+      if qargs.after == None:
+        after_sec = 0.0
+      else:
+        after_sec = time.mktime(time.strptime(qargs.after,"%Y-%m-%dT%H:%M:%S"))
+      selector = s3select.ModifiedSelector(after_sec, qargs.only_deleted, qargs.no_deleted)
+    elif tool == "s3lisdv":
+      if qargs.before == None:
+        before_sec = time.time()
+      else:
+        before_sec = time.mktime(time.strptime(qargs.before,"%Y-%m-%dT%H:%M:%S"))
+      selector = s3select.DeletedSelector(before_sec)
+    else:
+      selector = s3select.TruncationSelector(qargs.version_limit)
+    if prefix != None and qargs.prefix != None and not qargs.prefix.startswith(prefix):
+      parser.error("query %s: prefix %r is outside of the scanned prefix %r" % (tool, qargs.prefix, prefix))
+    queries.append((qargs.prefix, selector, qargs.output))
+
+  # without an explicit prefix scan the common prefix of all queries
+
+  if prefix == None and None not in [ p for p, s, o in queries ]:
+    prefix = os.path.commonprefix([ p for p, s, o in queries ]) or None
+
+  # parse config file and establish S3 connections, unless the caller hands over its own
+  # parallel listing workers each establish a connection of their own
+
+  if connect == None:
+    connect = s3connect.connector(s3connect.read_config(s3_conf), args.backend)
+
+  s3 = connect()
+
+  # prepare one output per query
+  # time the selectors and writers of all queries if statistics are recorded
+
+  scans = []
+  writers = []
+  for i, (qprefix, selector, output_file) in enumerate(queries):
+    writer = s3format.version_writer(open(output_file, "wb"), bucket_name, format, compress)
+    writers.append(writer)
+    scans.append((qprefix, s3stats.timed_call(selector.select, "select"), s3stats.timed_call(writer.write, "write", "selected"), i + 1))
+
+  log = None
+  if args.verbose:
+    log = s3log.VersionLog()
+
+  # list object versions in bucket once
+
+  bucket = s3.get_bucket(bucket_name)
+
+  # split the listing into shards, either at the specified object names or at common prefixes
+
+  if split_at:
+    split_points = split_at
+  else:
+    split_points = s3lister.discover_split_points(bucket, prefix, shards, delimiter)
+  open_bucket = lambda: connect().get_bucket(bucket_name, validate=False)
+
+  # the remaining versions of an object are skipped once no query covering its name can select any of them
+
+  selectors = [ (qprefix, selector) for qprefix, selector, output_file in queries ]
+
+  def skip_rest(v):
+    for qprefix, selector in selectors:
+      if (qprefix == None or v.name.startswith(qprefix)) and not selector.skip_rest(v):
+        return False
+    return True
+
+  # loop over all object versions
+  # s3lister takes care of pagination because get_all_versions() can only handle 1000 versions at a time
+  # hand every version to the selectors of all queries covering its name
+  # write versions selected by a query to the output of the query
+
+  for v in s3stats.timed(s3lister.list_versions(bucket, prefix, split_points, workers, open_bucket, skip=skip_rest), "list", "listed"):
+    for qprefix, select, write, i in scans:
+      if qprefix != None and not v.name.startswith(qprefix):
+        continue
+      if select(v):
+        if log != None:
+          log.write("query", str(i), "selected", v.name, v.version_id)
+        write(v)
+
+  for writer in writers:
+    writer.close()
+  if log != None:
+    log.close()
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+# s3scheduler
+#
+# by Walter Graf
+#
+# retries, adaptive concurrency and rate limiting of S3 requests
+#
+# Connections returned by schedule() send every request through the process
+# wide Scheduler instance scheduler, which
+# - retries requests failing with a 500, 502, 503 or 504 response or a
+#   connection error, waiting a jittered exponential backoff between the
+#   attempts (a random time up to base delay * 2^attempt, capped). boto's own
+#   retries are turned off so that every attempt is seen by the scheduler.
+# - limits the number of requests in flight across all threads with an AIMD
+#   controller: the limit grows by one per limit successful requests while it
+#   is in use and is halved (at most once per decrease interval) when a request
+#   is throttled, fails with a connection error or takes more than
+#   S3_SCHEDULER_LATENCY_FACTOR times the usual latency of its operation.
+#   Running the tools with many workers thus finds the concurrency the
+#   endpoint sustains on its own.
+# - optionally never starts more than a given number of requests per second.
+#
+# Requests are retried as a whole, which is safe for the requests the tools
+# send: listings, deletes of specific versions, bucket configuration and
+# server-side copies, which at worst make the same version current twice.
+
+import time
+import random
+import threading
+import socket
+import httplib
+import s3stats
+
+# number of times a failed request is retried
+S3_SCHEDULER_RETRIES = 8
+
+# backoff before the n-th retry is a random time up to min(max delay, base delay * 2^n) seconds
+S3_SCHEDULER_BASE_DELAY = 0.1
+S3_SCHEDULER_MAX_DELAY = 20.0
+
+# bounds of the number of requests in flight
+S3_SCHEDULER_MIN_CONCURRENCY = 1
+S3_SCHEDULER_MAX_CONCURRENCY = 256
+
+# multiplicative decrease of the concurrency limit and minimum seconds between two decreases
+S3_SCHEDULER_DECREASE = 0.5
+S3_SCHEDULER_DECREASE_INTERVAL = 1.0
+
+# a request counts as congested if it takes this many times the usual latency of its
+# operation, but at least S3_SCHEDULER_LATENCY_FLOOR seconds
+S3_SCHEDULER_LATENCY_FACTOR = 4.0
+S3_SCHEDULER_LATENCY_FLOOR = 0.1
+
+S3_SCHEDULER_RETRY_STATUS = [ 500, 502, 503, 504 ]
+
+# connection errors (resets, timeouts, broken responses) retried like boto does
+S3_SCHEDULER_RETRY_EXCEPTIONS = (socket.error, httplib.HTTPException)
+
+# a response boto would have retried, raised to hand it to the scheduler
+
+class RetryableResponse(Exception):
+
+  def __init__(self, status, reason, body):
+    Exception.__init__(self, "%d %s" % (status, reason))
+    self.status = status
+    self.reason = reason
+    self.body = body
+
+def _check_response(response, i, next_sleep):
+  if response.status in S3_SCHEDULER_RETRY_STATUS:
+    raise RetryableResponse(response.status, response.reason, response.read())
+  return None
+
+class Scheduler(object):
+
+  def __init__(self, retries=S3_SCHEDULER_RETRIES, requests_per_sec=None, max_concurrency=S3_SCHEDULER_MAX_CONCURRENCY):
+    self.retries = retries
+    self.requests_per_sec = requests_per_sec
+    self.max_concurrency = max_concurrency
+    self.limit = float(max_concurrency)
+    self.in_flight = 0
+    self.condition = threading.Condition()
+    self.decreased = 0.0
+    self.latency = {}
+    self.next_start = 0.0
+
+  # call request(), retrying it according to the schedule
+  # request is a function sending one attempt of the request of operation op
+
+  def call(self, op, request):
+    attempt = 0
+    while True:
+      self._acquire()
+      started = time.time()
+      try:
+        response = request()
+      except RetryableResponse as e:
+        self.release(False)
+        s3stats.stats.event("throttled" if e.status == 503 else "server_error")
+        if attempt >= self.retries:
+          import boto.exception
+          raise boto.exception.BotoServerError(e.status, e.reason, e.body)
+      except S3_SCHEDULER_RETRY_EXCEPTIONS:
+        self.release(False)
+        s3stats.stats.event("connection_error")
+        if attempt >= self.retries:
+          raise
+      except Exception:
+        self.release(True)
+        raise
+      else:
+        self.release(self.usual(op, time.time() - started))
+        return response
+      attempt += 1
+      s3stats.stats.event("retry")
+      time.sleep(random.uniform(0, min(S3_SCHEDULER_MAX_DELAY, S3_SCHEDULER_BASE_DELAY * 2 ** attempt)))
+
+  # wait for a free slot and for the rate limit
+
+  def _acquire(self):
+    with self.condition:
+      while self.in_flight >= max(S3_SCHEDULER_MIN_CONCURRENCY, int(self.limit)):
+        self.condition.wait()
+      start = self._take()
+    if start > time.time():
+      time.sleep(start - time.time())
+
+  # take a free slot without waiting, for event loops sending requests themselves (s3async)
+  # returns the time the request may start at, None if there is no free slot
+  # the slot is freed by release() once the request is done
+
+  def acquire_nowait(self):
+    with self.condition:
+      if self.in_flight >= max(S3_SCHEDULER_MIN_CONCURRENCY, int(self.limit)):
+        return None
+      return self._take()
+
+  def _take(self):
+    self.in_flight += 1
+    if not self.requests_per_sec:
+      return 0.0
+    start = max(time.time(), self.next_start)
+    self.next_start = start + 1.0 / self.requests_per_sec
+    return start
+
+  # free the slot of a request, adjusting the limit to its outcome
+
+  def release(self, ok):
+    with self.condition:
+      if ok:
+        if self.in_flight >= int(self.limit):
+          self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+      else:
+        now = time.time()
+        if now - self.decreased >= S3_SCHEDULER_DECREASE_INTERVAL:
+          self.limit = max(S3_SCHEDULER_MIN_CONCURRENCY, min(self.limit, self.in_flight) * S3_SCHEDULER_DECREASE)
+          self.decreased = now
+          s3stats.stats.event("concurrency_decrease")
+      self.in_flight -= 1
+      self.condition.notify_all()
+
+  # True if latency is not congested for op, learning the usual latency of op on the way
+  # the usual latency follows lower latencies immediately and higher ones slowly
+
+  def usual(self, op, latency):
+    with self.condition:
+      usual = self.latency.get(op)
+      if usual == None or latency < usual:
+        self.latency[op] = latency
+        return True
+      self.latency[op] = usual + (latency - usual) * 0.01
+    return latency < max(usual * S3_SCHEDULER_LATENCY_FACTOR, S3_SCHEDULER_LATENCY_FLOOR)
+
+# the scheduler of this process
+
+scheduler = Scheduler()
+
+# set once the configuration must no longer change, see fix()
+_fixed = False
+
+# configure the scheduler
+# retries             number of times a failed request is retried
+# requests_per_sec    never start more requests per second, None for no limit
+
+def setup(retries=S3_SCHEDULER_RETRIES, requests_per_sec=None):
+  if _fixed:
+    return
+  scheduler.retries = retries
+  scheduler.requests_per_sec = requests_per_sec
+
+# configure the scheduler for good, the setup() calls of the tools are ignored from now on
+# a process running many tools one after another or side by side (s3daemon) thereby keeps
+# one request budget for all of them
+
+def fix(retries=S3_SCHEDULER_RETRIES, requests_per_sec=None):
+  global _fixed
+  setup(retries, requests_per_sec)
+  _fixed = True
+
+# send the requests of a boto S3 connection through the scheduler
+
+def schedule(connection):
+  make_request = connection.make_request
+  def scheduled_make_request(method, bucket="", key="", headers=None, data="", query_args=None, sender=None, override_num_retries=None, retry_handler=None):
+    def check(response, i, next_sleep):
+      if retry_handler != None:
+        status = retry_handler(response, i, next_sleep)
+        if status:
+          return status
+      return _check_response(response, i, next_sleep)
+    op = s3stats.operation(method, key, query_args)
+    return scheduler.call(op, lambda: make_request(method, bucket, key, headers, data, query_args, sender, 0, check))
+  connection.make_request = scheduled_make_request
+  return connection
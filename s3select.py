@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+# s3select
+#
+# by Walter Graf
+#
+# version selection logic of the listing tools
+#
+# Each selector implements the selection criteria of one listing tool and is
+# fed with all versions (s3record.Version records) in S3 listing order, one
+# call of select() per version.
+# Selectors keeping per object state expose it with state() and restore() so
+# checkpointed listings can carry on in the middle of an object.
+# skip_rest() tells from a version alone, without the selector state, whether
+# any later version of the same object can still be selected. s3lister uses
+# it to jump past the remaining versions of decided objects.
+#
+#   ModifiedSelector    s3lisov  versions modified after a point in time
+#   DeletedSelector     s3lisdv  all versions of objects deleted before a point in time
+#   TruncationSelector  s3listv  versions exceeding a version limit
+
+class ModifiedSelector(object):
+
+  # skip objects with mod_time before or equal to after_sec
+  # skip existing (not deleted) objects in case of only_deleted
+  # skip deleted objects in case of no_deleted
+
+  def __init__(self, after_sec=0.0, only_deleted=False, no_deleted=False):
+    self.after_sec = after_sec
+    self.only_deleted = only_deleted
+    self.no_deleted = no_deleted
+
+  def select(self, v):
+    if v.mod_time <= self.after_sec:
+      return False
+    has_del_marker = v.del_marker
+    is_deleted = has_del_marker and v.is_latest
+    if self.only_deleted:
+      if not is_deleted:
+        return False
+    if self.no_deleted:
+       if is_deleted:
+        return False
+    return True
+
+  # versions of an object are listed newest first, so once one is modified before
+  # after_sec all following ones are, and only the latest one can be a deletion
+
+  def skip_rest(self, v):
+    return v.mod_time <= self.after_sec or self.only_deleted
+
+  def state(self):
+    return {}
+
+  def restore(self, state):
+    pass
+
+class DeletedSelector(object):
+
+  # select all versions of an object whose latest version is a delete marker
+  # skip objects deleted after or equal specified time (mod_time >= before_sec)
+
+  def __init__(self, before_sec):
+    self.before_sec = before_sec
+
+    # to handle all versions belonging to one name
+    self.current_name = None
+    self.selected = False
+
+  def select(self, v):
+    if v.name != self.current_name:
+      self.selected = False
+      self.current_name = v.name
+    has_del_marker = v.del_marker
+    is_deleted = has_del_marker and v.is_latest
+    if is_deleted and v.mod_time < self.before_sec:
+      self.selected = True
+    return self.selected
+
+  # the latest version decides about the object
+
+  def skip_rest(self, v):
+    return v.is_latest and not (v.del_marker and v.mod_time < self.before_sec)
+
+  def state(self):
+    return { "current_name": self.current_name, "selected": self.selected }
+
+  def restore(self, state):
+    self.current_name = state["current_name"]
+    self.selected = state["selected"]
+
+class TruncationSelector(object):
+
+  # count versions
+  # do not count delete markers
+  # select all versions beyond version limit
+
+  def __init__(self, version_limit):
+    self.version_limit = version_limit
+
+    # to handle correct version count
+    self.current_name = None
+    self.vcount = 0
+
+  def select(self, v):
+    if v.name != self.current_name:
+      self.vcount = 0
+      self.current_name = v.name
+    has_no_del_marker = not v.del_marker
+    if has_no_del_marker:
+      self.vcount += 1
+    return self.vcount > self.version_limit
+
+  # every object may have more versions beyond the limit
+
+  def skip_rest(self, v):
+    return False
+
+  def state(self):
+    return { "current_name": self.current_name, "vcount": self.vcount }
+
+  def restore(self, state):
+    self.current_name = state["current_name"]
+    self.vcount = state["vcount"]
@@ -5,60 +5,73 @@
 #
 # by Walter Graf
 #
-# usage: s3setv.py [-h] [-c s3-config-file] bucket-name
+# usage: s3setv.py [-h] [-c s3-config-file]
+#                  [--stats] [--stats-file stats-file]
+#                  [--stats-format {prometheus,json}]
+#                  bucket-name
 #
 # set versioning for existing bucket
 #
 # positional arguments:
-#   bucket-name        bucket name
+#   bucket-name           bucket name
 #
 # optional arguments:
-#   -h, --help         show this help message and exit
-#   -c s3-config-file  use this S3 configuration file (default:
-#                      $HOME/s3versioning.cnf)
+#   -h, --help            show this help message and exit
+#   -c s3-config-file     use this S3 configuration file (default:
+#                         $HOME/s3versioning.cnf)
+#   --stats               print request and pipeline statistics to stderr at
+#                         exit
+#   --stats-file stats-file
+#                         write request and pipeline statistics to this file at
+#                         exit
+#   --stats-format {prometheus,json}
+#                         format of the statistics file (default: prometheus)
 
 import sys
 import os
 import argparse
-import ConfigParser
-import boto
-import boto.s3.connection
 import s3version
+import s3stats
+import s3connect
 
-# parse command line arguments
+# command line arguments
 
-parser = argparse.ArgumentParser(description = "set versioning for existing bucket")
-parser.add_argument("bucket", metavar="bucket-name", help="bucket name")
-parser.add_argument("-c", dest="s3_conf", metavar="s3-config-file", default=s3version.S3_CONF, help="use this S3 configuration file (default: %(default)s)")
-args = parser.parse_args()
+def make_parser(prog=None):
+  parser = argparse.ArgumentParser(prog = prog, description = "set versioning for existing bucket")
+  parser.add_argument("bucket", metavar="bucket-name", help="bucket name")
+  parser.add_argument("-c", dest="s3_conf", metavar="s3-config-file", default=s3version.S3_CONF, help="use this S3 configuration file (default: %(default)s)")
+  parser.add_argument("--stats", action="store_true", help="print request and pipeline statistics to stderr at exit")
+  parser.add_argument("--stats-file", metavar="stats-file", help="write request and pipeline statistics to this file at exit")
+  parser.add_argument("--stats-format", choices=s3stats.S3_STATS_FORMATS, default="prometheus", help="format of the statistics file (default: %(default)s)")
+  return parser
 
-s3_conf = args.s3_conf
-bucket_name = args.bucket
+# turn on versioning for an existing bucket as asked for by the command line arguments argv
+# (default: sys.argv), connect opens the S3 connections instead of the S3 configuration file
+# returns the exit status
 
-# parse config file
+def main(argv=None, connect=None, prog=None):
+  parser = make_parser(prog)
+  args = parser.parse_args(argv)
 
-cnf = ConfigParser.RawConfigParser()
-cnf.read(s3_conf)
+  # record request and pipeline statistics if asked for, they are reported at exit
 
-access = cnf.get("connect", "access")
-secret = cnf.get("connect", "secret")
-host = cnf.get("connect", "host")
-port = cnf.getint("connect", "port")
-is_secure = cnf.getboolean("connect", "is_secure")
+  s3stats.setup("s3setv", args.stats, args.stats_file, args.stats_format)
 
-# establish S3 connection
+  s3_conf = args.s3_conf
+  bucket_name = args.bucket
 
-s3 = boto.connect_s3(
-  aws_access_key_id = access,
-  aws_secret_access_key = secret,
-  host = host,
-  port = port,
-  is_secure = is_secure,
-  calling_format = boto.s3.connection.OrdinaryCallingFormat()
-  )
+  # parse config file and establish S3 connection, unless the caller hands over its own
 
-# set versioning in existing bucket
+  if connect == None:
+    connect = s3connect.connector(s3connect.read_config(s3_conf))
+  s3 = connect()
 
-bucket = s3.get_bucket(bucket_name)
-print >> sys.stderr, "Enabling versioning"
-bucket.configure_versioning(True)
+  # set versioning in existing bucket
+
+  bucket = s3.get_bucket(bucket_name)
+  print >> sys.stderr, "Enabling versioning"
+  bucket.configure_versioning(True)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
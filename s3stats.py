@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+
+# s3stats
+#
+# by Walter Graf
+#
+# instrumentation of the tools
+#
+# The tools record into the process wide Stats instance stats:
+# - every S3 request, by operation: count, errors, latency histogram and bytes
+#   sent and received. Connections returned by instrument() record their
+#   requests; the latency is measured up to the response headers.
+# - the time spent in each stage of a tool's pipeline (listing, parsing,
+#   selecting, writing, deleting, ...) and the number of versions passing a
+#   stage. Stages are measured by wrapping iterables with timed() and
+#   functions with timed_call(). Stage times of parallel workers add up.
+# - events like retried or throttled requests.
+#
+# Recording is disabled unless setup() has been called with an output, all
+# helpers then return the objects they are handed unchanged so the hot loops
+# do not pay for the instrumentation. At exit the statistics are reported as
+# a text summary on stderr and/or written to a file as JSON or in the
+# Prometheus text format, e.g. for the textfile collector of node exporter.
+# The processes s3fanout forks for several buckets write their statistics to
+# a file, the process that forked them adds them up with merge().
+
+import sys
+import os
+import time
+import json
+import atexit
+import threading
+
+S3_STATS_FORMATS = [ "prometheus", "json" ]
+
+# upper bounds of the latency histogram buckets in seconds
+S3_STATS_BUCKETS = [ 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf") ]
+
+S3_STATS_METRIC_PREFIX = "s3versioning_"
+
+class Stats(object):
+
+  def __init__(self):
+    self.enabled = False
+    self.tool = None
+    self.started = time.time()
+    self.lock = threading.Lock()
+    self.requests = {}
+    self.stages = {}
+    self.counters = {}
+    self.events = {}
+
+  # one S3 request of operation op, status is None if no response was received
+
+  def request(self, op, seconds, sent, status):
+    with self.lock:
+      r = self.requests.get(op)
+      if r == None:
+        r = self.requests[op] = { "count": 0, "errors": 0, "seconds": 0.0, "sent": 0, "received": 0, "buckets": [ 0 ] * len(S3_STATS_BUCKETS) }
+      r["count"] += 1
+      if status == None or status >= 300:
+        r["errors"] += 1
+      r["seconds"] += seconds
+      r["sent"] += sent
+      for i, le in enumerate(S3_STATS_BUCKETS):
+        if seconds <= le:
+          r["buckets"][i] += 1
+          break
+
+  def received(self, op, n):
+    with self.lock:
+      self.requests[op]["received"] += n
+
+  def stage(self, name, seconds):
+    with self.lock:
+      self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+  def count(self, name, n=1):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + n
+
+  # something worth counting happened, e.g. a request was retried
+
+  def event(self, name):
+    with self.lock:
+      self.events[name] = self.events.get(name, 0) + 1
+
+  # add the statistics d of another process, as returned by as_dict()
+
+  def merge(self, d):
+    with self.lock:
+      for op, r in d["requests"].items():
+        mine = self.requests.get(op)
+        if mine == None:
+          self.requests[op] = dict(r, buckets=list(r["buckets"]))
+          continue
+        for k in [ "count", "errors", "seconds", "sent", "received" ]:
+          mine[k] += r[k]
+        mine["buckets"] = [ a + b for a, b in zip(mine["buckets"], r["buckets"]) ]
+      for name, seconds in d["stages"].items():
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+      for name, n in d["counters"].items():
+        self.counters[name] = self.counters.get(name, 0) + n
+      for name, n in d["events"].items():
+        self.events[name] = self.events.get(name, 0) + n
+
+  def clear(self):
+    with self.lock:
+      self.requests = {}
+      self.stages = {}
+      self.counters = {}
+      self.events = {}
+
+  def elapsed(self):
+    return time.time() - self.started
+
+  def as_dict(self):
+    with self.lock:
+      return {
+        "tool": self.tool,
+        "started": self.started,
+        "elapsed": self.elapsed(),
+        "requests": dict([ (op, dict(r, buckets=list(r["buckets"]))) for op, r in self.requests.items() ]),
+        "stages": dict(self.stages),
+        "counters": dict(self.counters),
+        "events": dict(self.events)
+        }
+
+# the statistics of this process
+
+stats = Stats()
+
+# enable recording for tool and report at exit
+# show      print a summary to stderr
+# output    write the statistics to this file, replaced atomically
+# format    format of output, prometheus or json
+# tools called as functions set up the statistics once per call, the statistics of all
+# calls add up under the tool of the first call recording them and are reported once, as
+# asked for by the last call recording them
+
+_report = None
+
+def setup(tool, show=False, output=None, format="prometheus"):
+  global _report
+  if not stats.enabled:
+    stats.tool = tool
+    stats.started = time.time()
+  if not show and output == None:
+    return
+  stats.enabled = True
+  if _report == None:
+    atexit.register(_report_at_exit)
+  _report = (show, output, format)
+
+def _report_at_exit():
+  show, output, format = _report
+  if show:
+    print_summary(sys.stderr)
+  if output != None:
+    write(output, format)
+
+# add the statistics another process wrote to path as JSON to the statistics of this process
+
+def merge(path):
+  with open(path, "rb") as f:
+    stats.merge(json.load(f))
+
+# name of the S3 operation of a request
+
+def operation(method, key, query_args):
+  query = (query_args or "").split("&")[0].split("=")[0]
+  if method == "GET" and not key and query in [ "versions", "versioning" ]:
+    return "list_versions" if query == "versions" else "get_versioning"
+  if method == "POST" and query == "delete":
+    return "delete_objects"
+  if key:
+    return { "GET": "get_object", "HEAD": "head_object", "PUT": "put_object", "DELETE": "delete_object" }.get(method, method.lower() + "_object")
+  if query:
+    return method.lower() + "_" + query
+  return { "GET": "list_objects", "HEAD": "head_bucket", "PUT": "create_bucket", "DELETE": "delete_bucket" }.get(method, method.lower() + "_bucket")
+
+# record the requests of a boto S3 connection
+
+def instrument(connection):
+  if not stats.enabled:
+    return connection
+  make_request = connection.make_request
+  def timed_make_request(method, bucket="", key="", headers=None, data="", query_args=None, *args, **kwargs):
+    op = operation(method, key, query_args)
+    sent = len(data) if isinstance(data, basestring) else 0
+    started = time.time()
+    try:
+      response = make_request(method, bucket, key, headers, data, query_args, *args, **kwargs)
+    except Exception as e:
+      stats.request(op, time.time() - started, sent, getattr(e, "status", None))
+      raise
+    stats.request(op, time.time() - started, sent, response.status)
+    _count_received(response, op)
+    return response
+  connection.make_request = timed_make_request
+  return connection
+
+# boto caches the body of a response, only the first complete read counts
+
+def _count_received(response, op):
+  read = response.read
+  state = { "read": False }
+  def counted_read(amt=None):
+    data = read(amt)
+    if amt != None or not state["read"]:
+      stats.received(op, len(data))
+    if amt == None:
+      state["read"] = True
+    return data
+  response.read = counted_read
+
+# yield the items of iterable, recording the time spent waiting for them as stage
+# and their number as counter
+
+def timed(iterable, stage, counter=None):
+  if not stats.enabled:
+    return iterable
+  return _timed(iterable, stage, counter)
+
+def _timed(iterable, stage, counter):
+  it = iter(iterable)
+  seconds = 0.0
+  n = 0
+  try:
+    while True:
+      started = time.time()
+      try:
+        item = it.next()
+      except StopIteration:
+        seconds += time.time() - started
+        break
+      seconds += time.time() - started
+      n += 1
+      yield item
+  finally:
+    stats.stage(stage, seconds)
+    if counter != None:
+      stats.count(counter, n)
+
+# function recording the time spent in calls of function as stage
+# and the number of calls as counter
+
+def timed_call(function, stage, counter=None):
+  if not stats.enabled:
+    return function
+  def call(*args, **kwargs):
+    started = time.time()
+    try:
+      return function(*args, **kwargs)
+    finally:
+      stats.stage(stage, time.time() - started)
+      if counter != None:
+        stats.count(counter)
+  return call
+
+# summary, latencies are upper bounds of the histogram buckets
+
+def _quantile(buckets, count, q):
+  n = 0
+  for i, le in enumerate(S3_STATS_BUCKETS):
+    n += buckets[i]
+    if n >= q * count:
+      return le
+  return S3_STATS_BUCKETS[-1]
+
+def _size(n):
+  for unit in [ "B", "KB", "MB", "GB" ]:
+    if n < 1024 or unit == "GB":
+      return "%.1f %s" % (n, unit) if unit != "B" else "%d B" % n
+    n /= 1024.0
+
+def _ms(seconds):
+  return "inf" if seconds == float("inf") else "%.1f" % (seconds * 1000)
+
+def print_summary(output):
+  d = stats.as_dict()
+  elapsed = d["elapsed"]
+  print >> output, "%s statistics, elapsed %.3f s" % (d["tool"], elapsed)
+  for name, n in sorted(d["counters"].items()):
+    print >> output, "  %-24s %12d %12.0f /s" % ("versions " + name, n, n / elapsed if elapsed > 0 else 0)
+  if d["requests"]:
+    print >> output, "  %-24s %8s %8s %9s %9s %9s %9s %10s %10s" % ("requests", "count", "errors", "avg ms", "p50 ms", "p90 ms", "p99 ms", "sent", "received")
+    for op, r in sorted(d["requests"].items()):
+      count = r["count"]
+      print >> output, "  %-24s %8d %8d %9.1f %9s %9s %9s %10s %10s" % (op, count, r["errors"], r["seconds"] / count * 1000,
+        _ms(_quantile(r["buckets"], count, 0.5)), _ms(_quantile(r["buckets"], count, 0.9)), _ms(_quantile(r["buckets"], count, 0.99)), _size(r["sent"]), _size(r["received"]))
+  if d["stages"]:
+    print >> output, "  %-24s %12s" % ("stages", "seconds")
+    for name, seconds in sorted(d["stages"].items()):
+      print >> output, "  %-24s %12.3f" % (name, seconds)
+  if d["events"]:
+    print >> output, "  %-24s %12s" % ("events", "count")
+    for name, n in sorted(d["events"].items()):
+      print >> output, "  %-24s %12d" % (name, n)
+
+# write the statistics to path, replacing it atomically
+
+def write(path, format="prometheus"):
+  d = stats.as_dict()
+  if format == "json":
+    data = json.dumps(d, indent=2, sort_keys=True) + "\n"
+  else:
+    data = prometheus(d)
+  tmp = path + ".tmp"
+  with open(tmp, "wb") as f:
+    f.write(data)
+  os.rename(tmp, path)
+
+def _labels(**labels):
+  return "{" + ",".join([ '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in sorted(labels.items()) ]) + "}"
+
+def _le(le):
+  return "+Inf" if le == float("inf") else repr(le)
+
+def prometheus(d):
+  tool = d["tool"]
+  p = S3_STATS_METRIC_PREFIX
+  lines = []
+  def metric(name, type, help, samples):
+    lines.append("# HELP %s%s %s" % (p, name, help))
+    lines.append("# TYPE %s%s %s" % (p, name, type))
+    for suffix, labels, value in samples:
+      lines.append("%s%s%s%s %s" % (p, name, suffix, _labels(**labels), repr(value) if isinstance(value, float) else value))
+  requests = sorted(d["requests"].items())
+  metric("last_run_timestamp_seconds", "gauge", "start time of the last run", [ ("", { "tool": tool }, d["started"]) ])
+  metric("elapsed_seconds", "gauge", "duration of the last run", [ ("", { "tool": tool }, d["elapsed"]) ])
+  metric("requests_total", "counter", "S3 requests by operation", [ ("", { "tool": tool, "operation": op }, r["count"]) for op, r in requests ])
+  metric("request_errors_total", "counter", "failed S3 requests by operation", [ ("", { "tool": tool, "operation": op }, r["errors"]) for op, r in requests ])
+  metric("sent_bytes_total", "counter", "request bytes sent by operation", [ ("", { "tool": tool, "operation": op }, r["sent"]) for op, r in requests ])
+  metric("received_bytes_total", "counter", "response bytes received by operation", [ ("", { "tool": tool, "operation": op }, r["received"]) for op, r in requests ])
+  samples = []
+  for op, r in requests:
+    n = 0
+    for le, count in zip(S3_STATS_BUCKETS, r["buckets"]):
+      n += count
+      samples.append(("_bucket", { "tool": tool, "operation": op, "le": _le(le) }, n))
+    samples.append(("_sum", { "tool": tool, "operation": op }, r["seconds"]))
+    samples.append(("_count", { "tool": tool, "operation": op }, r["count"]))
+  metric("request_duration_seconds", "histogram", "S3 request latency up to the response headers", samples)
+  metric("stage_seconds_total", "counter", "time spent in each pipeline stage", [ ("", { "tool": tool, "stage": name }, seconds) for name, seconds in sorted(d["stages"].items()) ])
+  metric("versions_total", "counter", "versions passing each pipeline stage", [ ("", { "tool": tool, "stage": name }, n) for name, n in sorted(d["counters"].items()) ])
+  metric("events_total", "counter", "retries, throttled requests and other events", [ ("", { "tool": tool, "event": name }, n) for name, n in sorted(d["events"].items()) ])
+  return "\n".join(lines) + "\n"
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# s3sync
+#
+# by Walter Graf
+#
+# usage: s3sync.py [-h] [-c s3-config-file] [--catalog catalog-file]
+#                  [--prefix object-prefix] [--if-older-than seconds]
+#                  [--shards shards] [--split-at object-name]
+#                  [--delimiter delimiter] [--workers workers]
+#                  [--backend {boto,async}] [--retries retries]
+#                  [--max-rate requests-per-sec] [--stats]
+#                  [--stats-file stats-file] [--stats-format {prometheus,json}]
+#                  bucket-name
+#
+# synchronize the local version catalog with a particular bucket
+#
+# positional arguments:
+#   bucket-name           name of bucket
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   -c s3-config-file     use this S3 configuration file (default:
+#                         $HOME/s3versioning.cnf)
+#   --catalog catalog-file
+#                         use this catalog file (default: $HOME/s3versioning.db)
+#   --prefix object-prefix
+#                         only synchronize objects starting with this prefix
+#   --if-older-than seconds
+#                         skip the synchronization if the prefix has been
+#                         synchronized less than this many seconds ago
+#   --shards shards       split the listing into this many key ranges at common
+#                         prefixes and list them in parallel (default: 1)
+#   --split-at object-name
+#                         split the listing after this object name instead of at
+#                         common prefixes (may be repeated)
+#   --delimiter delimiter
+#                         delimiter used to discover common prefixes (default:
+#                         /)
+#   --workers workers     list this many key ranges in parallel, each using its
+#                         own S3 connection (default: 4)
+#   --backend {boto,async}
+#                         send the S3 requests through boto's connections or the
+#                         event loop of s3async (default: boto)
+#   --retries retries     retry throttled or failed S3 requests this many times
+#                         (default: 8)
+#   --max-rate requests-per-sec
+#                         never send more than this many S3 requests per second
+#   --stats               print request and pipeline statistics to stderr at
+#                         exit
+#   --stats-file stats-file
+#                         write request and pipeline statistics to this file at
+#                         exit
+#   --stats-format {prometheus,json}
+#                         format of the statistics file (default: prometheus)
+
+import sys
+import os
+import argparse
+import time
+import calendar
+import s3version
+import s3stats
+import s3connect
+import s3scheduler
+import s3lister
+import s3catalog
+
+# command line arguments
+
+def make_parser(prog=None):
+  parser = argparse.ArgumentParser(prog = prog, description = "synchronize the local version catalog with a particular bucket")
+  parser.add_argument("bucket", metavar="bucket-name", help="name of bucket")
+  parser.add_argument("-c", dest="s3_conf", metavar="s3-config-file", default=s3version.S3_CONF, help="use this S3 configuration file (default: %(default)s)")
+  parser.add_argument("--catalog", metavar="catalog-file", default=s3version.S3_CATALOG, help="use this catalog file (default: %(default)s)")
+  parser.add_argument("--prefix", metavar="object-prefix", help="only synchronize objects starting with this prefix")
+  parser.add_argument("--if-older-than", metavar="seconds", type=int, help="skip the synchronization if the prefix has been synchronized less than this many seconds ago")
+  parser.add_argument("--shards", metavar="shards", type=int, default=1, help="split the listing into this many key ranges at common prefixes and list them in parallel (default: %(default)s)")
+  parser.add_argument("--split-at", metavar="object-name", action="append", help="split the listing after this object name instead of at common prefixes (may be repeated)")
+  parser.add_argument("--delimiter", metavar="delimiter", default="/", help="delimiter used to discover common prefixes (default: %(default)s)")
+  parser.add_argument("--workers", metavar="workers", type=int, default=4, help="list this many key ranges in parallel, each using its own S3 connection (default: %(default)s)")
+  parser.add_argument("--backend", choices=s3connect.S3_BACKENDS, default="boto", help="send the S3 requests through boto's connections or the event loop of s3async (default: %(default)s)")
+  parser.add_argument("--retries", metavar="retries", type=int, default=s3scheduler.S3_SCHEDULER_RETRIES, help="retry throttled or failed S3 requests this many times (default: %(default)s)")
+  parser.add_argument("--max-rate", metavar="requests-per-sec", type=float, help="never send more than this many S3 requests per second")
+  parser.add_argument("--stats", action="store_true", help="print request and pipeline statistics to stderr at exit")
+  parser.add_argument("--stats-file", metavar="stats-file", help="write request and pipeline statistics to this file at exit")
+  parser.add_argument("--stats-format", choices=s3stats.S3_STATS_FORMATS, default="prometheus", help="format of the statistics file (default: %(default)s)")
+  return parser
+
+# synchronize the catalog with a bucket as asked for by the command line arguments argv
+# (default: sys.argv), connect opens the S3 connections instead of the S3 configuration file
+# returns the exit status
+
+def main(argv=None, connect=None, prog=None):
+  parser = make_parser(prog)
+  args = parser.parse_args(argv)
+
+  # record request and pipeline statistics if asked for, they are reported at exit
+
+  s3stats.setup("s3sync", args.stats, args.stats_file, args.stats_format)
+
+  # retry failed requests and adapt the number of requests in flight to the endpoint
+
+  if args.retries < 0:
+    parser.error("number of retries must not be negative")
+  if args.max_rate != None and args.max_rate <= 0:
+    parser.error("maximum request rate must be positive")
+  s3scheduler.setup(args.retries, args.max_rate)
+
+  s3_conf = args.s3_conf
+  bucket_name = args.bucket
+  catalog_file = args.catalog
+  prefix = args.prefix
+  if_older_than = args.if_older_than
+  shards = args.shards
+  split_at = args.split_at
+  delimiter = args.delimiter
+  workers = args.workers
+
+  if shards < 1:
+    parser.error("number of shards must be at least 1")
+  if workers < 1:
+    parser.error("number of workers must be at least 1")
+
+  # open catalog and check the watermark of the prefix
+
+  catalog = s3catalog.Catalog(catalog_file)
+
+  if if_older_than != None:
+    synced = catalog.watermark(bucket_name, prefix)
+    if synced != None and calendar.timegm(time.strptime(synced, "%Y-%m-%dT%H:%M:%S")) > time.time() - if_older_than:
+      print >> sys.stderr, "prefix", repr(prefix or ""), "of bucket", bucket_name, "synchronized at", synced, "- skipping"
+      return 0
+
+  # parse config file and establish S3 connections, unless the caller hands over its own
+  # parallel listing workers each establish a connection of their own
+
+  if connect == None:
+    connect = s3connect.connector(s3connect.read_config(s3_conf), args.backend)
+
+  s3 = connect()
+
+  # list object versions in bucket and merge them into the catalog
+
+  bucket = s3.get_bucket(bucket_name)
+
+  # split the listing into shards, either at the specified object names or at common prefixes
+
+  if split_at:
+    split_points = split_at
+  else:
+    split_points = s3lister.discover_split_points(bucket, prefix, shards, delimiter)
+  open_bucket = lambda: connect().get_bucket(bucket_name, validate=False)
+
+  print >> sys.stderr, "synchronizing prefix", repr(prefix or ""), "of bucket", bucket_name, "into", catalog_file
+
+  # the sync stage includes the time spent waiting for the listing
+
+  sync = s3stats.timed_call(catalog.sync, "sync")
+  objects, changed, removed, versions = sync(bucket_name, prefix, s3stats.timed(s3lister.list_versions(bucket, prefix, split_points, workers, open_bucket), "list", "listed"))
+  catalog.close()
+
+  print >> sys.stderr, objects, "objects with", versions, "versions,", changed, "objects updated,", removed, "objects removed"
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
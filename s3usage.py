@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# s3usage
+#
+# by Walter Graf
+#
+# usage: s3usage.py [-h] [-c s3-config-file] [--output report-file]
+#                   [--format {json,csv}] [--prefix object-prefix]
+#                   [--depth depth] [--max-prefixes prefixes]
+#                   [--at yyyy-mm-ddThh:mm:ss] [--shards shards]
+#                   [--split-at object-name] [--delimiter delimiter]
+#                   [--workers workers] [--backend {boto,async}]
+#                   [--retries retries] [--max-rate requests-per-sec] [--stats]
+#                   [--stats-file stats-file] [--stats-format {prometheus,json}]
+#                   bucket-name
+#
+# report the storage used by the current and noncurrent versions of a bucket per
+# prefix
+#
+# positional arguments:
+#   bucket-name           name of bucket
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   -c s3-config-file     use this S3 configuration file (default:
+#                         $HOME/s3versioning.cnf)
+#   --output report-file, -o report-file
+#                         write the report to this file (default: stdout)
+#   --format {json,csv}   write the report in this format (default: json)
+#   --prefix object-prefix
+#                         only count objects starting with this prefix
+#   --depth depth         cut the object names after this many delimiters into
+#                         the prefixes reported (default: 1)
+#   --max-prefixes prefixes
+#                         count at most this many prefixes separately (default:
+#                         10000)
+#   --at yyyy-mm-ddThh:mm:ss
+#                         compute the age of noncurrent versions at this time
+#                         (default: now)
+#   --shards shards       split the listing into this many key ranges at common
+#                         prefixes and list them in parallel (default: 1)
+#   --split-at object-name
+#                         split the listing after this object name instead of at
+#                         common prefixes (may be repeated)
+#   --delimiter delimiter
+#                         delimiter cutting the object names into prefixes and
+#                         used to discover common prefixes (default: /)
+#   --workers workers     list this many key ranges in parallel, each using its
+#                         own S3 connection (default: 4)
+#   --backend {boto,async}
+#                         send the S3 requests through boto's connections or the
+#                         event loop of s3async (default: boto)
+#   --retries retries     retry throttled or failed S3 requests this many times
+#                         (default: 8)
+#   --max-rate requests-per-sec
+#                         never send more than this many S3 requests per second
+#   --stats               print request and pipeline statistics to stderr at
+#                         exit
+#   --stats-file stats-file
+#                         write request and pipeline statistics to this file at
+#                         exit
+#   --stats-format {prometheus,json}
+#                         format of the statistics file (default: prometheus)
+#
+# The versions are counted while they are listed, nothing is kept per object
+# except for the object being listed. Each object name is cut after --depth
+# delimiters into its prefix, e.g. a/b/c/d.txt into a/b/ at depth 2 and
+# objects higher up the tree into the prefix they are in, and every prefix
+# gets a fixed set of counters:
+#
+#   objects                   object names
+#   deleted_objects           objects whose latest version is a delete marker
+#   versions                  versions including delete markers
+#   delete_markers            delete markers
+#   current_versions/_bytes   latest versions which are no delete marker
+#   noncurrent_versions/_bytes
+#                             older versions which are no delete marker
+#   noncurrent_bytes_<age>    bytes of noncurrent versions by the time since
+#                             they became noncurrent (when the next version was
+#                             created), up to 1, 7, 30, 90 or 365 days or older
+#   objects_<n>_versions      objects by number of versions including delete
+#                             markers, up to 1, 2, 5, 10 or 100 or more
+#
+# Memory therefore depends on the number of prefixes, not on the number of
+# objects. Once --max-prefixes prefixes are counted, objects of further
+# prefixes are counted under the prefix "*". The report lists the prefixes
+# in order followed by the total, as JSON or as csv with one row per prefix
+# and a last row "(total)".
+
+import sys
+import argparse
+import time
+import csv
+import json
+import s3version
+import s3stats
+import s3connect
+import s3scheduler
+import s3lister
+
+# upper bounds of the age classes of noncurrent versions in days
+S3_USAGE_AGE_DAYS = [ 1, 7, 30, 90, 365 ]
+
+# upper bounds of the classes of objects by number of versions
+S3_USAGE_VERSION_COUNTS = [ 1, 2, 5, 10, 100 ]
+
+# prefix counting the objects of prefixes beyond the maximum number of prefixes
+S3_USAGE_OTHER = "*"
+
+# prefix column of the total in the csv report
+S3_USAGE_TOTAL = "(total)"
+
+S3_USAGE_FORMATS = [ "json", "csv" ]
+
+# command line arguments
+
+def make_parser(prog=None):
+  parser = argparse.ArgumentParser(prog = prog, description = "report the storage used by the current and noncurrent versions of a bucket per prefix")
+  parser.add_argument("bucket", metavar="bucket-name", help="name of bucket")
+  parser.add_argument("-c", dest="s3_conf", metavar="s3-config-file", default=s3version.S3_CONF, help="use this S3 configuration file (default: %(default)s)")
+  parser.add_argument("--output", "-o", metavar="report-file", help="write the report to this file (default: stdout)")
+  parser.add_argument("--format", choices=S3_USAGE_FORMATS, default="json", help="write the report in this format (default: %(default)s)")
+  parser.add_argument("--prefix", metavar="object-prefix", help="only count objects starting with this prefix")
+  parser.add_argument("--depth", metavar="depth", type=int, default=1, help="cut the object names after this many delimiters into the prefixes reported (default: %(default)s)")
+  parser.add_argument("--max-prefixes", metavar="prefixes", type=int, default=10000, help="count at most this many prefixes separately (default: %(default)s)")
+  parser.add_argument("--at", metavar="yyyy-mm-ddThh:mm:ss", help="compute the age of noncurrent versions at this time (default: now)")
+  parser.add_argument("--shards", metavar="shards", type=int, default=1, help="split the listing into this many key ranges at common prefixes and list them in parallel (default: %(default)s)")
+  parser.add_argument("--split-at", metavar="object-name", action="append", help="split the listing after this object name instead of at common prefixes (may be repeated)")
+  parser.add_argument("--delimiter", metavar="delimiter", default="/", help="delimiter cutting the object names into prefixes and used to discover common prefixes (default: %(default)s)")
+  parser.add_argument("--workers", metavar="workers", type=int, default=4, help="list this many key ranges in parallel, each using its own S3 connection (default: %(default)s)")
+  parser.add_argument("--backend", choices=s3connect.S3_BACKENDS, default="boto", help="send the S3 requests through boto's connections or the event loop of s3async (default: %(default)s)")
+  parser.add_argument("--retries", metavar="retries", type=int, default=s3scheduler.S3_SCHEDULER_RETRIES, help="retry throttled or failed S3 requests this many times (default: %(default)s)")
+  parser.add_argument("--max-rate", metavar="requests-per-sec", type=float, help="never send more than this many S3 requests per second")
+  parser.add_argument("--stats", action="store_true", help="print request and pipeline statistics to stderr at exit")
+  parser.add_argument("--stats-file", metavar="stats-file", help="write request and pipeline statistics to this file at exit")
+  parser.add_argument("--stats-format", choices=s3stats.S3_STATS_FORMATS, default="prometheus", help="format of the statistics file (default: %(default)s)")
+  return parser
+
+# names of the age classes and the classes of objects by number of versions
+
+def _age_names():
+  return [ "%dd" % d for d in S3_USAGE_AGE_DAYS ] + [ "older" ]
+
+def _count_names():
+  return [ str(n) for n in S3_USAGE_VERSION_COUNTS ] + [ "more" ]
+
+def _class(bounds, value):
+  for i, bound in enumerate(bounds):
+    if value <= bound:
+      return i
+  return len(bounds)
+
+# the counters of one prefix
+
+class Usage(object):
+
+  COUNTERS = [ "objects", "deleted_objects", "versions", "delete_markers", "current_versions", "current_bytes", "noncurrent_versions", "noncurrent_bytes" ]
+
+  def __init__(self):
+    for name in self.COUNTERS:
+      setattr(self, name, 0)
+    self.noncurrent_bytes_by_age = [ 0 ] * (len(S3_USAGE_AGE_DAYS) + 1)
+    self.objects_by_versions = [ 0 ] * (len(S3_USAGE_VERSION_COUNTS) + 1)
+
+  def add(self, other):
+    for name in self.COUNTERS:
+      setattr(self, name, getattr(self, name) + getattr(other, name))
+    self.noncurrent_bytes_by_age = [ a + b for a, b in zip(self.noncurrent_bytes_by_age, other.noncurrent_bytes_by_age) ]
+    self.objects_by_versions = [ a + b for a, b in zip(self.objects_by_versions, other.objects_by_versions) ]
+
+  # flat dictionary of all counters, the column names of the csv report
+
+  def as_dict(self):
+    d = dict([ (name, getattr(self, name)) for name in self.COUNTERS ])
+    for name, n in zip(_age_names(), self.noncurrent_bytes_by_age):
+      d["noncurrent_bytes_" + name] = n
+    for name, n in zip(_count_names(), self.objects_by_versions):
+      d["objects_%s_versions" % name] = n
+    return d
+
+def _columns():
+  return Usage.COUNTERS + [ "noncurrent_bytes_" + name for name in _age_names() ] + [ "objects_%s_versions" % name for name in _count_names() ]
+
+# counts the versions of a listing per prefix
+# the versions are expected in listing order, all versions of an object next to each other, newest first
+
+class UsageCounter(object):
+
+  def __init__(self, depth, delimiter, max_prefixes, at_sec):
+    self.depth = depth
+    self.delimiter = delimiter
+    self.max_prefixes = max_prefixes
+    self.at_sec = at_sec
+    self.prefixes = {}
+    self.overflowed = False
+
+    # the object being counted
+
+    self.current_name = None
+    self.usage = None
+    self.vcount = 0
+    self.newer_mod_time = None
+
+  # prefix of an object name, cut after depth delimiters
+
+  def prefix_of(self, name):
+    parts = name.split(self.delimiter)
+    return "".join([ p + self.delimiter for p in parts[:min(self.depth, len(parts) - 1)] ])
+
+  def add(self, v):
+    if v.name != self.current_name:
+      self._finish_object()
+      self.current_name = v.name
+      prefix = self.prefix_of(v.name)
+      usage = self.prefixes.get(prefix)
+      if usage == None:
+        if len(self.prefixes) >= self.max_prefixes:
+          prefix = S3_USAGE_OTHER
+          self.overflowed = True
+          usage = self.prefixes.get(prefix)
+        if usage == None:
+          usage = self.prefixes[prefix] = Usage()
+      self.usage = usage
+      usage.objects += 1
+      if v.is_latest and v.del_marker:
+        usage.deleted_objects += 1
+    usage = self.usage
+    usage.versions += 1
+    self.vcount += 1
+    if v.del_marker:
+      usage.delete_markers += 1
+    elif v.is_latest:
+      usage.current_versions += 1
+      usage.current_bytes += v.size
+    else:
+      usage.noncurrent_versions += 1
+      usage.noncurrent_bytes += v.size
+
+      # a version became noncurrent when the next newer one was created
+
+      noncurrent_since = self.newer_mod_time if self.newer_mod_time != None else v.mod_time
+      age_days = max(0.0, self.at_sec - noncurrent_since) / 86400.0
+      usage.noncurrent_bytes_by_age[_class(S3_USAGE_AGE_DAYS, age_days)] += v.size
+    self.newer_mod_time = v.mod_time
+
+  def _finish_object(self):
+    if self.usage != None:
+      self.usage.objects_by_versions[_class(S3_USAGE_VERSION_COUNTS, self.vcount)] += 1
+    self.usage = None
+    self.vcount = 0
+    self.newer_mod_time = None
+
+  # the counters of all prefixes in prefix order, those of further prefixes last, and their total
+
+  def close(self):
+    self._finish_object()
+    total = Usage()
+    for usage in self.prefixes.values():
+      total.add(usage)
+    prefixes = sorted([ (prefix, usage) for prefix, usage in self.prefixes.items() if prefix != S3_USAGE_OTHER ])
+    if self.overflowed:
+      prefixes.append((S3_USAGE_OTHER, self.prefixes[S3_USAGE_OTHER]))
+    return prefixes, total
+
+# write the report as JSON
+
+def write_json(output, bucket_name, depth, at, prefixes, total):
+  report = {
+    "bucket": bucket_name,
+    "depth": depth,
+    "at": at,
+    "prefixes": [ dict(usage.as_dict(), prefix=prefix) for prefix, usage in prefixes ],
+    "total": total.as_dict()
+    }
+  output.write(json.dumps(report, indent=2, sort_keys=True) + "\n")
+
+# write the report as csv, one row per prefix followed by the total
+
+def write_csv(output, bucket_name, depth, at, prefixes, total):
+  writer = csv.DictWriter(output, [ "bucket", "prefix" ] + _columns(), delimiter=",", quotechar='"')
+  writer.writerow(dict([ (k, k) for k in [ "bucket", "prefix" ] + _columns() ]))
+  for prefix, usage in prefixes:
+    writer.writerow(dict(usage.as_dict(), bucket=bucket_name, prefix=prefix.encode("utf-8") if isinstance(prefix, unicode) else prefix))
+  writer.writerow(dict(total.as_dict(), bucket=bucket_name, prefix=S3_USAGE_TOTAL))
+
+# report the storage used as asked for by the command line arguments argv (default: sys.argv)
+# connect opens the S3 connections instead of the S3 configuration file
+# returns the exit status
+
+def main(argv=None, connect=None, prog=None):
+  parser = make_parser(prog)
+  args = parser.parse_args(argv)
+
+  # record request and pipeline statistics if asked for, they are reported at exit
+
+  s3stats.setup("s3usage", args.stats, args.stats_file, args.stats_format)
+
+  # retry failed requests and adapt the number of requests in flight to the endpoint
+
+  if args.retries < 0:
+    parser.error("number of retries must not be negative")
+  if args.max_rate != None and args.max_rate <= 0:
+    parser.error("maximum request rate must be positive")
+  s3scheduler.setup(args.retries, args.max_rate)
+
+  s3_conf = args.s3_conf
+  bucket_name = args.bucket
+  output_file = args.output
+  prefix = args.prefix
+  depth = args.depth
+  max_prefixes = args.max_prefixes
+  if args.at == None:
+    at_sec = time.time()
+    at = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(at_sec))
+  else:
+    at_sec = time.mktime(time.strptime(args.at,"%Y-%m-%dT%H:%M:%S"))
+    at = args.at
+  shards = args.shards
+  split_at = args.split_at
+  delimiter = args.delimiter
+  workers = args.workers
+
+  if depth < 0:
+    parser.error("depth must not be negative")
+  if max_prefixes < 1:
+    parser.error("maximum number of prefixes must be at least 1")
+  if shards < 1:
+    parser.error("number of shards must be at least 1")
+  if workers < 1:
+    parser.error("number of workers must be at least 1")
+
+  # parse config file and establish S3 connections, unless the caller hands over its own
+  # parallel listing workers each establish a connection of their own
+
+  if connect == None:
+    connect = s3connect.connector(s3connect.read_config(s3_conf), args.backend)
+
+  s3 = connect()
+  bucket = s3.get_bucket(bucket_name)
+
+  # split the listing into shards, either at the specified object names or at common prefixes
+
+  if split_at:
+    split_points = split_at
+  else:
+    split_points = s3lister.discover_split_points(bucket, prefix, shards, delimiter)
+  open_bucket = lambda: connect().get_bucket(bucket_name, validate=False)
+
+  # count all object versions as they are listed
+
+  counter = UsageCounter(depth, delimiter, max_prefixes, at_sec)
+  add = s3stats.timed_call(counter.add, "count")
+  for v in s3stats.timed(s3lister.list_versions(bucket, prefix, split_points, workers, open_bucket), "list", "listed"):
+    add(v)
+  prefixes, total = counter.close()
+  if counter.overflowed:
+    print >> sys.stderr, "more than", max_prefixes, "prefixes, the objects of further prefixes are counted under", S3_USAGE_OTHER
+
+  output = open(output_file, "wb") if output_file != None else sys.stdout
+  if args.format == "csv":
+    write_csv(output, bucket_name, depth, at, prefixes, total)
+  else:
+    write_json(output, bucket_name, depth, at, prefixes, total)
+  if output != sys.stdout:
+    output.close()
+  print >> sys.stderr, total.objects, "objects,", total.versions, "versions,", total.current_bytes, "current bytes,", total.noncurrent_bytes, "noncurrent bytes in", len(prefixes), "prefixes"
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
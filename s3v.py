@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# s3v
+#
+# by Walter Graf
+#
+# usage: s3v.py [-h] subcommand ...
+#
+# run a tool of the S3 versioning toolset
+#
+# positional arguments:
+#   subcommand  tool to run
+#   argument    arguments of the tool
+#
+# optional arguments:
+#   -h, --help  show this help message and exit
+#
+# subcommands:
+#   makvb      make versioned bucket
+#   setv       set versioning for existing bucket
+#   lisov      list object versions for a particular bucket
+#   lisdv      list all versions of a deleted object for a particular bucket
+#   listv      list truncated versions for a particular bucket
+#   delov      delete object versions according to a csv file or binary version list
+#   plan       compile version lists into a sorted, deduplicated and sharded delete plan for s3delov
+#   delvb      delete versioned bucket including its versioned objects
+#   scan       run several listing queries in a single pass over the versions of a bucket
+#   diff       list the changes between two version listings of a bucket
+#   usage      report the storage used by the current and noncurrent versions of a bucket per prefix
+#   sync       synchronize the local version catalog with a particular bucket
+#   retain     remove the versions of a bucket expired by the retention policies
+#   restore    restore the objects of a bucket to the versions current at a point in time
+#   verify     verify the content of object versions against their checksums
+#   daemon     run listing, delete and restore jobs of local clients with warm S3 connections
+#   job        run a listing, delete or restore job in s3daemon
+#
+# see s3v subcommand -h for the arguments of a subcommand
+#
+# All tools of the toolset are subcommands of s3v, e.g. "s3v lisov bucket" is
+# the same as "s3lisov.py bucket". The tool of a subcommand is only imported
+# when the subcommand is run and boto only once the first S3 connection is
+# opened (see s3connect), so that s3v -h and argument errors are answered
+# without loading either.
+#
+# Batch jobs can run the tools as Python functions in one process instead of
+# starting an interpreter per call:
+#
+#   import s3v, s3connect
+#   connect = s3connect.connector(s3connect.read_config("s3versioning.cnf"))
+#   status = s3v.run("lisov", [ "--after", "2020-01-01T00:00:00", "-o", "new.csv", "bucket" ], connect)
+#
+# run() returns the exit status of the tool, argument errors raise SystemExit
+# like on the command line. A connect function handed over is used for all
+# connections of the tool instead of the -c configuration file, so the
+# configuration is read once per batch.
+
+import sys
+import argparse
+
+# subcommands with their descriptions, the tool of subcommand c is the module s3<c>
+
+S3V_COMMANDS = [
+  ("makvb", "make versioned bucket"),
+  ("setv", "set versioning for existing bucket"),
+  ("lisov", "list object versions for a particular bucket"),
+  ("lisdv", "list all versions of a deleted object for a particular bucket"),
+  ("listv", "list truncated versions for a particular bucket"),
+  ("delov", "delete object versions according to a csv file or binary version list"),
+  ("plan", "compile version lists into a sorted, deduplicated and sharded delete plan for s3delov"),
+  ("delvb", "delete versioned bucket including its versioned objects"),
+  ("scan", "run several listing queries in a single pass over the versions of a bucket"),
+  ("diff", "list the changes between two version listings of a bucket"),
+  ("usage", "report the storage used by the current and noncurrent versions of a bucket per prefix"),
+  ("sync", "synchronize the local version catalog with a particular bucket"),
+  ("retain", "remove the versions of a bucket expired by the retention policies"),
+  ("restore", "restore the objects of a bucket to the versions current at a point in time"),
+  ("verify", "verify the content of object versions against their checksums"),
+  ("daemon", "run listing, delete and restore jobs of local clients with warm S3 connections"),
+  ("job", "run a listing, delete or restore job in s3daemon"),
+  ]
+
+# command line arguments, the arguments following the subcommand are left to its tool
+
+def make_parser(prog=None):
+  parser = argparse.ArgumentParser(prog = prog, description = "run a tool of the S3 versioning toolset",
+    formatter_class = argparse.RawDescriptionHelpFormatter,
+    epilog = "subcommands:\n" + "\n".join([ "  %-10s %s" % c for c in S3V_COMMANDS ]) + "\n\nsee s3v subcommand -h for the arguments of a subcommand")
+  parser.add_argument("command", metavar="subcommand", choices=[ c for c, d in S3V_COMMANDS ], help="tool to run")
+  parser.add_argument("args", metavar="argument", nargs=argparse.REMAINDER, help="arguments of the tool")
+  return parser
+
+# run the tool of subcommand command with the command line arguments argv
+# connect opens the S3 connections instead of the S3 configuration file
+# returns the exit status of the tool
+
+def run(command, argv, connect=None):
+  if command not in [ c for c, d in S3V_COMMANDS ]:
+    raise ValueError("unknown subcommand %r" % command)
+  tool = __import__("s3" + command)
+  return tool.main(argv, connect, "s3v " + command)
+
+# run the subcommand of the command line arguments argv (default: sys.argv)
+# returns the exit status
+
+def main(argv=None):
+  parser = make_parser()
+  args = parser.parse_args(argv)
+  return run(args.command, args.args)
+
+if __name__ == "__main__":
+  sys.exit(main())
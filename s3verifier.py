@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+# s3verifier
+#
+# by Walter Graf
+#
+# content verification of object versions
+#
+# ContentVerifier reads object versions with ranged GETs spread over a pool of
+# worker threads, each owning its own S3 connection, and checks the MD5 of the
+# content against a reference checksum:
+# - the MD5 of a manifest, if one is given and lists the version
+# - otherwise the ETag, which S3 sets to the MD5 of the content of objects
+#   uploaded in one piece. Objects uploaded in parts carry the MD5 of the MD5s
+#   of their parts, followed by the number of parts. The part size is not
+#   recorded, the content is checked against the common part sizes fitting the
+#   size of the object at once; if none of them matches the version is
+#   reported as unverifiable. ETags of objects encrypted with SSE-C or SSE-KMS
+#   are not MD5s at all, such objects need a manifest.
+#
+# The ranges of all versions queue up in order. While the workers fetch the
+# next ranges, the caller's thread feeds the oldest fetched range into the
+# checksums of its version, so that the content is streamed through the
+# checksums and never more than window ranges are held in memory.
+#
+# The results are handed to on_result(v, status, detail) from the caller's
+# thread, status being one of S3_VERIFY_OK, S3_VERIFY_MISMATCH,
+# S3_VERIFY_UNVERIFIABLE and S3_VERIFY_ERROR.
+
+import threading
+import Queue
+import collections
+import hashlib
+import csv
+import re
+import urllib
+
+S3_VERIFY_OK = "ok"
+S3_VERIFY_MISMATCH = "checksum_mismatch"
+S3_VERIFY_UNVERIFIABLE = "unverifiable"
+S3_VERIFY_ERROR = "error"
+S3_VERIFY_SIZE_COLLAPSE = "size_collapse"
+
+# size of the ranges read with one GET
+S3_VERIFY_RANGE_SIZE = 8 * 1024 ** 2
+
+# ranges in flight per worker
+S3_VERIFY_WINDOW = 2
+
+# part sizes of multipart uploads the content is checked against, besides the
+# smallest whole number of MB fitting the number of parts
+S3_VERIFY_PART_SIZES = [ n * 1024 ** 2 for n in [ 5, 8, 10, 15, 16, 25, 32, 50, 64, 100, 128, 256, 512 ] ]
+S3_VERIFY_MAX_PART_SIZES = 8
+
+# a version is reported as collapsed if its predecessor was at least this large
+# and it is smaller than this fraction of its predecessor
+S3_VERIFY_COLLAPSE_MIN_SIZE = 4096
+S3_VERIFY_COLLAPSE_RATIO = 0.1
+
+_md5_etag = re.compile(r"^[0-9a-f]{32}$")
+_multipart_etag = re.compile(r"^([0-9a-f]{32})-([0-9]+)$")
+
+# True if the size of version v collapsed compared to its predecessor
+
+def size_collapsed(v, predecessor):
+  return predecessor.size >= S3_VERIFY_COLLAPSE_MIN_SIZE and v.size < predecessor.size * S3_VERIFY_COLLAPSE_RATIO
+
+# manifest of MD5 checksums, a csv file with the columns object, version_id and md5
+
+def read_manifest(input):
+  manifest = {}
+  for row in csv.DictReader(input):
+    manifest[(row["object"], row["version_id"])] = row["md5"].lower()
+  return manifest
+
+# part sizes a multipart upload of size bytes in parts parts may have used
+
+def _part_sizes(size, parts):
+  mb = 1024 ** 2
+  sizes = [ (size + parts * mb - 1) // (parts * mb) * mb ] + S3_VERIFY_PART_SIZES
+  fitting = []
+  for p in sizes:
+    if (parts - 1) * p < size <= parts * p and p not in fitting:
+      fitting.append(p)
+  return fitting[0:S3_VERIFY_MAX_PART_SIZES]
+
+# the checksums of one version being read
+
+class _Check(object):
+
+  def __init__(self, v, md5=None, multipart=None):
+    self.v = v
+    self.md5 = md5
+    self.multipart = multipart
+    self.error = None
+    if md5 != None:
+      self.hash = hashlib.md5()
+    else:
+      self.parts = [ [ p, 0, hashlib.md5(), [] ] for p in _part_sizes(v.size, multipart[1]) ]
+
+  def update(self, data):
+    if self.md5 != None:
+      self.hash.update(data)
+      return
+    for part in self.parts:
+      part_size, filled, h, digests = part
+      i = 0
+      while i < len(data):
+        n = min(len(data) - i, part_size - filled)
+        h.update(buffer(data, i, n))
+        i += n
+        filled += n
+        if filled == part_size:
+          digests.append(h.digest())
+          h = hashlib.md5()
+          filled = 0
+      part[1:3] = [ filled, h ]
+
+  # (status, detail) of the completely read version
+
+  def result(self):
+    if self.error != None:
+      return S3_VERIFY_ERROR, self.error
+    if self.md5 != None:
+      md5 = self.hash.hexdigest()
+      if md5 == self.md5:
+        return S3_VERIFY_OK, md5
+      return S3_VERIFY_MISMATCH, "content md5 %s, expected %s" % (md5, self.md5)
+    md5, parts = self.multipart
+    for part_size, filled, h, digests in self.parts:
+      if filled:
+        digests = digests + [ h.digest() ]
+      if len(digests) == parts and hashlib.md5("".join(digests)).hexdigest() == md5:
+        return S3_VERIFY_OK, "%s-%d" % (md5, parts)
+    return S3_VERIFY_UNVERIFIABLE, "no part size matches the multipart etag %s-%d" % (md5, parts)
+
+# a range being fetched by a worker
+
+class _Fetch(object):
+
+  __slots__ = ("done", "data", "error")
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.data = None
+    self.error = None
+
+class ContentVerifier(object):
+
+  # open_bucket  called once per worker, must return a bucket on a connection of its own
+  # workers      number of worker threads
+  # on_result    called as on_result(v, status, detail) for every verified version
+  # manifest     dict (object, version_id) -> md5 taking precedence over the etags
+  # range_size   number of bytes read with one GET
+
+  def __init__(self, open_bucket, workers, on_result, manifest=None, range_size=S3_VERIFY_RANGE_SIZE):
+    if workers < 1:
+      raise ValueError("number of workers must be at least 1")
+    self.on_result = on_result
+    self.manifest = manifest or {}
+    self.range_size = range_size
+    self.window = workers * S3_VERIFY_WINDOW
+    self.queue = Queue.Queue()
+    self.pending = collections.deque()
+    self.verified = 0
+    self.bytes = 0
+    self.requests = 0
+
+    # connections are opened up front so that connection problems surface in the caller
+
+    self.buckets = [ open_bucket() for i in range(workers) ]
+    self.threads = []
+    for b in self.buckets:
+      t = threading.Thread(target=self._work, args=(b,))
+      t.daemon = True
+      t.start()
+      self.threads.append(t)
+
+  # verify the content of version v, blocks while window ranges are in flight
+
+  def add(self, v):
+    md5 = self.manifest.get((v.name, v.version_id))
+    multipart = None
+    if md5 == None:
+      etag = (v.etag or "").strip('"').lower()
+      if _md5_etag.match(etag):
+        md5 = etag
+      else:
+        m = _multipart_etag.match(etag)
+        if m:
+          multipart = (m.group(1), int(m.group(2)))
+    if md5 == None and multipart == None:
+      self.on_result(v, S3_VERIFY_UNVERIFIABLE, "etag %s is no md5" % v.etag)
+      return
+    check = _Check(v, md5, multipart)
+    if v.size == 0:
+      self._finish(check)
+      return
+    for start in xrange(0, v.size, self.range_size):
+      while len(self.pending) >= self.window:
+        self._consume()
+      end = min(start + self.range_size, v.size)
+      f = _Fetch()
+      self.requests += 1
+      self.queue.put((v.name, v.version_id, start, end, f))
+      self.pending.append((check, f, end == v.size))
+
+  # wait for all versions to be verified and stop the workers
+
+  def close(self):
+    while self.pending:
+      self._consume()
+    for t in self.threads:
+      self.queue.put(None)
+    for t in self.threads:
+      t.join()
+
+  def _consume(self):
+    check, f, last = self.pending.popleft()
+    f.done.wait()
+    if f.error != None:
+      if check.error == None:
+        check.error = f.error
+    elif check.error == None:
+      check.update(f.data)
+      self.bytes += len(f.data)
+    if last:
+      self._finish(check)
+
+  def _finish(self, check):
+    self.verified += 1
+    status, detail = check.result()
+    self.on_result(check.v, status, detail)
+
+  def _work(self, bucket):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        break
+      name, version_id, start, end, f = item
+      try:
+        f.data = self._get(bucket, name, version_id, start, end)
+      except Exception as e:
+        f.error = "%s %s" % (e.__class__.__name__, e)
+      f.done.set()
+
+  def _get(self, bucket, name, version_id, start, end):
+    if isinstance(name, unicode):
+      name = name.encode("utf-8")
+    response = bucket.connection.make_request("GET", bucket.name, name, headers={ "Range": "bytes=%d-%d" % (start, end - 1) }, query_args="versionId=" + urllib.quote(version_id, safe=""))
+    data = response.read()
+    if response.status not in [ 200, 206 ]:
+      raise IOError("GET failed: %d %s" % (response.status, response.reason))
+    if response.status == 200:
+      data = data[start:end]
+    if len(data) != end - start:
+      raise IOError("GET returned %d of %d bytes" % (len(data), end - start))
+    return data
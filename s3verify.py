@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# s3verify
+#
+# by Walter Graf
+#
+# usage: s3verify.py [-h] [-c s3-config-file] [--output csv-file-output]
+#                    [--after yyyy-mm-ddThh:mm:ss] [--prefix object-prefix]
+#                    [--latest-only] [--manifest manifest-file]
+#                    [--cache cache-file] [--range-size MB]
+#                    [--verify-workers workers] [--shards shards]
+#                    [--split-at object-name] [--delimiter delimiter]
+#                    [--workers workers] [--format {csv,binary}] [--compress]
+#                    [--verbose] [--backend {boto,async}] [--retries retries]
+#                    [--max-rate requests-per-sec] [--stats]
+#                    [--stats-file stats-file]
+#                    [--stats-format {prometheus,json}]
+#                    bucket-name
+#
+# verify the content of object versions against their checksums
+#
+# positional arguments:
+#   bucket-name           name of bucket
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   -c s3-config-file     use this S3 configuration file (default:
+#                         $HOME/s3versioning.cnf)
+#   --output csv-file-output, -o csv-file-output
+#                         write the versions with findings to this file
+#                         (default: stdout)
+#   --after yyyy-mm-ddThh:mm:ss
+#                         only verify versions modified after this time
+#   --prefix object-prefix
+#                         only verify objects starting with this prefix
+#   --latest-only         only verify the latest version of every object
+#   --manifest manifest-file
+#                         verify against the md5 checksums of this csv file with
+#                         the columns object, version_id and md5 instead of the
+#                         etags
+#   --cache cache-file    skip versions recorded as verified in this file and
+#                         record the newly verified ones
+#   --range-size MB       read the versions in ranges of this many MB (default:
+#                         8)
+#   --verify-workers workers
+#                         read ranges with this many parallel workers, each
+#                         using its own S3 connection (default: 8)
+#   --shards shards       split the listing into this many key ranges at common
+#                         prefixes and list them in parallel (default: 1)
+#   --split-at object-name
+#                         split the listing after this object name instead of at
+#                         common prefixes (may be repeated)
+#   --delimiter delimiter
+#                         delimiter used to discover common prefixes (default:
+#                         /)
+#   --workers workers     list this many key ranges in parallel, each using its
+#                         own S3 connection (default: 4)
+#   --format {csv,binary}
+#                         write the versions in this format (default: csv)
+#   --compress            compress binary output
+#   --verbose, -v         log every verified version to stderr
+#   --backend {boto,async}
+#                         send the S3 requests through boto's connections or the
+#                         event loop of s3async (default: boto)
+#   --retries retries     retry throttled or failed S3 requests this many times
+#                         (default: 8)
+#   --max-rate requests-per-sec
+#                         never send more than this many S3 requests per second
+#   --stats               print request and pipeline statistics to stderr at
+#                         exit
+#   --stats-file stats-file
+#                         write request and pipeline statistics to this file at
+#                         exit
+#   --stats-format {prometheus,json}
+#                         format of the statistics file (default: prometheus)
+#
+# findings:
+#   checksum_mismatch    the content does not match its md5 (etag or manifest)
+#   size_collapse        the version is less than a tenth of the size of its predecessor
+#   unverifiable         no md5 is known for the version (see s3verifier)
+#   error                the version could not be read
+# the versions with findings are written to the output in the format of the listing
+# tools, each version once even with several findings, so that e.g. corrupted
+# versions can be removed with s3delov
+
+import sys
+import os
+import argparse
+import time
+import itertools
+import s3version
+import s3stats
+import s3connect
+import s3scheduler
+import s3log
+import s3format
+import s3select
+import s3lister
+import s3journal
+import s3verifier
+
+# command line arguments
+
+def make_parser(prog=None):
+  parser = argparse.ArgumentParser(prog = prog, description = "verify the content of object versions against their checksums")
+  parser.add_argument("bucket", metavar="bucket-name", help="name of bucket")
+  parser.add_argument("-c", dest="s3_conf", metavar="s3-config-file", default=s3version.S3_CONF, help="use this S3 configuration file (default: %(default)s)")
+  parser.add_argument("--output", "-o", metavar="csv-file-output", help="write the versions with findings to this file (default: stdout)")
+  parser.add_argument("--after", metavar="yyyy-mm-ddThh:mm:ss", help="only verify versions modified after this time")
+  parser.add_argument("--prefix", metavar="object-prefix", help="only verify objects starting with this prefix")
+  parser.add_argument("--latest-only", action="store_true", help="only verify the latest version of every object")
+  parser.add_argument("--manifest", metavar="manifest-file", type=argparse.FileType("rb"), help="verify against the md5 checksums of this csv file with the columns object, version_id and md5 instead of the etags")
+  parser.add_argument("--cache", metavar="cache-file", help="skip versions recorded as verified in this file and record the newly verified ones")
+  parser.add_argument("--range-size", metavar="MB", type=int, default=s3verifier.S3_VERIFY_RANGE_SIZE // 1024 ** 2, help="read the versions in ranges of this many MB (default: %(default)s)")
+  parser.add_argument("--verify-workers", metavar="workers", type=int, default=8, help="read ranges with this many parallel workers, each using its own S3 connection (default: %(default)s)")
+  parser.add_argument("--shards", metavar="shards", type=int, default=1, help="split the listing into this many key ranges at common prefixes and list them in parallel (default: %(default)s)")
+  parser.add_argument("--split-at", metavar="object-name", action="append", help="split the listing after this object name instead of at common prefixes (may be repeated)")
+  parser.add_argument("--delimiter", metavar="delimiter", default="/", help="delimiter used to discover common prefixes (default: %(default)s)")
+  parser.add_argument("--workers", metavar="workers", type=int, default=4, help="list this many key ranges in parallel, each using its own S3 connection (default: %(default)s)")
+  parser.add_argument("--format", choices=s3format.S3_FORMATS, default="csv", help="write the versions in this format (default: %(default)s)")
+  parser.add_argument("--compress", action="store_true", help="compress binary output")
+  parser.add_argument("--verbose", "-v", action="store_true", help="log every verified version to stderr")
+  parser.add_argument("--backend", choices=s3connect.S3_BACKENDS, default="boto", help="send the S3 requests through boto's connections or the event loop of s3async (default: %(default)s)")
+  parser.add_argument("--retries", metavar="retries", type=int, default=s3scheduler.S3_SCHEDULER_RETRIES, help="retry throttled or failed S3 requests this many times (default: %(default)s)")
+  parser.add_argument("--max-rate", metavar="requests-per-sec", type=float, help="never send more than this many S3 requests per second")
+  parser.add_argument("--stats", action="store_true", help="print request and pipeline statistics to stderr at exit")
+  parser.add_argument("--stats-file", metavar="stats-file", help="write request and pipeline statistics to this file at exit")
+  parser.add_argument("--stats-format", choices=s3stats.S3_STATS_FORMATS, default="prometheus", help="format of the statistics file (default: %(default)s)")
+  return parser
+
+# verify the content of object versions as asked for by the command line arguments argv
+# (default: sys.argv), connect opens the S3 connections instead of the S3 configuration file
+# returns the exit status, 1 if any version has been flagged
+
+def main(argv=None, connect=None, prog=None):
+  parser = make_parser(prog)
+  args = parser.parse_args(argv)
+
+  # record request and pipeline statistics if asked for, they are reported at exit
+
+  s3stats.setup("s3verify", args.stats, args.stats_file, args.stats_format)
+
+  # retry failed requests and adapt the number of requests in flight to the endpoint
+
+  if args.retries < 0:
+    parser.error("number of retries must not be negative")
+  if args.max_rate != None and args.max_rate <= 0:
+    parser.error("maximum request rate must be positive")
+  s3scheduler.setup(args.retries, args.max_rate)
+
+  s3_conf = args.s3_conf
+  bucket_name = args.bucket
+  output_file = args.output
+  if args.after == None:
+    after_sec = 0.0
+  else:
+    after_sec = time.mktime(time.strptime(args.after,"%Y-%m-%dT%H:%M:%S"))
+  prefix = args.prefix
+  latest_only = args.latest_only
+  cache_file = args.cache
+  range_size = args.range_size * 1024 ** 2
+  verify_workers = args.verify_workers
+  shards = args.shards
+  split_at = args.split_at
+  delimiter = args.delimiter
+  workers = args.workers
+  format = args.format
+  compress = args.compress
+
+  if shards < 1:
+    parser.error("number of shards must be at least 1")
+  if workers < 1 or verify_workers < 1:
+    parser.error("number of workers must be at least 1")
+  if range_size < 1:
+    parser.error("range size must be at least 1 MB")
+
+  # load the manifest and the cache of verified versions
+
+  manifest = None
+  if args.manifest != None:
+    manifest = s3verifier.read_manifest(args.manifest)
+    print >> sys.stderr, "manifest", args.manifest.name, "holds", len(manifest), "checksums"
+
+  cache = None
+  if cache_file != None:
+    cache = s3journal.VerifyJournal(cache_file)
+    print >> sys.stderr, "cache", cache_file, "holds", cache.loaded, "verified versions"
+
+  # parse config file and establish S3 connections, unless the caller hands over its own
+  # parallel listing and verify workers each establish a connection of their own
+
+  if connect == None:
+    connect = s3connect.connector(s3connect.read_config(s3_conf), args.backend)
+
+  s3 = connect()
+  bucket = s3.get_bucket(bucket_name)
+  open_bucket = lambda: connect().get_bucket(bucket_name, validate=False)
+
+  # prepare output of the versions with findings
+
+  if output_file == None:
+    output = sys.stdout
+  else:
+    output = open(output_file, "wb")
+
+  writer = s3format.version_writer(output, bucket_name, format, compress)
+
+  # report the findings, record the verified versions in the cache
+
+  log = None
+  if args.verbose:
+    log = s3log.VersionLog()
+
+  findings = {}
+
+  # a size collapse is reported before the content of the version is verified, the
+  # collapsed versions are remembered until then so that each version is written once
+
+  collapsed = set()
+
+  def report(v, status, detail):
+    if log != None:
+      log.write(status, v.name, v.version_id)
+    written = (v.name, v.version_id) in collapsed
+    if status != s3verifier.S3_VERIFY_SIZE_COLLAPSE:
+      collapsed.discard((v.name, v.version_id))
+    if status == s3verifier.S3_VERIFY_OK:
+      if cache != None:
+        cache.record(bucket_name, [ (v.name, v.version_id, v.etag) ])
+      return
+    findings[status] = findings.get(status, 0) + 1
+    print >> sys.stderr, status, v.name, v.version_id, ":", detail
+    if not written:
+      writer.write(v)
+    if status == s3verifier.S3_VERIFY_SIZE_COLLAPSE:
+      collapsed.add((v.name, v.version_id))
+
+  verifier = s3verifier.ContentVerifier(open_bucket, verify_workers, report, manifest, range_size)
+
+  # list the object versions, split into shards either at the specified object names or at common prefixes
+
+  if split_at:
+    split_points = split_at
+  else:
+    split_points = s3lister.discover_split_points(bucket, prefix, shards, delimiter)
+  versions = s3lister.list_versions(bucket, prefix, split_points, workers, open_bucket)
+
+  # the listing returns the versions of an object next to each other, newest first
+  # every selected version is compared with its predecessor, the next older version that
+  # is not a delete marker, and its content is verified unless the cache knows it
+  # delete markers have no content
+
+  selector = s3select.ModifiedSelector(after_sec)
+  select = s3stats.timed_call(selector.select, "select")
+  verify = s3stats.timed_call(verifier.add, "verify", "selected")
+
+  skipped = 0
+  for name, group in itertools.groupby(s3stats.timed(versions, "list", "listed"), lambda v: v.name):
+    group = list(group)
+    for i, v in enumerate(group):
+      if latest_only and i > 0:
+        break
+      if v.del_marker or not select(v):
+        continue
+      for predecessor in group[i + 1:]:
+        if not predecessor.del_marker:
+          if s3verifier.size_collapsed(v, predecessor):
+            report(v, s3verifier.S3_VERIFY_SIZE_COLLAPSE, "%d bytes, predecessor %s %d bytes" % (v.size, predecessor.version_id, predecessor.size))
+          break
+      if cache != None and cache.done(bucket_name, v.name, v.version_id, v.etag):
+        collapsed.discard((v.name, v.version_id))
+        skipped += 1
+        continue
+      verify(v)
+
+  s3stats.timed_call(verifier.close, "verify")()
+  writer.flush()
+  if output_file != None:
+    output.close()
+  if log != None:
+    log.close()
+  if cache != None:
+    cache.close()
+  s3stats.stats.count("verified", verifier.verified)
+  for status, n in findings.items():
+    s3stats.stats.count(status, n)
+
+  print >> sys.stderr, "verified", verifier.verified, "versions,", verifier.bytes, "bytes,", verifier.requests, "range requests"
+  if cache != None:
+    print >> sys.stderr, "skipped", skipped, "versions verified by a previous run"
+  for status, n in sorted(findings.items()):
+    print >> sys.stderr, "  ", n, "x", status
+  if findings:
+    return 1
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
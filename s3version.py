@@ -2,3 +2,9 @@ import os
 S3_DEFAULT_CONF_FILE = "s3versioning.cnf"
 S3_CONF = os.environ["HOME"] + "/" + S3_DEFAULT_CONF_FILE
 S3_CSV_KEYS = [ "bucket", "object", "version_id", "mod_time", "size", "del_marker", "is_latest" ]
+S3_DEFAULT_CATALOG_FILE = "s3versioning.db"
+S3_CATALOG = os.environ["HOME"] + "/" + S3_DEFAULT_CATALOG_FILE
+S3_DEFAULT_METADATA_FILE = "s3metadata.db"
+S3_METADATA = os.environ["HOME"] + "/" + S3_DEFAULT_METADATA_FILE
+S3_DEFAULT_SOCKET_FILE = "s3daemon.sock"
+S3_SOCKET = os.environ["HOME"] + "/" + S3_DEFAULT_SOCKET_FILE
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+# test_s3deleter
+#
+# by Walter Graf
+#
+# checks of the result handling of s3deleter against in-memory buckets
+#
+# usage: python -m unittest test_s3deleter
+
+import unittest
+import s3async
+import s3deleter
+
+# a multi-object delete result as boto parses it
+
+class _Error(object):
+
+  def __init__(self, key, version_id, code, message):
+    self.key = key
+    self.version_id = version_id
+    self.code = code
+    self.message = message
+
+class _Result(object):
+
+  def __init__(self, errors):
+    self.errors = errors
+
+# a bucket failing the multi-object delete of the names in failing
+# boto returns the keys of the parsed response as unicode
+
+class _Bucket(object):
+
+  def __init__(self, failing):
+    self.name = "bucket"
+    self.connection = None
+    self.failing = failing
+
+  def delete_keys(self, keys, quiet=False):
+    return _Result([ _Error(name.decode("utf-8"), unicode(version_id), "AccessDenied", "Access Denied") for name, version_id in keys if name in self.failing ])
+
+# a bucket rejecting every multi-object delete with status
+
+class _RejectingBucket(object):
+
+  def __init__(self, status, code=None):
+    self.name = "bucket"
+    self.connection = None
+    self.status = status
+    self.code = code
+    self.single = []
+
+  def delete_keys(self, keys, quiet=False):
+    import boto.exception
+    body = None
+    if self.code != None:
+      body = "<Error><Code>%s</Code><Message>rejected</Message></Error>" % self.code
+    raise boto.exception.S3ResponseError(self.status, "rejected", body)
+
+  def delete_key(self, name, version_id=None):
+    self.single.append((name, version_id))
+
+# an async client answering every request with a canned response
+
+class _Request(object):
+
+  def __init__(self, method, response):
+    self.method = method
+    self.response = response
+
+  def wait(self):
+    return self.response
+
+class _Client(object):
+
+  def __init__(self, status, body):
+    self.status = status
+    self.body = body
+    self.submitted = []
+    self.sent = None
+
+  def submit(self, method, bucket, key=None, headers=None, body=None, query_args=None):
+    self.submitted.append((method, key, query_args))
+    self.sent = body
+    return _Request(method, s3async.Response(self.status, "", [], self.body))
+
+class _Connection(object):
+
+  def __init__(self, client):
+    self.client = client
+
+class _AsyncBucket(object):
+
+  def __init__(self, client):
+    self.name = "bucket"
+    self.connection = _Connection(client)
+
+class BulkResultTest(unittest.TestCase):
+
+  def setUp(self):
+    self.failed = []
+    self.deleted = []
+
+  def on_failure(self, name, version_id, code, message, row):
+    self.failed.append((name, version_id, code, row))
+
+  def on_deleted(self, versions):
+    self.deleted.extend(versions)
+
+  def check(self, deleter):
+    self.assertEqual(deleter.deleted, 1)
+    self.assertEqual(deleter.failed, 1)
+    self.assertEqual(self.failed, [ ("gr\xc3\xbc\xc3\x9fe", "v2", "AccessDenied", "row 2") ])
+    self.assertEqual(self.deleted, [ ("plain", "v1", "row 1") ])
+
+  def test_failing_non_ascii_key(self):
+    deleter = s3deleter.VersionDeleter(_Bucket([ "gr\xc3\xbc\xc3\x9fe" ]), on_failure=self.on_failure, on_deleted=self.on_deleted)
+    deleter.add("plain", "v1", "row 1")
+    deleter.add("gr\xc3\xbc\xc3\x9fe", "v2", "row 2")
+    deleter.close()
+    self.check(deleter)
+
+  def test_failing_non_ascii_key_async(self):
+    body = ('<?xml version="1.0" encoding="UTF-8"?><DeleteResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+      '<Error><Key>gr\xc3\xbc\xc3\x9fe</Key><VersionId>v2</VersionId><Code>AccessDenied</Code><Message>Access Denied</Message></Error>'
+      '</DeleteResult>')
+    deleter = s3deleter.AsyncDeleter(_AsyncBucket(_Client(200, body)), on_failure=self.on_failure, on_deleted=self.on_deleted)
+    deleter.add("plain", "v1", "row 1")
+    deleter.add("gr\xc3\xbc\xc3\x9fe", "v2", "row 2")
+    deleter.close()
+    self.check(deleter)
+
+class BulkFallbackTest(unittest.TestCase):
+
+  def test_unsupported(self):
+    for status, code in [ (400, "NotImplemented"), (405, None), (501, None) ]:
+      bucket = _RejectingBucket(status, code)
+      deleter = s3deleter.VersionDeleter(bucket)
+      deleter.add("a", "v1")
+      deleter.close()
+      self.assertFalse(deleter.bulk)
+      self.assertEqual((deleter.deleted, deleter.failed), (1, 0))
+      self.assertEqual(bucket.single, [ ("a", "v1") ])
+
+  def test_failed_batch(self):
+    bucket = _RejectingBucket(403)
+    deleter = s3deleter.VersionDeleter(bucket)
+    deleter.add("a", "v1")
+    deleter.add("b", "v2")
+    deleter.close()
+    self.assertTrue(deleter.bulk)
+    self.assertEqual((deleter.deleted, deleter.failed), (0, 2))
+    self.assertEqual(bucket.single, [])
+
+  def test_malformed(self):
+    bucket = _RejectingBucket(400, "MalformedXML")
+    deleter = s3deleter.VersionDeleter(bucket)
+    deleter.add("a", "v1")
+    deleter.add("b", "v2")
+    deleter.close()
+    self.assertTrue(deleter.bulk)
+    self.assertEqual((deleter.deleted, deleter.failed), (0, 2))
+    self.assertEqual(deleter.errors, { "MalformedXML": 2 })
+    self.assertEqual(bucket.single, [])
+
+  def test_malformed_async(self):
+    client = _Client(400, "<Error><Code>MalformedXML</Code><Message>rejected</Message></Error>")
+    deleter = s3deleter.AsyncDeleter(_AsyncBucket(client))
+    deleter.add("a", "v1")
+    deleter.close()
+    self.assertTrue(deleter.bulk)
+    self.assertEqual((deleter.deleted, deleter.failed), (0, 1))
+    self.assertEqual(deleter.errors, { "MalformedXML": 1 })
+    self.assertEqual([ method for method, key, query_args in client.submitted ], [ "POST" ])
+
+  def test_failed_batch_async(self):
+    client = _Client(403, "")
+    deleter = s3deleter.AsyncDeleter(_AsyncBucket(client))
+    deleter.add("a", "v1")
+    deleter.close()
+    self.assertTrue(deleter.bulk)
+    self.assertEqual((deleter.deleted, deleter.failed), (0, 1))
+    self.assertEqual([ method for method, key, query_args in client.submitted ], [ "POST" ])
+
+  def test_unsupported_async(self):
+    client = _Client(501, "")
+    deleter = s3deleter.AsyncDeleter(_AsyncBucket(client))
+    deleter.add("a", "v1")
+    deleter.close()
+    self.assertFalse(deleter.bulk)
+    self.assertEqual([ method for method, key, query_args in client.submitted ], [ "POST", "DELETE" ])
+
+class DeleteMarkerTest(unittest.TestCase):
+
+  def test_bulk_async(self):
+    client = _Client(200, '<?xml version="1.0" encoding="UTF-8"?><DeleteResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/"></DeleteResult>')
+    deleter = s3deleter.AsyncDeleter(_AsyncBucket(client))
+    deleter.add("a", None)
+    deleter.add("b", "v2")
+    deleter.close()
+    self.assertEqual((deleter.deleted, deleter.failed), (2, 0))
+    self.assertTrue("<Object><Key>a</Key></Object>" in client.sent)
+    self.assertTrue("<Object><Key>b</Key><VersionId>v2</VersionId></Object>" in client.sent)
+
+  def test_single_async(self):
+    client = _Client(204, "")
+    deleter = s3deleter.AsyncDeleter(_AsyncBucket(client), batch_size=1)
+    deleter.add("a", None)
+    deleter.close()
+    self.assertEqual((deleter.deleted, deleter.failed), (1, 0))
+    self.assertEqual(client.submitted, [ ("DELETE", "a", None) ])
+
+class ParallelDeleterTest(unittest.TestCase):
+
+  def on_failure(self, name, version_id, code, message, row):
+    raise IOError("disk full")
+
+  def test_worker_error(self):
+    deleter = s3deleter.ParallelDeleter(lambda: _RejectingBucket(403), 2, 2, on_failure=self.on_failure, queue_size=1)
+    for i in range(20):
+      deleter.add("key%d" % i, "v%d" % i)
+    self.assertRaises(IOError, deleter.close)
+
+  def test_worker_error_flush(self):
+    deleter = s3deleter.ParallelDeleter(lambda: _RejectingBucket(403), 2, 2, on_failure=self.on_failure)
+    deleter.add("a", "v1")
+    deleter.add("b", "v2")
+    self.assertRaises(IOError, deleter.flush)
+
+if __name__ == "__main__":
+  unittest.main()